@@ -0,0 +1,673 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Regression tests for transcode.py. Run with: python -m unittest
+test_transcode'''
+
+import os, sys, shutil, tempfile, unittest, datetime, json, struct, types
+import threading
+import transcode
+
+_EBML_HEADER = 0x1A45DFA3
+_MKV_INFO = 0x1549A966
+_MKV_CLUSTER = 0x1F43B675
+
+def _segment(children, trailing = '', size_len = 8):
+    '''Builds a minimal Matroska file from the given top-level elements
+    (ID and payload), with a SeekHead listing them, followed by any trailing
+    data outside of the Segment. The size of the Segment is written using
+    size_len bytes, as mkvmerge does.'''
+    elements = [transcode._ebml_element(eid, payload)
+                for eid, payload in children]
+    entries = [(eid, 0) for eid, payload in children]
+    head_len = len(transcode._mkv_seekhead(entries))
+    (pos, entries) = (head_len, [])
+    for (eid, payload), element in zip(children, elements):
+        entries.append((eid, pos))
+        pos += len(element)
+    body = transcode._mkv_seekhead(entries) + ''.join(elements)
+    return transcode._ebml_element(_EBML_HEADER, 'matroska') + \
+        transcode._ebml_id(transcode._EBML_SEGMENT) + \
+        transcode._ebml_vint(len(body), size_len) + body + trailing
+
+def _seek_target(filename, eid):
+    '''Returns the ID of the element found where the SeekHead of a Matroska
+    file says the given element is.'''
+    with open(filename, 'rb') as mkv:
+        (size_pos, data, end, children) = transcode._mkv_segment(mkv)
+        for child, start, stop in children:
+            if child == transcode._EBML_SEEKHEAD:
+                mkv.seek(start)
+                raw = mkv.read(stop - start)
+                for sid, pos in transcode._mkv_seek_entries(raw):
+                    if sid == eid:
+                        mkv.seek(data + pos)
+                        return transcode._ebml_header(mkv.read(12))[0]
+    return None
+
+class CheckJobTest(unittest.TestCase):
+    
+    def test_jobs(self):
+        'Batch jobs are checked before any of them is started.'
+        (fd, video) = tempfile.mkstemp(suffix = '.mkv')
+        os.close(fd)
+        try:
+            self.assertEqual(transcode._check_job(['1021', '20120501200000']),
+                             None)
+            self.assertEqual(transcode._check_job(['42']), None)
+            self.assertEqual(transcode._check_job([video]), None)
+            self.assertEqual(transcode._check_job(['1021', '2012050120']),
+                             'invalid timestamp')
+            self.assertEqual(transcode._check_job(['x', '20120501200000']),
+                             'invalid channel ID')
+            self.assertEqual(transcode._check_job([video + '.missing']),
+                             'file not found')
+            self.assertEqual(transcode._check_job([__file__]),
+                             'file is not a WTV recording or a valid ' +
+                             'video file')
+        finally:
+            os.remove(video)
+    
+    def test_batch_jobs(self):
+        'Recording names in batch files become channel IDs and timestamps.'
+        self.assertEqual(transcode._job_args('1021_20120501200000.mpg'),
+                         ['1021', '20120501200000'])
+        self.assertEqual(transcode._check_job(transcode._job_args(
+            '1021 2012050120')), 'file not found')
+
+class _Chapters:
+    
+    def __init__(self):
+        self.marks = []
+    
+    def add(self, pos, seg):
+        self.marks.append((pos, seg))
+
+class _CutOptions:
+    cutter = 'concat'
+    clip_thresh = 5
+
+class _CutSource:
+    orig = 'test.mpg'
+    cutlist = [(100, 160), (200, 260)]
+    duration = 300
+
+class _Transcoder(transcode.Transcoder):
+    
+    def __init__(self):
+        (self.opts, self.source) = (_CutOptions(), _CutSource())
+        (self.chapters, self._clips) = (_Chapters(), [])
+
+class SplitTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.keyframe = transcode._keyframe_before
+        transcode._keyframe_before = lambda filename, time: time // 3 * 3
+        self.t = _Transcoder()
+    
+    def tearDown(self):
+        transcode._keyframe_before = self.keyframe
+    
+    def test_concat_keyframes(self):
+        'Clips start at the keyframe before each cut, moving the chapters.'
+        self.t.split()
+        self.assertEqual(self.t._clips, [(0, 100), (159, 200), (258, 300)])
+        self.assertEqual(self.t.chapters.marks,
+                         [(0, 0), (100, 1), (141, 2), (183, None)])
+    
+    def test_concat_short_cut(self):
+        'Cuts shorter than a GOP are kept rather than copied twice.'
+        self.t.source.cutlist = [(100, 101), (200, 260)]
+        self.t.split()
+        self.assertEqual(self.t._clips, [(0, 200), (258, 300)])
+        self.assertEqual(self.t.chapters.marks,
+                         [(0, 0), (200, 1), (242, None)])
+    
+    def test_concat_no_keyframe(self):
+        'Clips are extracted separately if a keyframe cannot be found.'
+        transcode._keyframe_before = lambda filename, time: None
+        self.t._extract = lambda clip: None
+        self.t.split()
+        self.assertEqual(self.t.opts.cutter, 'split')
+        self.assertEqual(self.t._clips, [(0, 100), (160, 200), (260, 300)])
+        self.assertEqual(self.t.chapters.marks,
+                         [(0, 0), (100, 1), (140, 2), (180, None)])
+    
+    def test_split_unchanged(self):
+        'Clips extracted separately keep the exact cut points.'
+        self.t.opts.cutter = 'projectx'
+        self.t.split()
+        self.assertEqual(self.t._clips, [(0, 100), (160, 200), (260, 300)])
+        self.assertEqual(self.t.chapters.marks,
+                         [(0, 0), (100, 1), (140, 2), (180, None)])
+
+class CommandTest(unittest.TestCase):
+    
+    def test_abort_after_register(self):
+        'Commands registered once the abort flag is set are never started.'
+        (procs, abort) = ([], threading.Event())
+        abort.set()
+        args = [sys.executable, '-c', 'open(%r, "w")' % os.devnull]
+        self.assertRaises(RuntimeError, transcode._cmd, args,
+                          procs = procs, abort = abort)
+        self.assertEqual(procs, [])
+        transcode._cmd(args, procs = procs, abort = threading.Event())
+
+class ToolCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix = 'transcode_test_')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+    
+    def test_non_utf8_output(self):
+        'Tool output which is not UTF-8 is decoded and can be cached.'
+        args = [sys.executable, '-c',
+                'import sys; sys.stdout.write("v\\xff1\\n")']
+        lines = transcode._ver_output(args, False)
+        self.assertEqual(lines, [u'v\ufffd1\n'])
+        path = os.path.join(self.tmp, 'tools.json')
+        transcode._save_tool_cache(path)
+        with open(path, 'r') as cache:
+            self.assertTrue(u'v\ufffd1\n' in
+                            [l for e in json.load(cache).values()
+                             for l in e['lines']])
+
+class EvictTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix = 'transcode_test_')
+        for sub in ['index', 'http', 'art']:
+            os.mkdir(os.path.join(self.tmp, sub))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+    
+    def _add(self, sub, name, size, mtime):
+        filename = os.path.join(self.tmp, sub, name)
+        with open(filename, 'wb') as data:
+            data.write('x' * size)
+        os.utime(filename, (mtime, mtime))
+    
+    def test_evict_index(self):
+        'The least recently used frame indexes are removed first.'
+        self._add('index', 'old.idx', 400, 1000)
+        self._add('index', 'mid.idx', 400, 2000)
+        self._add('index', 'new.idx', 400, 3000)
+        self._add('http', 'response', 400, 0)
+        transcode._evict_lru(self.tmp, 1000, ['index'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp, 'index'))),
+                         ['mid.idx', 'new.idx'])
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'http')),
+                         ['response'])
+    
+    def test_evict_when_full(self):
+        'Downloads are only listed again once they pass the size limit.'
+        transcode._cache_totals.clear()
+        self._add('http', 'old', 400, 1000)
+        transcode._cache_added(self.tmp, 1000, 400)
+        self._add('art', 'mid', 400, 2000)
+        transcode._cache_added(self.tmp, 1000, 400)
+        self._add('http', 'unseen', 400, 2500)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'http', 'old')))
+        self._add('http', 'new', 400, 3000)
+        transcode._cache_added(self.tmp, 1000, 400)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp, 'http'))),
+                         ['new', 'unseen'])
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'art')), [])
+        transcode._cache_totals.clear()
+
+class MKVWriteElementsTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix = 'transcode_test_')
+        self.mkv = os.path.join(self.tmp, 'test.mkv')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+    
+    def _write(self, data):
+        with open(self.mkv, 'wb') as mkv:
+            mkv.write(data)
+    
+    def _read(self):
+        with open(self.mkv, 'rb') as mkv:
+            return mkv.read()
+    
+    def test_no_room_leaves_file_untouched(self):
+        'Tags which do not fit are not voided if they cannot be appended.'
+        tags = transcode._ebml_element(0x7373, 'old')
+        self._write(_segment([(_MKV_INFO, 'info'),
+                              (transcode._EBML_TAGS, tags),
+                              (_MKV_CLUSTER, 'x' * 64)],
+                             transcode._ebml_element(_EBML_HEADER, 'next')))
+        before = self._read()
+        new = transcode._ebml_element(transcode._EBML_TAGS, 'N' * 500)
+        self.assertRaises(ValueError, transcode._mkv_write_elements,
+                          self.mkv, {transcode._EBML_TAGS : new})
+        self.assertEqual(self._read(), before)
+        self.assertEqual(_seek_target(self.mkv, transcode._EBML_TAGS),
+                         transcode._EBML_TAGS)
+    
+    def test_no_room_for_segment_size(self):
+        'Tags are not voided if the size of the Segment cannot grow.'
+        tags = transcode._ebml_element(0x7373, 'old')
+        self._write(_segment([(_MKV_INFO, 'info'),
+                              (transcode._EBML_TAGS, tags),
+                              (_MKV_CLUSTER, 'x')], size_len = 1))
+        before = self._read()
+        new = transcode._ebml_element(transcode._EBML_TAGS, 'N' * 500)
+        self.assertRaises(ValueError, transcode._mkv_write_elements,
+                          self.mkv, {transcode._EBML_TAGS : new})
+        self.assertEqual(self._read(), before)
+    
+    def test_append_at_end_of_file(self):
+        'Tags which do not fit in place are appended and indexed.'
+        tags = transcode._ebml_element(0x7373, 'old')
+        self._write(_segment([(_MKV_INFO, 'info'),
+                              (transcode._EBML_TAGS, tags),
+                              (_MKV_CLUSTER, 'x' * 64)]))
+        new = transcode._ebml_element(transcode._EBML_TAGS, 'N' * 500)
+        transcode._mkv_write_elements(self.mkv, {transcode._EBML_TAGS : new})
+        self.assertTrue(self._read().endswith(new))
+        self.assertEqual(_seek_target(self.mkv, transcode._EBML_TAGS),
+                         transcode._EBML_TAGS)
+        with open(self.mkv, 'rb') as mkv:
+            children = transcode._mkv_segment(mkv)[3]
+        self.assertEqual([eid for eid, start, stop in children],
+                         [transcode._EBML_SEEKHEAD, _MKV_INFO,
+                          transcode._EBML_VOID, _MKV_CLUSTER,
+                          transcode._EBML_TAGS])
+
+_SAMPLES = ['sample one', 'sample two']
+
+def _mp4(layout):
+    '''Builds a minimal MPEG-4 file whose chunk offset table points at two
+    samples within its mdat box. The layout is 'start' (moov before mdat),
+    'end' (moov at the end of the file) or 'free' (moov before mdat,
+    followed by padding).'''
+    ftyp = transcode._mp4_box('ftyp', 'isom' + '\0' * 4)
+    mdat = transcode._mp4_box('mdat', ''.join(_SAMPLES))
+    def moov(offsets):
+        stco = transcode._mp4_box('stco', struct.pack('>II', 0, len(offsets))
+                                  + ''.join([struct.pack('>I', o)
+                                             for o in offsets]))
+        for kind in ['stbl', 'minf', 'mdia', 'trak', 'moov']:
+            stco = transcode._mp4_box(kind, stco)
+        return stco
+    size = len(moov([0, 0]))
+    if layout == 'end':
+        (before, after) = (ftyp + mdat, '')
+    elif layout == 'free':
+        (before, after) = (ftyp, transcode._mp4_free(256) + mdat)
+    else:
+        (before, after) = (ftyp, mdat)
+    data = len(ftyp) + 8
+    if layout != 'end':
+        data += size + len(after) - len(mdat)
+    offsets = [data, data + len(_SAMPLES[0])]
+    return before + moov(offsets) + after
+
+def _mp4_samples(filename):
+    'Returns the data found at each offset in the chunk offset table.'
+    with open(filename, 'rb') as mp4:
+        data = mp4.read()
+    box = (0, len(data))
+    for kind in ['moov', 'trak', 'mdia', 'minf', 'stbl', 'stco']:
+        for name, start, body, end in transcode._mp4_boxes(data, *box):
+            if name == kind:
+                box = (body, end)
+                break
+        else:
+            return None
+    count = struct.unpack('>I', data[box[0] + 4:box[0] + 8])[0]
+    offsets = struct.unpack('>%dI' % count, data[box[0] + 8:box[1]])
+    return [data[o:o + len(sample)] for o, sample in zip(offsets, _SAMPLES)]
+
+class MP4WriteItemsTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix = 'transcode_test_')
+        self.mp4 = os.path.join(self.tmp, 'test.mp4')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+    
+    def _write(self, layout):
+        with open(self.mp4, 'wb') as mp4:
+            mp4.write(_mp4(layout))
+    
+    def _boxes(self):
+        with open(self.mp4, 'rb') as mp4:
+            return [kind for kind, start, end
+                    in transcode._mp4_top_boxes(mp4)]
+    
+    def test_moov_before_mdat(self):
+        'A moov box which outgrows its space is moved to the end.'
+        self._write('start')
+        transcode._mp4_write_items(self.mp4,
+                                   [transcode._mp4_item('\xa9nam', 'Name')])
+        self.assertEqual(self._boxes(), ['ftyp', 'free', 'mdat', 'moov',
+                                         'free'])
+        self.assertEqual(_mp4_samples(self.mp4), _SAMPLES)
+        self.assertTrue('\xa9nam' in transcode._mp4_read_items(self.mp4))
+    
+    def test_moov_at_end(self):
+        'A moov box at the end of the file is rewritten where it is.'
+        self._write('end')
+        transcode._mp4_write_items(self.mp4,
+                                   [transcode._mp4_item('\xa9nam', 'Name')])
+        self.assertEqual(self._boxes(), ['ftyp', 'mdat', 'moov', 'free'])
+        self.assertEqual(_mp4_samples(self.mp4), _SAMPLES)
+        self.assertTrue('\xa9nam' in transcode._mp4_read_items(self.mp4))
+    
+    def test_moov_before_free(self):
+        'Padding after the moov box is used before moving it.'
+        self._write('free')
+        size = os.path.getsize(self.mp4)
+        transcode._mp4_write_items(self.mp4,
+                                   [transcode._mp4_item('\xa9nam', 'Name')])
+        self.assertEqual(self._boxes(), ['ftyp', 'moov', 'free', 'mdat'])
+        self.assertEqual(os.path.getsize(self.mp4), size)
+        self.assertEqual(_mp4_samples(self.mp4), _SAMPLES)
+        transcode._mp4_write_items(self.mp4,
+                                   [transcode._mp4_item('desc', 'x' * 400)])
+        self.assertEqual(self._boxes(), ['ftyp', 'free', 'free', 'mdat',
+                                         'moov', 'free'])
+        self.assertEqual(_mp4_samples(self.mp4), _SAMPLES)
+        items = transcode._mp4_read_items(self.mp4)
+        self.assertTrue('\xa9nam' in items and 'desc' in items)
+    
+    def test_replace_and_remove(self):
+        'Items are replaced by key, and items set to None are removed.'
+        self._write('end')
+        transcode._mp4_write_items(self.mp4,
+                                   [transcode._mp4_item('\xa9nam', 'Old'),
+                                    transcode._mp4_item('\xa9gen', 'Drama')])
+        transcode._mp4_write_items(self.mp4,
+                                   [transcode._mp4_item('\xa9nam', 'New'),
+                                    ('\xa9gen', None)])
+        items = transcode._mp4_read_items(self.mp4)
+        self.assertEqual(sorted(items.keys()), ['\xa9nam'])
+        self.assertTrue(items['\xa9nam'].endswith('New'))
+        self.assertEqual(_mp4_samples(self.mp4), _SAMPLES)
+
+class _Options:
+    webm = False
+
+class _Source(dict):
+    opts = _Options()
+    base = None
+    final_file = None
+    time = datetime.datetime(2012, 5, 1, 20, 0)
+    fps = 29.97
+
+class _Later(datetime.datetime):
+    
+    @classmethod
+    def now(cls, tz = None):
+        return datetime.datetime(2030, 1, 1, 12, 0)
+
+class MKVMetadataTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix = 'transcode_test_')
+        _Source.base = os.path.join(self.tmp, 'test')
+        _Source.final_file = os.path.join(self.tmp, 'test.mkv')
+        with open(_Source.final_file, 'wb') as mkv:
+            mkv.write(_segment([(_MKV_INFO, 'info'),
+                                (_MKV_CLUSTER, 'x' * 64)]))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+    
+    def test_unchanged_ignores_dates(self):
+        'Tags differing only in the tagging dates are left alone.'
+        source = _Source(title = 'Show', subtitle = 'Episode', season = 1,
+                         episode = 2, credits = [('Some Actor', 'actor')])
+        meta = transcode.MKVMetadata(source)
+        self.assertFalse(meta.unchanged('test'))
+        meta.embed('test')
+        clock = types.ModuleType('datetime')
+        clock.__dict__.update(datetime.__dict__)
+        clock.datetime = _Later
+        transcode.datetime = clock
+        try:
+            self.assertTrue(transcode.MKVMetadata(source).unchanged('test'))
+        finally:
+            transcode.datetime = datetime
+        source['subtitle'] = 'Another Episode'
+        self.assertFalse(transcode.MKVMetadata(source).unchanged('test'))
+    
+    def test_embed_without_credits(self):
+        'TV episodes with no credits can be tagged in place.'
+        source = _Source(title = 'Show', subtitle = 'Episode', season = 1,
+                         episode = 2)
+        meta = transcode.MKVMetadata(source)
+        self.assertFalse(meta.unchanged('test'))
+        meta.embed('test')
+        self.assertTrue(transcode.MKVMetadata(source).unchanged('test'))
+    
+    def test_embed_non_ascii(self):
+        'Unicode and UTF-8 encoded values are embedded as UTF-8.'
+        source = _Source(title = u'Caf\xe9', subtitle = '\xc3\xa9t\xc3\xa9')
+        meta = transcode.MKVMetadata(source)
+        meta.embed('test')
+        tags = dict([(name, val) for target, name, val
+                     in meta._current_tags()])
+        self.assertEqual(tags['TITLE'], 'Caf\xc3\xa9')
+        self.assertEqual(tags['SUBTITLE'], '\xc3\xa9t\xc3\xa9')
+        self.assertTrue(transcode.MKVMetadata(source).unchanged('test'))
+    
+    def _attachments(self):
+        'Returns the description and data of each attached file.'
+        raw = transcode._mkv_read_element(_Source.final_file,
+                                          transcode._EBML_ATTACHMENTS)
+        ids = transcode._EBML_FILE_IDS
+        files = []
+        for eid, start, body, end in transcode._ebml_children(
+                raw, transcode._ebml_header(raw)[2]):
+            fields = dict([(child, raw[cbody:cend]) for child, cstart, cbody,
+                           cend in transcode._ebml_children(raw, body, end)])
+            files.append((fields[ids['FileDescription']],
+                          fields[ids['FileData']]))
+        return files
+    
+    def test_embed_artwork(self):
+        'Artwork replaces the previous artwork, keeping other attachments.'
+        ids = transcode._EBML_FILE_IDS
+        font = transcode._ebml_element(ids['FileDescription'], 'Font')
+        font += transcode._ebml_element(ids['FileData'], 'glyphs')
+        font = transcode._ebml_element(transcode._EBML_ATTACHED_FILE, font)
+        with open(_Source.final_file, 'wb') as mkv:
+            mkv.write(_segment([(_MKV_INFO, 'info'),
+                                (transcode._EBML_ATTACHMENTS, font),
+                                (_MKV_CLUSTER, 'x' * 64)]))
+        art = os.path.join(self.tmp, 'art.jpg')
+        for image in ['first image', 'second image']:
+            with open(art, 'wb') as data:
+                data.write(image)
+            source = _Source(title = 'Show', subtitle = 'Episode',
+                             albumart = art)
+            transcode.MKVMetadata(source).embed('test')
+        self.assertEqual(self._attachments(),
+                         [('Font', 'glyphs'),
+                          ('Episode preview', 'second image')])
+        self.assertEqual(_seek_target(_Source.final_file,
+                                      transcode._EBML_ATTACHMENTS),
+                         transcode._EBML_ATTACHMENTS)
+    
+    def test_keep_recording_date(self):
+        'Re-tagging keeps the recording date already within the file.'
+        source = _Source(title = 'Show', subtitle = 'Episode')
+        transcode.MKVMetadata(source).embed('test')
+        source = _Source(title = 'Show', subtitle = 'Episode')
+        source.time = None
+        meta = transcode.MKVMetadata(source)
+        self.assertTrue(meta.unchanged('test'))
+        meta.embed('test')
+        dates = [val for target, name, val in meta._current_tags()
+                 if name == 'DATE_RECORDED']
+        self.assertEqual(dates, ['2012-05-01'])
+
+class MP4MetadataTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix = 'transcode_test_')
+        self.mp4 = os.path.join(self.tmp, 'test.mp4')
+        with open(self.mp4, 'wb') as mp4:
+            mp4.write(_mp4('start'))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+    
+    def _source(self, **tags):
+        source = _Source(**tags)
+        source.final_file = self.mp4
+        return source
+    
+    def test_unchanged(self):
+        'Files already carrying every item are recognized as unchanged.'
+        source = self._source(title = 'Show', subtitle = 'Episode',
+                              season = 1, seasoncount = 2)
+        meta = transcode.MP4Metadata(source)
+        self.assertFalse(meta.unchanged('test'))
+        meta.write('test')
+        self.assertTrue(transcode.MP4Metadata(source).unchanged('test'))
+        items = transcode._mp4_read_items(self.mp4)
+        self.assertTrue('tvsh' in items and 'disk' in items)
+        self.assertTrue(items['\xa9nam'].endswith('Episode'))
+        source['subtitle'] = 'Another Episode'
+        self.assertFalse(transcode.MP4Metadata(source).unchanged('test'))
+        self.assertEqual(_mp4_samples(self.mp4), _SAMPLES)
+    
+    def test_retag_files(self):
+        'Only MPEG-4 and Matroska videos are re-tagged, in sorted order.'
+        os.mkdir(os.path.join(self.tmp, 'sub'))
+        for name in ['b.MKV', 'a.m4v', 'c.avi', 'sub/d.mp4', 'notes.txt']:
+            open(os.path.join(self.tmp, name), 'wb').close()
+        found = [os.path.relpath(f, self.tmp)
+                 for f in transcode._retag_files(self.tmp)]
+        self.assertEqual(found, ['a.m4v', 'b.MKV', 'test.mp4',
+                                 os.path.join('sub', 'd.mp4')])
+
+class TitleCatalogTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix = 'transcode_test_')
+        path = os.path.join(self.tmp, 'catalog.db')
+        self.catalog = transcode.TitleCatalog(path)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+    
+    def test_round_trip(self):
+        'Added titles are found again with their ID and year.'
+        self.catalog.add('movie', 'Some Movie', 42, 1999)
+        self.assertEqual(self.catalog.search('movie', 'some movie'),
+                         [(u'Some Movie', u'42', 1999)])
+        self.assertEqual(self.catalog.search('show', 'Some Movie'), [])
+        self.assertEqual(self.catalog.search('movie', 'Unrelated'), [])
+    
+    def test_ranking(self):
+        'Exact matches come first, followed by the most similar titles.'
+        for title in ['Office Space', 'The Office', 'The Offices',
+                      'Parks and Recreation']:
+            self.catalog.add('show', title)
+        found = [f[0] for f in self.catalog.search('show', 'the office')]
+        self.assertEqual(found[:2], [u'The Office', u'The Offices'])
+        self.assertTrue(u'Parks and Recreation' not in found)
+        found = [f[0] for f in self.catalog.search('show', 'the ofice')]
+        self.assertEqual(found[0], u'The Office')
+    
+    def test_lookup_related_titles(self):
+        'Related titles which merely contain the title are not matches.'
+        self.catalog.add('show', 'Law & Order: Special Victims Unit')
+        self.catalog.add('movie', 'The Godfather: Part II', 240, 1974)
+        self.assertEqual(self.catalog.lookup('show', 'Law & Order'), None)
+        self.assertEqual(self.catalog.lookup('movie', 'The Godfather'), None)
+        self.assertEqual(self.catalog.lookup('movie', 'The Godfather Part II',
+                                             year = 1974),
+                         (u'The Godfather: Part II', u'240', 1974))
+        self.assertEqual(self.catalog.lookup('movie', 'The Godfather: Part II',
+                                             year = 1990), None)
+        self.assertEqual(self.catalog.lookup('show', 'Law and Order: ' +
+                                             'Special Victim Unit')[0],
+                         u'Law & Order: Special Victims Unit')
+    
+    def test_non_ascii(self):
+        'UTF-8 encoded and unicode titles are interchangeable.'
+        self.catalog.add('show', 'Caf\xc3\xa9 Show')
+        self.catalog.add('show', 'Bad \xff Bytes')
+        for title in ['Caf\xc3\xa9 Show', u'caf\xe9 show']:
+            found = self.catalog.search('show', title)
+            self.assertEqual(found[0][0], u'Caf\xe9 Show')
+        self.assertEqual(self.catalog.search('show', 'Bad \xff Bytes')[0][0],
+                         u'Bad \ufffd Bytes')
+
+class CutPairsTest(unittest.TestCase):
+    
+    def test_balanced(self):
+        'Start and end marks are paired in order.'
+        marks = [(300, 1), (100, 1), (400, 0), (200, 0)]
+        self.assertEqual(transcode._cut_pairs(marks),
+                         [(100, 200), (300, 400)])
+    
+    def test_leading_end(self):
+        'A leading end mark cuts from the beginning.'
+        marks = [(50, 0), (100, 1), (200, 0)]
+        self.assertEqual(transcode._cut_pairs(marks), [(0, 50), (100, 200)])
+    
+    def test_trailing_start(self):
+        'A trailing start mark cuts to the end.'
+        marks = [(100, 1), (200, 0), (300, 1)]
+        self.assertEqual(transcode._cut_pairs(marks),
+                         [(100, 200), (300, 9999999)])
+    
+    def test_stray(self):
+        'Repeated start or end marks are ignored.'
+        marks = [(100, 1), (150, 1), (200, 0), (250, 0), (300, 1), (400, 0)]
+        self.assertEqual(transcode._cut_pairs(marks),
+                         [(100, 200), (300, 400)])
+        self.assertEqual(transcode._cut_pairs([]), [])
+
+class _Cursor:
+    
+    def __init__(self, results):
+        (self.results, self.queries) = (results, [])
+    
+    def execute(self, query, args):
+        self.queries.append((query, args))
+    
+    def fetchall(self):
+        return self.results.pop(0)
+    
+    def close(self):
+        pass
+
+class _Database:
+    
+    def __init__(self, results):
+        self.cur = _Cursor(results)
+    
+    def cursor(self):
+        return self.cur
+
+class MythLoaderTest(unittest.TestCase):
+    
+    def test_union_routing(self):
+        'Rows of each batched query are returned for their own parameters.'
+        db = _Database([[(1, 'b1'), (0, 'a1'), (1, 'b2')], [(0, 'c1')]])
+        loader = transcode.MythLoader(db)
+        loader.chunk = 2
+        rows = loader._union('x FROM t WHERE k = %s', [(1,), (2,), (3,)])
+        self.assertEqual(rows, [[('a1',)], [('b1',), ('b2',)], [('c1',)]])
+        (query, args) = db.cur.queries[0]
+        self.assertEqual(query, '(SELECT 0, x FROM t WHERE k = %s) ' +
+                         'UNION ALL (SELECT 1, x FROM t WHERE k = %s)')
+        self.assertEqual(args, [1, 2])
+        self.assertEqual(db.cur.queries[1][1], [3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -43,7 +43,6 @@ For Matroska / VP8:
 
 Optional dependencies:
 - ccextractor (http://ccextractor.sourceforge.net)
-- AtomicParsley (https://bitbucket.org/wez/atomicparsley)
 
 Most of these packages can usually be found in various Linux software
 repositories or as pre-compiled Windows binaries.
@@ -62,6 +61,9 @@ Usage:
   transcode.py %CHANID% %STARTTIME%
   transcode.py /path/to/file.wtv
   transcode.py /path/to/file.m4v
+  transcode.py --batch 1041_20100523000000 /path/to/file.wtv ...
+  transcode.py --batch-file jobs.txt --workers 4
+  transcode.py --retag /srv/video --lookup-workers 8
 See transcode.py --help for more details
 
 Notes on format string:
@@ -117,11 +119,12 @@ Special thanks to:
 # Known issues:
 # - subtitle font is sometimes too large on QuickTime / iTunes / iPods
 # - many Matroska players seem to have trouble displaying metadata properly
-# - AtomicParsley can crash on MPEG-4 files larger than 2 GB
-# - no Unicode support for AtomicParsley on Windows (Python bug)
 
-import re, os, sys, math, datetime, subprocess, urllib, tempfile, glob
+import re, os, sys, math, datetime, subprocess, urllib, tempfile
 import shutil, codecs, StringIO, time, optparse, unicodedata, logging
+import copy, multiprocessing, threading, hashlib, array, bisect, json
+import signal, collections, struct, urllib2, httplib, sqlite3
+import multiprocessing.pool
 import xml.dom.minidom
 import MythTV, MythTV.ttvdb.tvdb_api, MythTV.ttvdb.tvdb_exceptions
 import MythTV.tmdb3.tmdb_api, MythTV.tmdb3.tmdb_exceptions
@@ -135,6 +138,48 @@ def _clean(filename):
     except OSError:
         pass
 
+def _unicode(val):
+    '''Returns val as a unicode string, decoding byte strings as UTF-8 and
+    replacing any invalid characters.'''
+    if isinstance(val, str):
+        return val.decode('utf_8', 'replace')
+    return unicode(val)
+
+def _replace(src, dest):
+    'Moves the file src over dest, replacing it atomically where possible.'
+    if os.name == 'nt':
+        _clean(dest)
+    os.rename(src, dest)
+
+def _cache_path(opts, *parts):
+    '''Returns the path of a file within the cache directory, creating any
+    directories necessary, or None if caching is disabled.'''
+    if not opts.cache:
+        return None
+    path = os.path.join(opts.cache, *parts)
+    path_dir = os.path.dirname(path)
+    if not os.path.isdir(path_dir):
+        try:
+            os.makedirs(path_dir, 0755)
+        except OSError:
+            if not os.path.isdir(path_dir):
+                logging.warning('*** Could not create cache directory ***')
+                return None
+    return path
+
+def _file_key(filename):
+    '''Returns a key identifying the contents of a file, using its size and
+    a hash of its first and last megabyte of data.'''
+    mb = 1024 * 1024
+    size = os.path.getsize(filename)
+    sha = hashlib.sha1(str(size))
+    with open(filename, 'rb') as data:
+        sha.update(data.read(mb))
+        if size > 2 * mb:
+            data.seek(-mb, os.SEEK_END)
+            sha.update(data.read(mb))
+    return sha.hexdigest()
+
 def _convert_time(time):
     '''Converts a timestamp string into a datetime object.
     For example, '20100523140000' -> datetime(2010, 5, 23, 14, 0, 0) '''
@@ -159,6 +204,57 @@ def _convert_timestamp(ts):
     end += float(ts.group(8)) / 10 ** len(ts.group(8))
     return start, end
 
+def _srt_cues(subs):
+    '''Reads each caption from an open SRT file, yielding its start and end
+    times (in seconds) along with its lines of text.'''
+    ts = '(\d\d):(\d\d):(\d\d),(\d+)'
+    regex = re.compile(ts + '\s*-+>\s*' + ts)
+    (times, text) = (None, [])
+    for line in subs:
+        match = None
+        if '>' in line:
+            match = regex.search(line)
+        if match:
+            (times, text) = (_convert_timestamp(match), [])
+        elif line.strip() == '':
+            if times is not None:
+                yield times[0], times[1], text
+            times = None
+        elif times is not None:
+            text.append(line)
+    if times is not None:
+        yield times[0], times[1], text
+
+def _srt_time(sec):
+    'Formats a time in seconds as a SRT timestamp, e.g. 01:01:15,140.'
+    ms = int(round(max(sec, 0) * 1000))
+    (hours, ms) = divmod(ms, 3600000)
+    (minutes, ms) = divmod(ms, 60000)
+    (sec, ms) = divmod(ms, 1000)
+    return '%02d:%02d:%02d,%03d' % (hours, minutes, sec, ms)
+
+def _srt_rewrite(filename, transform):
+    '''Streams the captions of a SRT file through transform, which receives
+    and yields captions as (start, end, lines of text). The results are
+    numbered in order and written to a temporary file, which then replaces
+    the original SRT file. Returns the number of captions written.'''
+    (fd, tmp) = tempfile.mkstemp(dir = os.path.dirname(filename) or '.',
+                                 suffix = '.srt')
+    count = 0
+    try:
+        with os.fdopen(fd, 'w') as dest, open(filename, 'r') as subs:
+            for start, end, text in transform(_srt_cues(subs)):
+                count += 1
+                dest.write('%d\n%s --> %s\n' % (count, _srt_time(start),
+                                                _srt_time(end)))
+                dest.writelines(text)
+                dest.write('\n')
+        _replace(tmp, filename)
+    except:
+        _clean(tmp)
+        raise
+    return count
+
 def _seconds_to_time(sec):
     '''Returns a string representation of the length of time provided.
     For example, 3675.14 -> '01:01:15' '''
@@ -182,23 +278,68 @@ def _seconds_to_time_frac(sec, comma = False):
     else:
         return '%02d:%02d:%07.4f' % (hours, minutes, sec)
 
-def _levenshtein(lhs, rhs):
-    '''Computes the Levenbshtein distance between two strings, as discussed
-    and implemented in http://en.wikipedia.org/wiki/Levenshtein_distance'''
-    xlen = len(lhs) + 1
-    ylen = len(rhs) + 1
-    arr = [[0 for col in xrange(0, xlen)] for row in xrange(0, ylen)]
-    for y in xrange(0, ylen):
-        arr[y][0] = y
-    for x in xrange(0, xlen):
-        arr[0][x] = x
-    for y in xrange(1, ylen):
-        for x in xrange(1, xlen):
-            dist = arr[y - 1][x - 1]
-            if lhs[x - 1] != rhs[y - 1]:
-                dist = min(arr[y - 1][x], arr[y][x - 1], arr[y - 1][x - 1]) + 1
-            arr[y][x] = dist
-    return arr[ylen - 1][xlen - 1]
+def _levenshtein(lhs, rhs, limit = None):
+    '''Computes the Levenshtein distance between two strings, as discussed
+    in http://en.wikipedia.org/wiki/Levenshtein_distance, keeping only two
+    rows of the matrix. If a limit is given, only the diagonal band of
+    cells which could be under the limit is computed, and the limit itself
+    is returned as soon as the distance is known to reach it.'''
+    if len(lhs) < len(rhs):
+        lhs, rhs = rhs, lhs
+    xlen = len(lhs)
+    ylen = len(rhs)
+    if limit is None:
+        limit = xlen + 1
+    if xlen - ylen >= limit:
+        return limit
+    prev = [min(x, limit) for x in xrange(0, xlen + 2)]
+    cur = [limit] * (xlen + 2)
+    for y in xrange(1, ylen + 1):
+        lo = max(1, y - limit + 1)
+        hi = min(xlen, y + limit - 1)
+        if lo == 1:
+            cur[0] = min(y, limit)
+        else:
+            cur[lo - 1] = limit
+        best = cur[lo - 1]
+        ch = rhs[y - 1]
+        for x in xrange(lo, hi + 1):
+            if lhs[x - 1] == ch:
+                dist = prev[x - 1]
+            else:
+                dist = min(prev[x], cur[x - 1], prev[x - 1]) + 1
+                if dist > limit:
+                    dist = limit
+            cur[x] = dist
+            if dist < best:
+                best = dist
+        cur[hi + 1] = limit
+        if best >= limit:
+            return limit
+        prev, cur = cur, prev
+    return min(prev[xlen], limit)
+
+def _fuzzy_match(title, candidates, thresh = 0, key = None):
+    '''Returns the first of the candidates which matches closely with the
+    title: either containing the title, if it is long enough, or within the
+    Levenshtein threshold of it. The candidates are only consumed up to the
+    match, and key optionally obtains the name of each candidate.'''
+    if thresh == 0:
+        thresh = max(int(round(len(title) * 0.25)), 3)
+    title = title.lower()
+    contain = len(title) > 8
+    for candidate in candidates:
+        test = candidate
+        if key is not None:
+            test = key(candidate)
+        if test is None:
+            continue
+        test = test.lower()
+        if contain and test.find(title) >= 0:
+            return candidate
+        if _levenshtein(title, test, thresh) < thresh:
+            return candidate
+    return None
 
 def _last_name_first(name):
     '''Reverses the order of full names of people, so their last name
@@ -249,6 +390,17 @@ def _filter_xml(data):
     sub = '<\g<1>>\g<2></\g<3>>'
     return re.sub(regex, sub, data)
 
+def _seek_args(filename, start, length, opts, preroll = 10):
+    '''Returns arguments for ffmpeg to read length seconds of video from
+    filename, beginning at start. If fast seeking is enabled, ffmpeg jumps
+    straight to the keyframe before (start - preroll) without reading the
+    data leading up to it, and then skips accurately to start from there,
+    so that the clip boundaries are unchanged.'''
+    if not opts.fast_seek or start <= preroll:
+        return ['-i', filename, '-ss', str(start), '-t', str(length)]
+    return ['-ss', str(start - preroll), '-i', filename, '-ss', str(preroll),
+            '-t', str(length)]
+
 def _list_to_utf8(args):
     'Converts a list of objects into UTF-8 strings.'
     out = []
@@ -259,47 +411,281 @@ def _list_to_utf8(args):
             out.append(str(arg))
     return out
 
-def _cmd(args, cwd = None, expected = 0):
-    '''Executes an external command with the given working directory, ignoring
-    all output. Raises a RuntimeError exception if the return code of the
-    subprocess isn't what is expected.'''
-    args = _list_to_utf8(args)
-    ret = 0
-    logging.debug('$ %s' % ' '.join(args))
-    time.sleep(0.5)
-    proc = subprocess.Popen(args, stdout = subprocess.PIPE,
-                            stderr = subprocess.STDOUT, cwd = cwd)
-    for line in proc.stdout:
-        logging.debug(line.replace('\n', ''))
-    ret = proc.wait()
-    time.sleep(0.5)
+_commands = set()
+_commands_lock = threading.Lock()
+
+class Command:
+    '''Runs an external command in its own process group, so that it and
+    any children it spawns can be killed together. Only the last few lines of
+    output are kept (all of them if tail is None), and each line may be
+    passed to a callback as it is read. Once finished, the wall-clock time
+    and the CPU time used by the child (from its resource usage) are
+    recorded.'''
+    
+    def __init__(self, args, cwd = None, timeout = None, tail = 25,
+                 use_stderr = True, callback = None):
+        self.args = _list_to_utf8(args)
+        self.cwd = cwd
+        self.timeout = timeout
+        self.output = collections.deque(maxlen = tail)
+        self.use_stderr = use_stderr
+        self.callback = callback
+        self.proc = None
+        self.returncode = None
+        self.wall = None
+        self.cpu = None
+        self.killed = False
+        self.timed_out = False
+        self._lock = threading.Lock()
+        self._timer = None
+        self._started = None
+    
+    def start(self):
+        '''Starts the command. Raises an OSError exception if the program
+        could not be run.'''
+        kwargs = {}
+        if os.name == 'nt':
+            kwargs['creationflags'] = getattr(subprocess,
+                                              'CREATE_NEW_PROCESS_GROUP',
+                                              0x200)
+        else:
+            kwargs['preexec_fn'] = os.setpgrp
+            kwargs['close_fds'] = True
+        logging.debug('$ %s' % ' '.join(self.args))
+        with self._lock:
+            if self.killed:
+                raise RuntimeError('Command aborted', ' '.join(self.args))
+            with open(os.devnull, 'r+') as devnull:
+                stderr = subprocess.STDOUT
+                if not self.use_stderr:
+                    stderr = devnull
+                self.proc = subprocess.Popen(self.args, cwd = self.cwd,
+                                             stdin = devnull,
+                                             stdout = subprocess.PIPE,
+                                             stderr = stderr, **kwargs)
+            self._started = time.time()
+        with _commands_lock:
+            _commands.add(self)
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def _expire(self):
+        'Kills the command once its time limit has passed.'
+        self.timed_out = True
+        self.kill()
+    
+    def kill(self):
+        '''Kills the command along with its process group. If the command has
+        not been started yet, it is prevented from starting.'''
+        with self._lock:
+            self.killed = True
+            if self.proc is None or self.returncode is not None:
+                return
+            try:
+                if os.name == 'nt':
+                    with open(os.devnull, 'w') as devnull:
+                        subprocess.call(['taskkill', '/F', '/T', '/PID',
+                                         str(self.proc.pid)],
+                                        stdout = devnull, stderr = devnull)
+                else:
+                    os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+    
+    def wait(self):
+        '''Reads the output of the command until it exits, and returns its
+        exit code.'''
+        try:
+            for line in iter(self.proc.stdout.readline, ''):
+                line = line.rstrip('\r\n')
+                self.output.append(line)
+                if self.callback is not None:
+                    self.callback(line)
+            self.proc.stdout.close()
+            if hasattr(os, 'wait4'):
+                (pid, status, usage) = os.wait4(self.proc.pid, 0)
+                if os.WIFSIGNALED(status):
+                    self.proc.returncode = -os.WTERMSIG(status)
+                else:
+                    self.proc.returncode = os.WEXITSTATUS(status)
+                self.cpu = usage.ru_utime + usage.ru_stime
+            else:
+                self.proc.wait()
+        finally:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer.join()
+            with _commands_lock:
+                _commands.discard(self)
+        with self._lock:
+            self.returncode = self.proc.returncode
+        self.wall = time.time() - self._started
+        if self.cpu is None:
+            logging.debug('Exited with %d after %.1fs' %
+                          (self.returncode, self.wall))
+        else:
+            logging.debug('Exited with %d after %.1fs (%.1fs CPU)' %
+                          (self.returncode, self.wall, self.cpu))
+        return self.returncode
+    
+    def run(self):
+        '''Runs the command to completion and returns its exit code. The
+        command is killed if reading its output is interrupted.'''
+        self.start()
+        try:
+            return self.wait()
+        except BaseException:
+            self.kill()
+            raise
+    
+    def log_tail(self):
+        'Logs the last few lines of output, such as after a failure.'
+        for line in self.output:
+            logging.error('  %s' % line)
+
+def _kill_commands():
+    'Kills every external command which is still running.'
+    with _commands_lock:
+        running = list(_commands)
+    for cmd in running:
+        cmd.kill()
+
+def _cmd(args, cwd = None, expected = 0, procs = None, timeout = None,
+         abort = None):
+    '''Executes an external command with the given working directory,
+    keeping only the last lines of output for reporting failures. Raises a
+    RuntimeError exception if the return code of the subprocess isn't what
+    is expected, or if it runs for longer than the timeout. If procs is
+    provided, the command is added to it while running, so that it may be
+    killed by another thread. The command is not run if the abort event is
+    set once it has been added.'''
+    cmd = Command(args, cwd = cwd, timeout = timeout)
+    if procs is not None:
+        procs.append(cmd)
+    try:
+        if abort is not None and abort.is_set():
+            raise RuntimeError('Command aborted', ' '.join(cmd.args))
+        ret = cmd.run()
+    finally:
+        if procs is not None:
+            procs.remove(cmd)
+    if cmd.timed_out:
+        cmd.log_tail()
+        raise RuntimeError('Command timed out', ' '.join(cmd.args), timeout)
     if ret != 0 and ret != expected:
-        raise RuntimeError('Unexpected return code', ' '.join(args), ret)
+        cmd.log_tail()
+        raise RuntimeError('Unexpected return code', ' '.join(cmd.args), ret)
     return ret
 
+_ver_cache = {}
+_ver_lock = threading.Lock()
+_tool_cache = {}
+
+def _which(name):
+    '''Locates an executable in the current directory or on the PATH, and
+    returns its full path, or None if it could not be found.'''
+    exts = ['']
+    if os.name == 'nt':
+        exts += os.environ.get('PATHEXT', '.EXE').lower().split(os.pathsep)
+    dirs = os.environ.get('PATH', '').split(os.pathsep)
+    if os.path.dirname(name):
+        dirs = ['']
+    for path in dirs:
+        for ext in exts:
+            full = os.path.join(path, name + ext)
+            if os.path.isfile(full) and os.access(full, os.X_OK):
+                return os.path.realpath(full)
+    return None
+
+def _tool_stamp(args):
+    '''Identifies the program run by a probe command by its path and
+    modification time, along with any Java archive it runs. Returns None if
+    the program cannot be found.'''
+    files = [_which(args[0])]
+    if '-jar' in args and args.index('-jar') + 1 < len(args):
+        jar = args[args.index('-jar') + 1]
+        if os.path.isfile(jar):
+            files.append(os.path.realpath(jar))
+        else:
+            files.append(None)
+    stamp = []
+    for filename in files:
+        if filename is None:
+            return None
+        stamp.append([filename, os.path.getmtime(filename)])
+    return stamp
+
+def _load_tool_cache(opts):
+    '''Reads previously probed tool output from the cache directory, which
+    remains valid for as long as each tool stays unchanged. Returns the path
+    of the tool cache, or None if caching is disabled.'''
+    path = _cache_path(opts, 'tools.json')
+    if path is None or not os.path.exists(path):
+        return path
+    try:
+        with open(path, 'r') as cache:
+            entries = json.load(cache)
+        with _ver_lock:
+            _tool_cache.update(entries)
+    except (IOError, ValueError):
+        logging.debug('Ignoring unreadable tool cache %s' % path)
+    return path
+
+def _save_tool_cache(path):
+    'Writes the probed tool output to the given tool cache file.'
+    if path is None:
+        return
+    try:
+        with _ver_lock:
+            data = json.dumps(_tool_cache)
+        with open(path + '.tmp', 'w') as cache:
+            cache.write(data)
+        _replace(path + '.tmp', path)
+    except (IOError, OSError, ValueError, UnicodeError):
+        logging.debug('Could not write tool cache %s' % path)
+
+def _ver_output(args, use_stderr = True):
+    '''Executes an external command and returns its standard output (and
+    optionally stderr) as a list of lines. The output of each command is
+    remembered, so that tools are only probed once per process, and in the
+    tool cache on disk, so that unchanged tools are not probed again. Lines
+    are decoded as UTF-8, so that they are unicode whether or not they were
+    cached.'''
+    key = (tuple(args), use_stderr)
+    with _ver_lock:
+        if key in _ver_cache:
+            return _ver_cache[key]
+    disk_key = json.dumps([args, use_stderr])
+    stamp = _tool_stamp(args)
+    with _ver_lock:
+        entry = _tool_cache.get(disk_key)
+        if stamp is not None and entry and entry['stamp'] == stamp:
+            _ver_cache[key] = entry['lines']
+            return entry['lines']
+    lines = []
+    cmd = Command(args, timeout = 60, tail = None, use_stderr = use_stderr)
+    try:
+        cmd.run()
+        lines = [_unicode(line) + u'\n' for line in cmd.output]
+    except OSError:
+        pass
+    with _ver_lock:
+        _ver_cache[key] = lines
+        if stamp is not None:
+            _tool_cache[disk_key] = {'stamp' : stamp, 'lines' : lines}
+    return lines
+
 def _ver(args, regex, use_stderr = True):
     '''Executes an external command and searches through the standard output
     (and optionally stderr) for the provided regular expression. Returns the
     first matched group, or None if no matches were found.'''
-    ret = None
-    with open(os.devnull, 'w') as devnull:
-        try:
-            stderr = subprocess.STDOUT
-            if not use_stderr:
-                stderr = devnull
-            proc = subprocess.Popen(args, stdout = subprocess.PIPE,
-                                    stderr = stderr)
-            for line in proc.stdout:
-                match = re.search(regex, line)
-                if match:
-                    ret = match.group(1).strip()
-                    break
-            for line in proc.stdout:
-                pass
-            proc.wait()
-        except OSError:
-            pass
-    return ret
+    for line in _ver_output(args, use_stderr):
+        match = re.search(regex, line)
+        if match:
+            return match.group(1).strip()
+    return None
 
 def _nero_ver():
     '''Determines whether neroAacEnc is present, and if so, returns the
@@ -349,8 +735,13 @@ def _projectx_ver(opts):
     return _ver(['java', '-jar', opts.projectx, '-?'],
                 '(ProjectX [0-9/.]*)')
 
+_versions = {}
+
 def _version(opts):
     'Compiles a string representing the versions of the encoding tools.'
+    key = (opts.video, opts.audio, opts.aac_encoder, opts.projectx)
+    if key in _versions:
+        return _versions[key]
     nero_ver = _nero_ver()
     faac_ver = _faac_ver()
     x264_ver = _x264_ver()
@@ -369,8 +760,360 @@ def _version(opts):
     elif opts.aac_encoder == 'faac' and faac_ver:
         ver += ', %s' % faac_ver
     logging.debug('Version string: %s' % ver)
+    _versions[key] = ver
     return ver
 
+def _tool_probes(opts):
+    '''Returns the list of commands (and whether stderr is read) which are
+    used to detect the external tools and their capabilities.'''
+    probes = [(['ffmpeg', '-version'], False)]
+    for args in [['ffmpeg', '-codecs'], ['ffmpeg', '-help'],
+                 ['ffmpeg', '-formats'],
+                 ['neroAacEnc', '-help'], ['x264', '--version'], ['vp8enc'],
+                 ['faac', '--help'], ['flac', '-version'],
+                 ['java', '-jar', opts.projectx, '-?'], ['ccextractor'],
+                 ['MP4Box', '-version'], ['mkvmerge', '--version']]:
+        probes.append((args, True))
+    return probes
+
+def _probe_tools(opts):
+    '''Probes each of the external tools once, in parallel, so that the
+    results can be shared by every job. Output of tools which have not
+    changed since the last run is read from the tool cache instead.'''
+    path = _load_tool_cache(opts)
+    threads = []
+    for args, use_stderr in _tool_probes(opts):
+        thread = threading.Thread(target = _ver_output,
+                                  args = (args, use_stderr))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    _save_tool_cache(path)
+
+_downloads = ['http', 'art']
+
+def _evict_lru(path, size, subs = _downloads):
+    '''Removes the least recently used files within the given subdirectories
+    of the cache directory (by default, downloaded Tvdb / TMDb responses and
+    artwork) until together they fit well within the given size limit, in
+    bytes. Returns the size of the files which remain.'''
+    entries = []
+    total = 0
+    for sub in subs:
+        try:
+            names = os.listdir(os.path.join(path, sub))
+        except OSError:
+            continue
+        for name in names:
+            filename = os.path.join(path, sub, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            total += st.st_size
+    if total <= size:
+        return total
+    entries.sort()
+    for mtime, length, filename in entries:
+        if total <= size * 0.9:
+            break
+        _clean(filename)
+        total -= length
+    return total
+
+_cache_totals = {}
+_cache_lock = threading.Lock()
+
+def _cache_added(path, size, added, subs = _downloads):
+    '''Records that a file of added bytes was written to the given
+    subdirectories of the cache directory. The files are only listed once
+    per process, and again whenever the running total passes the size
+    limit, when the least recently used files are evicted.'''
+    key = (path, tuple(subs))
+    with _cache_lock:
+        total = _cache_totals.get(key)
+        if total is not None and total + added <= size:
+            _cache_totals[key] = total + added
+            return
+        _cache_totals[key] = _evict_lru(path, size, subs)
+
+class RateLimiter:
+    '''Spaces out requests to Tvdb / TMDb so that at most rate requests per
+    second are made by all of the threads within the process. A rate of 0
+    disables the limit.'''
+    
+    def __init__(self, rate):
+        self.interval = 0
+        if rate > 0:
+            self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next = 0
+    
+    def wait(self):
+        'Blocks until the next request may be made.'
+        if self.interval == 0:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+_rate_limiters = {}
+_rate_lock = threading.Lock()
+
+def _rate_limiter(opts):
+    'Returns the request rate limiter shared within the process.'
+    with _rate_lock:
+        if opts.request_rate not in _rate_limiters:
+            _rate_limiters[opts.request_rate] = RateLimiter(opts.request_rate)
+        return _rate_limiters[opts.request_rate]
+
+_lookup = threading.local()
+
+def _lookup_cancelled():
+    '''Determines whether the background metadata lookup running in the
+    current thread has been abandoned for running past its deadline.'''
+    cancel = getattr(_lookup, 'cancel', None)
+    return cancel is not None and cancel.is_set()
+
+class CacheHandler(urllib2.BaseHandler):
+    '''Stores the responses to HTTP GET requests (such as Tvdb and TMDb
+    lookups) on disk, so that they are shared between jobs, processes and
+    runs. Responses expire after ttl seconds, and the least recently used
+    responses and artwork are evicted whenever together they grow beyond
+    size bytes. In offline mode, cached responses are returned however old
+    they are, and any other request fails. Requests which are not answered
+    from the cache wait for the rate limiter, if given.'''
+    handler_order = 100
+    
+    def __init__(self, path, ttl, size, offline = False, limiter = None):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        self.offline = offline
+        self.limiter = limiter
+    
+    def _file(self, req):
+        'Returns the name of the cache entry for the given request.'
+        key = hashlib.sha1(req.get_full_url()).hexdigest()
+        return os.path.join(self.path, key)
+    
+    def _cacheable(self, req):
+        'Determines whether the response to the request may be cached.'
+        return self.path is not None and req.get_method() == 'GET'
+    
+    def _response(self, info, body):
+        'Builds a urllib2 response object from a cache entry.'
+        headers = httplib.HTTPMessage(StringIO.StringIO(info['headers']))
+        resp = urllib.addinfourl(StringIO.StringIO(body), headers,
+                                 info['url'], info['code'])
+        resp.msg = info['msg']
+        return resp
+    
+    def _miss(self, req):
+        '''Lets a request which cannot be answered from the cache through to
+        the network, once the rate limiter allows it, unless offline or the
+        lookup making the request has been cancelled.'''
+        if self.offline:
+            url = req.get_full_url()
+            raise urllib2.URLError('No cached response for %s in offline '
+                                   'mode' % url)
+        if self.limiter is not None and not _lookup_cancelled():
+            self.limiter.wait()
+        if _lookup_cancelled():
+            raise urllib2.URLError('Metadata lookup cancelled')
+        return None
+    
+    def default_open(self, req):
+        '''Returns the cached response to the request, if one exists which
+        has not yet expired.'''
+        if not self._cacheable(req):
+            return self._miss(req)
+        filename = self._file(req)
+        try:
+            with open(filename, 'rb') as entry:
+                info = json.loads(entry.readline())
+                age = time.time() - info['time']
+                if not self.offline and (age < 0 or age > self.ttl):
+                    return self._miss(req)
+                body = entry.read()
+        except (IOError, ValueError, KeyError):
+            return self._miss(req)
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        logging.debug('Using cached response for %s' % req.get_full_url())
+        resp = self._response(info, body)
+        resp.cached = True
+        return resp
+    
+    def http_response(self, req, resp):
+        '''Saves each successful response to the cache, replacing any
+        expired entry atomically.'''
+        if not self._cacheable(req) or resp.code != 200 or \
+                getattr(resp, 'cached', False):
+            return resp
+        body = resp.read()
+        info = {'url' : resp.geturl(), 'code' : resp.code, 'msg' : resp.msg,
+                'headers' : ''.join(resp.info().headers),
+                'time' : time.time()}
+        try:
+            fd, tmp = tempfile.mkstemp(prefix = '.', dir = self.path)
+            with os.fdopen(fd, 'wb') as entry:
+                entry.write(json.dumps(info) + '\n')
+                entry.write(body)
+            _replace(tmp, self._file(req))
+            _cache_added(os.path.dirname(self.path), self.size,
+                         os.path.getsize(self._file(req)))
+        except (IOError, OSError):
+            logging.debug('Could not cache response for %s' %
+                          req.get_full_url())
+        return self._response(info, body)
+    
+    https_response = http_response
+
+_http_openers = {}
+_http_lock = threading.Lock()
+
+def _http_opener(opts):
+    '''Returns a urllib2 opener which reads through the HTTP cache within
+    the cache directory, and installs it for any module which calls
+    urllib2.urlopen directly (such as tmdb3).'''
+    path = _cache_path(opts, 'http', '')
+    if path is not None:
+        path = os.path.dirname(path)
+    key = (path, opts.cache_ttl, opts.cache_size, opts.offline,
+           opts.request_rate)
+    limiter = _rate_limiter(opts)
+    with _http_lock:
+        if key not in _http_openers:
+            handler = CacheHandler(path, opts.cache_ttl * 3600,
+                                   opts.cache_size * 1024 * 1024,
+                                   opts.offline, limiter)
+            _http_openers[key] = urllib2.build_opener(handler)
+        urllib2.install_opener(_http_openers[key])
+        return _http_openers[key]
+
+class MediaInfo:
+    '''Describes the container format and streams of a media file, as
+    reported once by ffprobe.'''
+    
+    def __init__(self, filename):
+        self.filename = filename
+        cmd = Command(['ffprobe', '-v', 'error', '-print_format', 'json',
+                       '-show_streams', '-show_format', filename],
+                      timeout = 300, tail = None, use_stderr = False)
+        try:
+            cmd.run()
+        except OSError:
+            raise RuntimeError('FFmpeg is not installed.')
+        try:
+            data = json.loads('\n'.join(cmd.output))
+        except ValueError:
+            raise RuntimeError('Could not probe %s.' % filename)
+        self.format = data.get('format', {})
+        self.streams = data.get('streams', [])
+        self.video = [st for st in self.streams
+                      if st.get('codec_type') == 'video']
+        self.audio = [st for st in self.streams
+                      if st.get('codec_type') == 'audio']
+    
+    def duration(self):
+        'Returns the duration of the media in seconds, if known.'
+        duration = self.format.get('duration')
+        if duration is None or duration == 'N/A':
+            return None
+        return float(duration)
+    
+    def fps(self):
+        'Returns the frame rate of the first video stream, if known.'
+        if len(self.video) == 0:
+            return None
+        for key in ['r_frame_rate', 'avg_frame_rate']:
+            match = re.match('(\d+)/(\d+)', self.video[0].get(key, ''))
+            if match and int(match.group(2)) > 0 and int(match.group(1)) > 0:
+                return float(match.group(1)) / float(match.group(2))
+        return None
+    
+    def resolution(self):
+        'Returns the width and height of the first video stream, if known.'
+        if len(self.video) == 0 or not self.video[0].get('width'):
+            return None
+        return (int(self.video[0]['width']), int(self.video[0]['height']))
+    
+    def start_time(self):
+        'Returns the timestamp at which the media begins, in seconds.'
+        start = self.format.get('start_time')
+        if start is None or start == 'N/A':
+            return 0.0
+        return float(start)
+    
+    def tags(self):
+        '''Returns the metadata tags of the media file, including those of
+        each stream. Container tags take precedence over stream tags.'''
+        tags = {}
+        for stream in self.streams:
+            tags.update(stream.get('tags', {}))
+        tags.update(self.format.get('tags', {}))
+        return tags
+
+_media_info = {}
+
+def _keyframe_before(filename, time, preroll = 10):
+    '''Returns the time of the last video keyframe at or before time (both
+    in seconds from the beginning of the video), reading only the packets
+    from preroll seconds before it. Returns None if none can be found.'''
+    offset = _probe(filename).start_time()
+    found = []
+    def _parse(line):
+        fields = line.split(',')
+        if len(fields) < 2 or 'K' not in fields[1] or \
+                fields[0] in ['', 'N/A']:
+            return
+        pts = float(fields[0]) - offset
+        if pts <= time + 0.001:
+            found.append(pts)
+    interval = '%f%%%f' % (offset + max(time - preroll, 0), offset + time + 1)
+    args = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-read_intervals', interval, '-show_entries',
+            'packet=pts_time,flags', '-of', 'csv=p=0', filename]
+    try:
+        Command(args, timeout = 60, tail = 0, use_stderr = False,
+                callback = _parse).run()
+    except OSError:
+        return None
+    if len(found) == 0:
+        return None
+    return max(found)
+
+def _probe(filename):
+    '''Returns the MediaInfo for the given file, running ffprobe only once for
+    each version of the file.'''
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_size, st.st_mtime)
+    if key not in _media_info:
+        _media_info[key] = MediaInfo(filename)
+    return _media_info[key]
+
+_databases = {}
+
+def _connect(opts):
+    '''Connects to the MythTV MySQL database, reusing any connection which
+    was previously made with the same settings.'''
+    db_info = {'DBHostName' : opts.host, 'DBName' : opts.database,
+               'DBUserName' : opts.user, 'DBPassword' : opts.password,
+               'SecurityPin' : opts.pin}
+    key = tuple(sorted(db_info.items()))
+    if key not in _databases:
+        _databases[key] = MythTV.MythDB(**db_info)
+    return _databases[key]
+
 def _iso_639_2(lang):
     '''Translates from a two-letter ISO language code (ISO 639-1) to a
     three-letter ISO language code (ISO 639-2).'''
@@ -402,7 +1145,9 @@ def _find_conf_file():
 def _get_defaults():
     'Returns configuration defaults for this program.'
     opts = {'final_path' : '~/Videos', 'tmp' : None, 'format' : '%T/%T - %S',
+            'cache' : '~/.cache/transcode',
             'replace_char' : '', 'language' : 'en', 'country' : 'us',
+            'cc_languages' : None,
             'host' : '127.0.0.1', 'database' : 'mythconverg',
             'user' : 'mythtv', 'password' : 'mythtv', 'pin' : 0,
             'import_mythtv' : False, 'container' : 'mp4', 'video' : None,
@@ -414,6 +1159,13 @@ def _get_defaults():
             'audio_q' : 0.55, 'audio_br' : 192, 'downmix_to_stereo' : False,
             'use_db_rating' : True, 'use_db_descriptions' : False,
             'quiet' : False, 'verbose' : False, 'clip_thresh' : 5,
+            'cutter' : 'concat', 'fast_seek' : True, 'use_seek_table' : True,
+            'workers' : 1, 'isma_hint' : False, 'cache_ttl' : 72,
+            'cache_size' : 64, 'index_cache_size' : 256, 'offline' : False,
+            'art_size' : 0,
+            'metadata_timeout' : 600, 'request_rate' : 10.0,
+            'lookup_workers' : 8, 'tag_workers' : 2, 'direct_read' : True,
+            'storage_path' : None,
             'projectx' : 'project-x/ProjectX.jar',
             'remuxtool' : 'remuxTool.jar' }
     opts['.movie'] = {'format' : '%T'}
@@ -443,13 +1195,15 @@ def _add_option(opts, key, val):
     if match:
         dct = opts['.%s' % match.group(2)]
         key = match.group(1)
-    if key in ['tmp', 'video', 'audio', 'h264_rc', 'vp8_rc', 'preset',
-               'h264_speed', 'vp8_speed', 'resolution']:
+    if key in ['tmp', 'cache', 'video', 'audio', 'h264_rc', 'vp8_rc', 'preset',
+               'h264_speed', 'vp8_speed', 'resolution', 'cc_languages',
+               'storage_path']:
         if val == '' or not val or val.lower() == 'none':
             val = None
     if key in ['import_mythtv', 'ipod', 'webm', 'two_pass', 'auto_crop',
-               'deinterlace', 'downmix_to_stereo', 'use_db_rating',
-               'use_db_descriptions', 'quiet', 'verbose']:
+               'deinterlace', 'fast_seek', 'use_seek_table', 'isma_hint',
+               'downmix_to_stereo', 'use_db_rating', 'use_db_descriptions',
+               'offline', 'direct_read', 'quiet', 'verbose']:
         val = val.lower()
         if val in ['1', 't', 'y', 'true', 'yes', 'on']:
             val = True
@@ -459,9 +1213,12 @@ def _add_option(opts, key, val):
             raise ValueError('Invalid boolean value for %s: %s' %
                              (origkey, val))
     if key in ['pin', 'video_br', 'video_crf', 'threads',
-               'audio_br', 'audio_q', 'clip_thresh']:
+               'audio_br', 'audio_q', 'clip_thresh', 'workers',
+               'cache_ttl', 'cache_size', 'index_cache_size', 'art_size',
+               'metadata_timeout', 'request_rate', 'lookup_workers',
+               'tag_workers']:
         try:
-            if key == 'audio_q':
+            if key in ['audio_q', 'request_rate']:
                 val = float(val)
             else:
                 val = int(val)
@@ -500,7 +1257,9 @@ def _get_options(opts):
     'Uses optparse to obtain command-line options.'
     usage = 'usage: %prog [options] chanid time\n' + \
         '  %prog [options] wtv-file\n' + \
-        '  %prog [options] mp4-or-mkv-file'
+        '  %prog [options] mp4-or-mkv-file\n' + \
+        '  %prog [options] --batch job [job ...]\n' + \
+        '  %prog [options] --retag directory'
     version = '%prog 1.4'
     parser = optparse.OptionParser(usage = usage, version = version,
                                    formatter = optparse.TitledHelpFormatter())
@@ -518,6 +1277,13 @@ def _get_options(opts):
         flopts.add_option('-t', '--tmp', dest = 'tmp', metavar = 'PATH',
                           help = 'temporary directory to be used while ' +
                           'transcoding [default: %s]' % tempfile.gettempdir())
+    flopts.add_option('--cache', dest = 'cache', metavar = 'PATH',
+                      default = opts['cache'], help = 'directory to store ' +
+                      'cached data between runs [default: %default]')
+    flopts.add_option('--index-cache-size', dest = 'index_cache_size',
+                      metavar = 'MB', type = 'int',
+                      default = opts['index_cache_size'], help = 'maximum ' +
+                      'size of the cached frame indexes [default: %default]')
     flopts.add_option('--format', dest = 'format',
                       default = opts['format'], metavar = 'FMT',
                       help = 'format string for the encoded video filename ' +
@@ -529,6 +1295,10 @@ def _get_options(opts):
     flopts.add_option('-l', '--lang', dest = 'language',
                       default = opts['language'], metavar = 'LANG',
                       help = 'two-letter language code [default: %default]')
+    flopts.add_option('--cc-lang', dest = 'cc_languages',
+                      default = opts['cc_languages'], metavar = 'LANGS',
+                      help = 'comma-separated two-letter language codes of ' +
+                      'the CC1 and CC3 caption services [default: LANG]')
     flopts.add_option('--country', dest = 'country',
                       default = opts['country'], metavar = 'COUNTRY',
                       help = 'two-letter country code for TMDb ' +
@@ -558,6 +1328,18 @@ def _get_options(opts):
                       action = 'store_false', help = 'don\'t import ' +
                       'video into MythTV' +
                       _def_str(opts['import_mythtv'], False))
+    myopts.add_option('--direct-read', dest = 'direct_read',
+                      action = 'store_true', default = opts['direct_read'],
+                      help = 'read recordings in place if their storage ' +
+                      'group directory is reachable from this computer' +
+                      _def_str(opts['direct_read'], True))
+    myopts.add_option('--copy', dest = 'direct_read', action = 'store_false',
+                      help = 'always copy recordings to the temporary ' +
+                      'directory first' + _def_str(opts['direct_read'], False))
+    myopts.add_option('--storage-path', dest = 'storage_path',
+                      metavar = 'PATH', default = opts['storage_path'],
+                      help = 'local directory (such as a network share) ' +
+                      'which also contains MythTV recordings')
     parser.add_option_group(myopts)
     vfopts = optparse.OptionGroup(parser, 'Video format options')
     vfopts.add_option('--container', dest = 'container', metavar = 'FMT',
@@ -679,19 +1461,106 @@ def _get_options(opts):
                       'episode / movie descriptions from Tvdb / TMDb ' +
                       'when available' +
                       _def_str(opts['use_db_descriptions'], True))
+    mdopts.add_option('--cache-ttl', dest = 'cache_ttl', metavar = 'HOURS',
+                      type = 'int', default = opts['cache_ttl'],
+                      help = 'reuse cached Tvdb / TMDb responses for this ' +
+                      'many hours [default: %default]')
+    mdopts.add_option('--cache-size', dest = 'cache_size', metavar = 'MB',
+                      type = 'int', default = opts['cache_size'],
+                      help = 'maximum size of the cached Tvdb / TMDb ' +
+                      'responses and artwork together [default: %default]')
+    mdopts.add_option('--offline', dest = 'offline', action = 'store_true',
+                      default = opts['offline'], help = 'look up metadata ' +
+                      'only from cached Tvdb / TMDb responses' +
+                      _def_str(opts['offline'], True))
+    mdopts.add_option('--art-size', dest = 'art_size', metavar = 'PX',
+                      type = 'int', default = opts['art_size'],
+                      help = 'downscale artwork to at most PX pixels wide ' +
+                      'or high before embedding it (0 to keep the ' +
+                      'original) [default: %default]')
+    mdopts.add_option('--metadata-timeout', dest = 'metadata_timeout',
+                      metavar = 'SEC', type = 'int',
+                      default = opts['metadata_timeout'], help = 'stop ' +
+                      'waiting for Tvdb / TMDb metadata this many seconds ' +
+                      'after the job starts (0 to wait indefinitely) ' +
+                      '[default: %default]')
+    mdopts.add_option('--request-rate', dest = 'request_rate',
+                      metavar = 'N', type = 'float',
+                      default = opts['request_rate'], help = 'make at ' +
+                      'most N Tvdb / TMDb requests per second within each ' +
+                      'process (0 for no limit) [default: %default]')
     parser.add_option_group(mdopts)
+    bhopts = optparse.OptionGroup(parser, 'Batch options')
+    bhopts.add_option('-b', '--batch', dest = 'batch', action = 'store_true',
+                      default = False, help = 'treat each argument as a ' +
+                      'separate job: chanid_time, a job ID, or a file')
+    bhopts.add_option('--batch-file', dest = 'batch_file', metavar = 'FILE',
+                      help = 'read additional jobs from FILE, one per line ' +
+                      '(use - for standard input)')
+    bhopts.add_option('--recgroup', dest = 'recgroup', metavar = 'GROUP',
+                      help = 'transcode every recording within the MythTV ' +
+                      'recording group GROUP')
+    bhopts.add_option('-j', '--workers', dest = 'workers', metavar = 'N',
+                      type = 'int', default = opts['workers'],
+                      help = 'amount of jobs to transcode at once in ' +
+                      'batch mode [default: %default]')
+    bhopts.add_option('--retag', dest = 'retag', metavar = 'DIR',
+                      help = 'look up and embed metadata for every ' +
+                      'MPEG-4 / Matroska video within the directory DIR')
+    bhopts.add_option('--lookup-workers', dest = 'lookup_workers',
+                      metavar = 'N', type = 'int',
+                      default = opts['lookup_workers'], help = 'amount ' +
+                      'of videos to look up metadata for at once when ' +
+                      're-tagging [default: %default]')
+    bhopts.add_option('--tag-workers', dest = 'tag_workers', metavar = 'N',
+                      type = 'int', default = opts['tag_workers'],
+                      help = 'amount of videos to write tags to at once ' +
+                      'when re-tagging [default: %default]')
+    parser.add_option_group(bhopts)
     miopts = optparse.OptionGroup(parser, 'Miscellaneous options')
     miopts.add_option('-q', '--quiet', dest = 'quiet', action = 'store_true',
                       default = opts['quiet'], help = 'avoid printing to ' +
                       'stdout' + _def_str(opts['quiet'], True))
     miopts.add_option('-v', '--verbose', dest = 'verbose',
                       action = 'store_true', default = opts['verbose'],
-                      help = 'print command output to stdout' +
-                      _def_str(opts['verbose'], True))
+                      help = 'print debugging information, such as each ' +
+                      'command run along with its exit code and running ' +
+                      'time' + _def_str(opts['verbose'], True))
     miopts.add_option('--thresh', dest = 'clip_thresh', metavar = 'TH',
                       type = 'int', default = opts['clip_thresh'],
                       help = 'ignore clip segments TH seconds from the ' +
                       'beginning or end [default: %default]')
+    miopts.add_option('--cutter', dest = 'cutter', metavar = 'METHOD',
+                      choices = ['concat', 'split', 'projectx'],
+                      default = opts['cutter'], help = 'cut commercials in ' +
+                      'a single pass (concat), in separate segments ' +
+                      '(split), or while demuxing with Project-X ' +
+                      '(projectx) [default: %default]')
+    miopts.add_option('--seek-table', dest = 'use_seek_table',
+                      action = 'store_true', default = opts['use_seek_table'],
+                      help = 'use the MythTV seek table to locate cut ' +
+                      'points' + _def_str(opts['use_seek_table'], True))
+    miopts.add_option('--no-seek-table', dest = 'use_seek_table',
+                      action = 'store_false', help = 'index each frame ' +
+                      'with ffprobe to locate cut points' +
+                      _def_str(opts['use_seek_table'], False))
+    miopts.add_option('--fast-seek', dest = 'fast_seek', action = 'store_true',
+                      default = opts['fast_seek'], help = 'seek to the ' +
+                      'keyframe before each cut point without reading the ' +
+                      'video leading up to it' +
+                      _def_str(opts['fast_seek'], True))
+    miopts.add_option('--no-fast-seek', dest = 'fast_seek',
+                      action = 'store_false', help = 'read the video from ' +
+                      'the beginning when seeking to each cut point' +
+                      _def_str(opts['fast_seek'], False))
+    miopts.add_option('--hint', dest = 'isma_hint', action = 'store_true',
+                      default = opts['isma_hint'], help = 'add ISMA ' +
+                      'hint tracks to MPEG-4 files for RTP streaming' +
+                      _def_str(opts['isma_hint'], True))
+    miopts.add_option('--no-hint', dest = 'isma_hint',
+                      action = 'store_false', help = 'do not add hint ' +
+                      'tracks to MPEG-4 files' +
+                      _def_str(opts['isma_hint'], False))
     miopts.add_option('--project-x', dest = 'projectx', metavar = 'PATH',
                       default = opts['projectx'], help = 'path to the ' +
                       'Project-X JAR file                            ' +
@@ -720,54 +1589,109 @@ def _collapse_args(defaults, opts):
             for key, val in defaults['.%s' % group].iteritems():
                 setattr(opts, key, val)
 
-def _check_args(args, parser, opts):
-    '''Checks to ensure the positional arguments are valid, and adjusts
-    conflicting options if necessary.'''
+def _batch_mode(opts):
+    'Returns True if more than one job is to be transcoded.'
+    return opts.batch or opts.batch_file is not None or \
+        opts.recgroup is not None
+
+def _check_job(args):
+    '''Checks that the positional arguments of a job name a MythTV
+    recording (channel ID and timestamp), a MythTV job ID or a WTV / MPEG-4 /
+    Matroska file. Returns a description of the problem, or None if they
+    are valid.'''
     if len(args) == 2:
+        if not args[0].isdigit():
+            return 'invalid channel ID'
         try:
-            ts = _convert_time(args[1])
+            _convert_time(args[1])
         except ValueError:
-            print 'Error: invalid timestamp.'
-            exit(1)
+            return 'invalid timestamp'
     elif len(args) == 1 and not args[0].isdigit():
-        args[0] = os.path.expanduser(args[0])
         if not os.path.exists(args[0]):
-            print 'Error: file not found.'
+            return 'file not found'
+        if not re.search('\.([Ww][Tt][Vv]|[Mm][Pp]4|[Mm]4[Vv]|[Mm][Kk][Vv])',
+                         args[0]):
+            return 'file is not a WTV recording or a valid video file'
+    elif len(args) != 1:
+        return 'invalid job'
+    return None
+
+def _check_args(args, parser, opts):
+    '''Checks to ensure the positional arguments are valid, and adjusts
+    conflicting options if necessary.'''
+    if opts.retag is not None:
+        opts.retag = os.path.expanduser(opts.retag)
+        if not os.path.isdir(opts.retag):
+            print 'Error: directory not found.'
+            exit(1)
+        if opts.lookup_workers < 1 or opts.tag_workers < 1:
+            print 'Error: at least one worker is required.'
             exit(1)
-        wtv = re.search('\.[Ww][Tt][Vv]', args[0])
-        mp4 = re.search('\.[Mm][Pp]4', args[0])
-        m4v = re.search('\.[Mm]4[Vv]', args[0])
-        mkv = re.search('\.[Mm][Kk][Vv]', args[0])
-        if not (wtv or mp4 or m4v or mkv):
-            print 'Error: file is not a WTV recording or a valid video file.'
+    elif _batch_mode(opts):
+        if opts.workers < 1:
+            print 'Error: at least one worker is required.'
+            exit(1)
+    elif len(args) in [1, 2]:
+        if len(args) == 1 and not args[0].isdigit():
+            args[0] = os.path.expanduser(args[0])
+        err = _check_job(args)
+        if err is not None:
+            print 'Error: %s.' % err
             exit(1)
     else:
         parser.print_help()
         exit(1)
     if opts.final_path in [None, '', '.', './', '.\\']:
         opts.final_path = os.path.dirname(os.path.realpath(__file__))
-    for key in ['final_path', 'tmp', 'projectx', 'remuxtool']:
+    for key in ['final_path', 'tmp', 'cache', 'projectx', 'remuxtool',
+                'storage_path']:
         if getattr(opts, key) is not None:
             setattr(opts, key, os.path.expanduser(getattr(opts, key)))
     if opts.ipod and opts.webm:
         print 'Error: WebM and iPod options conflict.'
         exit(1)
+    if opts.cc_languages:
+        for lang in opts.cc_languages.split(','):
+            try:
+                if lang.strip() != '':
+                    _iso_639_2(lang.strip())
+            except ValueError:
+                print 'Error: invalid caption language %s.' % lang.strip()
+                exit(1)
     loglvl = logging.INFO
     if opts.verbose:
         loglvl = logging.DEBUG
     if opts.quiet:
         loglvl = logging.CRITICAL
-    logging.basicConfig(format = '%(message)s', level = loglvl)
+    fmt = '%(message)s'
+    if _batch_mode(opts) and opts.workers > 1:
+        fmt = '[%(processName)s] %(message)s'
+    if opts.retag is not None:
+        fmt = '[%(threadName)s] %(message)s'
+    logging.basicConfig(format = fmt, level = loglvl)
 
 class Subtitles:
     '''Extracts closed captions from source media using ccextractor and
-    writes them as SRT timed-text subtitles.'''
+    writes them as SRT timed-text subtitles. Both caption fields (CC1 and
+    CC3) are extracted in a single pass, each as its own subtitle track.'''
     subs = 1
-    marks = []
     
     def __init__(self, source):
         self.source = source
-        self.srt = source.base + '.srt'
+        langs = [source.opts.language]
+        if source.opts.cc_languages:
+            langs = [lang.strip() for lang
+                     in source.opts.cc_languages.split(',')]
+        self._srts = []
+        for field in [1, 2]:
+            lang = 'und'
+            if field <= len(langs) and langs[field - 1] != '':
+                lang = _iso_639_2(langs[field - 1])
+            srt = '%s-cc%d.srt' % (source.base, field * 2 - 1)
+            self._srts.append((srt, lang))
+        self.tracks = []
+        self._thread = None
+        self._errors = []
         self.enabled = self.check()
         if not self.enabled:
             logging.warning('*** ccextractor not found, ' +
@@ -779,81 +1703,111 @@ class Subtitles:
         ver = _ver(['ccextractor'], '(CCExtractor [0-9]+\.[0-9]+),')
         return ver is not None and not self.source.opts.webm
     
-    def mark(self, sec):
-        'Marks a cutpoint in the video at a given point.'
-        self.marks += [sec]
-    
     def extract(self, video):
         '''Obtains the closed-caption data embedded as VBI data within the
-        filtered video clip and writes them to a SRT file.'''
+        source video and writes each caption field to its own SRT file,
+        reading the video only once.'''
         if not self.enabled:
             return
         logging.info('*** Extracting subtitles ***')
-        _cmd(['ccextractor', '-o', self.srt, '-utf8', '-ve',
-              '--no_progress_bar', video], expected = 232)
-    
-    def adjust(self):
-        '''Joining video can cause the closed-caption VBI data to become
-        out-of-sync with the video, because some closed captions last longer
-        than the individual clips and ccextractor doesn't know when to clip
-        these captions. To compensate for this, any captions which
-        extend longer than the cutpoint are clipped, and the difference is
-        subtracted from the rest of the captions.'''
+        _cmd(['ccextractor', '-12', '-o1', self._srts[0][0],
+              '-o2', self._srts[1][0], '-utf8', '-ve', '--no_progress_bar',
+              video], expected = 232)
+    
+    def _extract_bg(self, video):
+        'Extracts subtitles, recording any error for finish() to raise.'
+        try:
+            self.extract(video)
+        except Exception as e:
+            self._errors.append(e)
+    
+    def start(self, video):
+        '''Begins extracting subtitles from the source video in the
+        background, so that the video may be cut at the same time.'''
         if not self.enabled:
             return
-        if len(self.marks) == 0:
+        self.clean_tmp()
+        self._errors = []
+        self._thread = threading.Thread(target = self._extract_bg,
+                                        args = (video,))
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def finish(self, clips):
+        '''Waits for subtitle extraction to complete, and then keeps only the
+        captions within the given video clips.'''
+        if self._thread is None:
             return
-        delay = 0.0
-        curr = 0
-        newsubs = ''
-        ts = '(\d\d):(\d\d):(\d\d),(\d+)'
-        regex = re.compile(ts + '\s*-+>\s*' + ts)
-        with open(self.srt, 'r') as subs:
-            for line in subs:
-                match = re.search(regex, line)
-                if match:
-                    start, end = _convert_timestamp(match)
-                    start += delay
-                    end += delay
-                    if curr < len(self.marks) and self.marks[curr] < end:
-                        if self.marks[curr] > start:
-                            delay += self.marks[curr] - end
-                            end = self.marks[curr]
-                        curr += 1
-                    start = _seconds_to_time_frac(start, True)
-                    end = _seconds_to_time_frac(end, True)
-                    newsubs += '%s --> %s\n' % (start, end)
-                else:
-                    newsubs += line
-        _clean(self.srt)
-        with open(self.srt, 'w') as subs:
-            subs.write(newsubs)
+        while self._thread.is_alive():
+            self._thread.join(1)
+        self._thread = None
+        if len(self._errors) > 0:
+            raise self._errors[0]
+        self.cut(clips)
+    
+    def _cut(self, cues, clips):
+        '''Yields each caption from the SRT file which falls within one of the
+        clips, trimmed to fit the clip and shifted to the joined timeline.'''
+        (starts, offsets, elapsed) = ([], [], 0)
+        for clip in clips:
+            starts.append(clip[0])
+            offsets.append((clip[0], clip[1], elapsed - clip[0]))
+            elapsed += clip[1] - clip[0]
+        for start, end, text in cues:
+            pos = max(bisect.bisect_right(starts, start) - 1, 0)
+            for (clip_start, clip_end, shift) in offsets[pos:]:
+                if clip_start >= end:
+                    break
+                if start < clip_end:
+                    yield (max(start, clip_start) + shift,
+                           min(end, clip_end) + shift, text)
+                    break
+    
+    def cut(self, clips):
+        '''Removes any captions extracted from the original video which fall
+        outside of the given video clips, and shifts the rest so that they line
+        up with the video once the clips have been joined. Captions which
+        overlap the edge of a clip are trimmed to fit within it.'''
+        self.tracks = []
+        if not self.enabled:
+            return
+        for srt, lang in self._srts:
+            if not os.path.exists(srt) or os.path.getsize(srt) == 0:
+                continue
+            if _srt_rewrite(srt, lambda cues: self._cut(cues, clips)) > 0:
+                logging.debug('Found subtitles (%s) in %s' % (lang, srt))
+                self.tracks.append((srt, lang))
     
     def clean_tmp(self):
         'Removes temporary SRT files.'
-        _clean(self.srt)
+        for srt, lang in self._srts:
+            _clean(srt)
 
 class MP4Subtitles(Subtitles):
     'Embeds SRT subtitles into the final MPEG-4 video file.'
     
     def write(self):
-        'Invokes MP4Box to embed the SRT subtitles into a MP4 file.'
-        if not self.enabled:
-            return
-        arg = '%s:name=Subtitles:layout=0x125x0x-1' % self.srt
-        _cmd(['MP4Box', '-tmp', self.source.opts.final_path, '-add',
-              arg, self.source.final_file])
+        '''Returns command-line arguments for MP4Box to embed each of the SRT
+        subtitle tracks into a MP4 file, tagged with its language.'''
+        args = []
+        if self.enabled:
+            for srt, lang in self.tracks:
+                args += ['-add', '%s:name=Subtitles:lang=%s:' % (srt, lang) +
+                         'layout=0x125x0x-1']
+        return args
 
 class MKVSubtitles(Subtitles):
     'Embeds SRT subtitles into the final MPEG-4 video file.'
     
     def write(self):
-        '''Returns command-line arguments for mkvmerge to embed the SRT
-        subtitles into a MKV file.'''
+        '''Returns command-line arguments for mkvmerge to embed each of the
+        SRT subtitle tracks into a MKV file, tagged with its language.'''
+        args = []
         if self.enabled:
-            return ['--track-name', '0:Subtitles', self.srt]
-        else:
-            return []
+            for srt, lang in self.tracks:
+                args += ['--language', '0:%s' % lang,
+                         '--track-name', '0:Subtitles', srt]
+        return args
 
 class MP4Chapters:
     'Creates iOS-style chapter markers between designated cutpoints.'
@@ -888,10 +1842,10 @@ class MP4Chapters:
         self._doc.documentElement.appendChild(sample)
     
     def write(self):
-        '''Outputs the chapter data to XML format and invokes MP4Box to embed
-        the chapter XML file into a MP4 file.'''
+        '''Outputs the chapter data to XML format and returns command-line
+        arguments for MP4Box to embed the chapter XML file into a MP4 file.'''
         if not self.enabled:
-            return
+            return []
         _clean(self._chap)
         data = self._doc.toprettyxml(encoding = 'UTF-8', indent = '  ')
         data = _filter_xml(data)
@@ -899,13 +1853,7 @@ class MP4Chapters:
         logging.debug(data)
         with open(self._chap, 'w') as dest:
             dest.write(data)
-        args = ['MP4Box', '-tmp', self.source.opts.final_path,
-                '-add', '%s:chap' % self._chap, self.source.final_file]
-        try:
-            _cmd(args)
-        except RuntimeError:
-            logging.warning('*** Old version of MP4Box, ' +
-                            'chapter support unavailable ***')
+        return ['-add', '%s:chap' % self._chap]
     
     def clean_tmp(self):
         'Removes the temporary chapter XML file.'
@@ -949,37 +1897,244 @@ class MKVChapters:
         'Removes the temporary chapter file.'
         _clean(self._chap)
 
+def _mp4_box(kind, payload):
+    'Serializes an MPEG-4 box of the given four-character type.'
+    return struct.pack('>I4s', len(payload) + 8, kind) + payload
+
+def _mp4_free(size):
+    'Returns a free box (padding) occupying exactly size bytes.'
+    return _mp4_box('free', '\0' * (size - 8))
+
+def _mp4_boxes(data, pos = 0, end = None):
+    '''Parses the MPEG-4 boxes contained within data, yielding the type of
+    each box along with the offsets of its start, its payload and its end.'''
+    if end is None:
+        end = len(data)
+    while pos + 8 <= end:
+        (size, kind) = struct.unpack('>I4s', data[pos:pos + 8])
+        head = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+            head = 16
+        elif size == 0:
+            size = end - pos
+        if size < head or pos + size > end:
+            raise ValueError('Invalid MPEG-4 box: %r' % kind)
+        yield kind, pos, pos + head, pos + size
+        pos += size
+
+def _mp4_top_boxes(mp4):
+    '''Reads the headers of each top-level box in an open MPEG-4 file,
+    returning the type, start and end offsets of each.'''
+    mp4.seek(0, os.SEEK_END)
+    length = mp4.tell()
+    (boxes, pos) = ([], 0)
+    while pos + 8 <= length:
+        mp4.seek(pos)
+        head = mp4.read(16)
+        (size, kind) = struct.unpack('>I4s', head[:8])
+        if size == 1:
+            size = struct.unpack('>Q', head[8:16])[0]
+        elif size == 0:
+            size = length - pos
+        if size < 8 or pos + size > length:
+            raise ValueError('Invalid MPEG-4 box: %r' % kind)
+        boxes.append((kind, pos, pos + size))
+        pos += size
+    return boxes
+
+def _mp4_item_key(item):
+    '''Returns the key identifying an iTunes metadata item: its type, or for
+    freeform items, its mean and name.'''
+    (size, kind) = struct.unpack('>I4s', item[:8])
+    if kind != '----':
+        return kind
+    key = [kind]
+    for child, start, body, end in _mp4_boxes(item, 8):
+        if child in ['mean', 'name']:
+            key.append(item[body + 4:end])
+    return tuple(key)
+
+def _mp4_meta(meta, items):
+    '''Rebuilds the payload of a meta box, replacing items within its ilst
+    box and discarding any padding inside it.'''
+    head = meta[:4]
+    pos = 4
+    if meta[4:8] == 'hdlr':
+        (head, pos) = ('', 0)
+    (children, ilst) = ([], None)
+    for kind, start, body, end in _mp4_boxes(meta, pos):
+        if kind == 'ilst':
+            ilst = []
+            for item in _mp4_boxes(meta, body, end):
+                ilst.append(meta[item[1]:item[3]])
+            children.append(None)
+        elif kind not in ['free', 'skip']:
+            children.append(meta[start:end])
+    if ilst is None:
+        (ilst, children) = ([], children + [None])
+    (merged, keys) = ([], {})
+    for item in ilst:
+        key = _mp4_item_key(item)
+        keys[key] = len(merged)
+        merged.append(item)
+    for key, item in items:
+        if key in keys:
+            merged[keys[key]] = item
+        else:
+            keys[key] = len(merged)
+            merged.append(item)
+    ilst = _mp4_box('ilst', ''.join([item for item in merged
+                                     if item is not None]))
+    return head + ''.join([ilst if child is None else child
+                           for child in children])
+
+def _mp4_moov(moov, items):
+    '''Rebuilds a moov box (given its payload) with the provided iTunes
+    metadata items in moov/udta/meta/ilst, creating any boxes necessary.'''
+    hdlr = _mp4_box('hdlr', '\0' * 8 + 'mdirappl' + '\0' * 9)
+    empty_meta = '\0' * 4 + hdlr
+    (children, udta) = ([], False)
+    for kind, start, body, end in _mp4_boxes(moov):
+        if kind == 'udta':
+            (inner, meta) = ([], False)
+            for child, cstart, cbody, cend in _mp4_boxes(moov, body, end):
+                if child == 'meta':
+                    meta = True
+                    inner.append(_mp4_box('meta', _mp4_meta(moov[cbody:cend],
+                                                            items)))
+                else:
+                    inner.append(moov[cstart:cend])
+            if not meta:
+                inner.append(_mp4_box('meta', _mp4_meta(empty_meta, items)))
+            children.append(_mp4_box('udta', ''.join(inner)))
+            udta = True
+        else:
+            children.append(moov[start:end])
+    if not udta:
+        meta = _mp4_box('meta', _mp4_meta(empty_meta, items))
+        children.append(_mp4_box('udta', meta))
+    return _mp4_box('moov', ''.join(children))
+
+def _mp4_write_items(filename, items, padding = 4096):
+    '''Embeds iTunes metadata items into an MPEG-4 file without copying its
+    media data. The moov box is rewritten in place if it fits within its
+    original space (including any padding following it), or if it is at the
+    end of the file. Otherwise, it is moved to the end of the file and its
+    old location becomes padding. Any items set to None are removed.'''
+    with open(filename, 'r+b') as mp4:
+        boxes = _mp4_top_boxes(mp4)
+        pos = [n for n in xrange(len(boxes)) if boxes[n][0] == 'moov']
+        if len(pos) == 0:
+            raise RuntimeError('No moov box found in %s.' % filename)
+        (kind, start, end) = boxes[pos[0]]
+        mp4.seek(start)
+        head = mp4.read(16)
+        skip = 8
+        if struct.unpack('>I', head[:4])[0] == 1:
+            skip = 16
+        mp4.seek(start + skip)
+        moov = _mp4_moov(mp4.read(end - start - skip), items)
+        space = end
+        last = pos[0] + 1
+        while last < len(boxes) and boxes[last][0] in ['free', 'skip']:
+            space = boxes[last][2]
+            last += 1
+        space -= start
+        if len(moov) == space or len(moov) + 8 <= space:
+            logging.debug('Writing metadata in place')
+            mp4.seek(start)
+            mp4.write(moov)
+            if len(moov) < space:
+                mp4.write(_mp4_free(space - len(moov)))
+        elif last == len(boxes):
+            logging.debug('Rewriting metadata at the end of the file')
+            mp4.seek(start)
+            mp4.write(moov + _mp4_free(padding))
+            mp4.truncate()
+        else:
+            logging.debug('Moving metadata to the end of the file')
+            mp4.seek(0, os.SEEK_END)
+            mp4.write(moov + _mp4_free(padding))
+            mp4.flush()
+            os.fsync(mp4.fileno())
+            mp4.seek(start + 4)
+            mp4.write('free')
+
+def _mp4_child(data, body, end, name):
+    '''Returns the payload and end offsets of the first child box of the
+    given type, or None if there is none.'''
+    for kind, start, cbody, cend in _mp4_boxes(data, body, end):
+        if kind == name:
+            return cbody, cend
+    return None
+
+def _mp4_read_items(filename):
+    '''Reads the iTunes metadata items within an MPEG-4 file, returning a
+    dictionary of the key of each item to the serialized item.'''
+    with open(filename, 'rb') as mp4:
+        moov = [box for box in _mp4_top_boxes(mp4) if box[0] == 'moov']
+        if len(moov) == 0:
+            return {}
+        (kind, start, end) = moov[0]
+        mp4.seek(start)
+        data = mp4.read(end - start)
+    box = _mp4_child(data, 0, len(data), 'moov')
+    for name in ['udta', 'meta', 'ilst']:
+        if box is None:
+            return {}
+        (body, end) = box
+        if name == 'ilst' and data[body + 4:body + 8] != 'hdlr':
+            body += 4
+        box = _mp4_child(data, body, end, name)
+    if box is None:
+        return {}
+    items = {}
+    for kind, start, body, end in _mp4_boxes(data, box[0], box[1]):
+        item = data[start:end]
+        items[_mp4_item_key(item)] = item
+    return items
+
+def _mp4_text(val):
+    'Encodes a metadata value as UTF-8 text.'
+    if type(val) is unicode:
+        return val.encode('utf_8')
+    return str(val)
+
+def _mp4_item(kind, val, flags = 1):
+    '''Returns an iTunes metadata item of the given type containing a single
+    data box. Flags are 1 for UTF-8 text, 21 for integers, 13 for JPEG or 14
+    for PNG images, or 0 for other binary data.'''
+    if flags == 1:
+        val = _mp4_text(val)
+    data = _mp4_box('data', struct.pack('>II', flags, 0) + val)
+    return kind, _mp4_box(kind, data)
+
+def _mp4_freeform(name, val, mean = 'com.apple.iTunes'):
+    'Returns a freeform (reverse DNS) iTunes metadata item.'
+    payload = _mp4_box('mean', '\0' * 4 + mean)
+    payload += _mp4_box('name', '\0' * 4 + name)
+    payload += _mp4_box('data', struct.pack('>II', 1, 0) + _mp4_text(val))
+    return ('----', mean, name), _mp4_box('----', payload)
+
 class MP4Metadata:
     '''Translates previously fetched metadata (series name, episode name,
-    episode number, credits...) into command-line arguments for AtomicParsley
-    in order to embed it as iOS-compatible MP4 tags.'''
-    _rating_ok = False
-    _credits_ok = False
+    episode number, credits...) into iTunes metadata items and embeds them
+    directly into the MP4 file as iOS-compatible MP4 tags.'''
+    _ratings = {'TV-Y' : ('us-tv', 100), 'TV-Y7' : ('us-tv', 200),
+                'TV-G' : ('us-tv', 300), 'TV-PG' : ('us-tv', 400),
+                'TV-14' : ('us-tv', 500), 'TV-MA' : ('us-tv', 600),
+                'G' : ('mpaa', 100), 'PG' : ('mpaa', 200),
+                'PG-13' : ('mpaa', 300), 'R' : ('mpaa', 400),
+                'NC-17' : ('mpaa', 500), 'Unrated' : ('mpaa', 600)}
     
     def __init__(self, source):
         self.source = source
         self.enabled = self.check()
-        if not self.enabled:
-            logging.warning('*** AtomicParsley not found, ' +
-                            'metadata disabled ***')
-        elif not self._rating_ok or not self._credits_ok:
-            logging.warning('*** Old version of AtomicParsley, ' +
-                            'some functions unavailable ***')
     
     def check(self):
-        '''Determines whether AtomicParsley is present, and if so, checks
-        whether code to handle 'reverse DNS' style atoms (needed for content
-        ratings and embedded XML credits) is present.'''
-        ver = _ver(['AtomicParsley', '--help'], '(AtomicParsley)')
-        if ver:
-            rdns = ['AtomicParsley', '--reverseDNS-help']
-            if _ver(rdns, '.*(--contentRating)'):
-                self._rating_ok = True
-            if _ver(rdns, '.*(--rDNSatom)'):
-                self._credits_ok = True
-            return not self.source.opts.webm
-        else:
-            return False
+        'Determines whether metadata should be embedded.'
+        return not self.source.opts.webm
     
     def _get_director(self):
         '''Browses through the credits tuple and returns the first credited
@@ -1057,110 +2212,474 @@ class MP4Metadata:
         self._make_section(writers, 'screenwriters', top, doc)
         return doc
     
-    def _perform(self, args):
-        '''Invokes AtomicParsley with the provided command-line arguments. If
-        the program is successful and outputs a new MP4 file with the newly
-        embedded metadata, copies the new file over the old.'''
-        self.clean_tmp()
-        args = ['AtomicParsley', self.source.final_file] + args
-        _cmd(args)
-        for old in glob.glob(self.source.final + '-temp-*.' +
-                             self.source.ext):
-            shutil.move(old, self.source.final_file)
+    def _number(self, kind, val, fmt = '>I'):
+        '''Returns an iTunes metadata item holding one or more integers, or
+        None if any of them are invalid.'''
+        if type(val) is not tuple:
+            val = (val,)
+        try:
+            val = struct.pack(fmt, *[int(num) for num in val])
+        except (ValueError, TypeError, struct.error):
+            logging.debug('Invalid value for %r: %r' % (kind, val))
+            return None
+        flags = 0
+        if fmt == '>I':
+            flags = 21
+        return _mp4_item(kind, val, flags)
+    
+    def _rating(self, rating):
+        '''Returns the iTunes content rating item for the given rating, or
+        None if it is not a recognized TV or MPAA rating.'''
+        rating = rating.strip()
+        if rating not in self._ratings:
+            logging.debug('Unknown content rating %s' % rating)
+            return None
+        (system, level) = self._ratings[rating]
+        return _mp4_freeform('iTunEXTC', '%s|%s|%d|' %
+                             (system, rating, level))
     
     def _simple_tags(self, version):
-        'Adds single-argument or standalone tags into the MP4 file.'
+        'Returns single-value tags to be embedded into the MP4 file.'
         s = self.source
         if s.get('movie') is True:
-            args = ['--stik', 'Short Film', '--encodingTool', version]
+            items = [_mp4_item('stik', '\x09', 21)]
         else:
-            args = ['--stik', 'TV Show', '--encodingTool', version]
+            items = [_mp4_item('stik', '\x0a', 21)]
+        items.append(_mp4_item('\xa9too', version))
         if type(s) == WTVSource:
-            args += ['--grouping', 'Windows Media Center Recording']
+            items.append(_mp4_item('\xa9grp',
+                                   'Windows Media Center Recording'))
         elif type(s) == MythSource:
-            args += ['--grouping', 'MythTV Recording']
+            items.append(_mp4_item('\xa9grp', 'MythTV Recording'))
         if s.get('time') is not None:
             utc = s.time.strftime('%Y-%m-%dT%H:%M:%SZ')
-            args += ['--purchaseDate', utc]
+            items.append(_mp4_item('purd', utc))
         if s.get('title') is not None:
             t = s['title']
             if s.get('movie') is not True:
-                args += ['--artist', t, '--album', t, '--albumArtist', t,
-                         '--TVShowName', t]
+                for kind in ['\xa9ART', '\xa9alb', 'aART', 'tvsh']:
+                    items.append(_mp4_item(kind, t))
             else:
-                args += ['--title', t]
+                items.append(_mp4_item('\xa9nam', t))
                 director = self._get_director()
                 if director is not None:
-                    args += ['--artist', director]
+                    items.append(_mp4_item('\xa9ART', director))
         if s.get('subtitle') is not None:
-            args += ['--title', s['subtitle']]
+            items.append(_mp4_item('\xa9nam', s['subtitle']))
         if s.get('category') is not None:
-            args += ['--genre', s['category']]
+            items.append(_mp4_item('\xa9gen', s['category']))
         if s.get('originalairdate') is not None:
-            args += ['--year', str(s['originalairdate'])]
+            items.append(_mp4_item('\xa9day', str(s['originalairdate'])))
         if s.get('channel') is not None:
-            args += ['--TVNetwork', s['channel']]
+            items.append(_mp4_item('tvnn', s['channel']))
         if s.get('syndicatedepisodenumber') is not None:
-            args += ['--TVEpisode', s['syndicatedepisodenumber']]
+            items.append(_mp4_item('tven', s['syndicatedepisodenumber']))
         if s.get('episode') is not None and \
                 s.get('episodecount') is not None:
-            track = '%s/%s' % (s['episode'], s['episodecount'])
-            args += ['--tracknum', track, '--TVEpisodeNum', s['episode']]
+            items.append(self._number('trkn', (0, s['episode'],
+                                               s['episodecount'], 0),
+                                      '>HHHH'))
+            items.append(self._number('tves', s['episode']))
         if s.get('season') is not None and \
                 s.get('seasoncount') is not None:
-            disk = '%s/%s' % (s['season'], s['seasoncount'])
-            args += ['--disk', disk, '--TVSeasonNum', s['season']]
-        if s.get('rating') is not None and self._rating_ok:
-            args += ['--contentRating', s['rating']]
+            items.append(self._number('disk', (0, s['season'],
+                                               s['seasoncount']), '>HHH'))
+            items.append(self._number('tvsn', s['season']))
+        if s.get('rating') is not None:
+            items.append(self._rating(s['rating']))
         if s.get('tagline') is not None:
-            args += ['--comment', s['tagline']]
-        self._perform(args)
+            items.append(_mp4_item('\xa9cmt', s['tagline']))
+        return [item for item in items if item is not None]
     
     def _longer_tags(self):
-        '''Adds lengthier tags (such as episode description or series artwork)
-        into the MP4 file separately, to avoid problems.'''
+        'Returns lengthier tags, such as episode description or artwork.'
         s = self.source
-        args = []
+        items = []
         if s.get('description') is not None:
-            args += ['--description', s['description'][:255]]
+            items.append(_mp4_item('desc', s['description'][:255]))
             if len(s.get('description')) > 255:
-                args += ['--longdesc', s['description']]
-        self._perform(args)
+                items.append(_mp4_item('ldes', s['description']))
         if s.get('albumart') is not None:
             try:
-                self._perform(['--artwork', s['albumart']])
-            except RuntimeError:
+                with open(s['albumart'], 'rb') as art:
+                    data = art.read()
+                flags = 13
+                if data.startswith('\x89PNG'):
+                    flags = 14
+                items.append(_mp4_item('covr', data, flags))
+            except IOError:
                 logging.warning('*** Could not embed artwork ***')
+        return items
     
     def _credits(self):
-        'Adds the credits XML data directly as a command-line argument.'
+        'Returns the credits XML data as a freeform iTunMOVI tag.'
         c = self.source.get('credits')
-        if c is not None and c != [] and self._credits_ok:
+        if c is not None and c != []:
             doc = self._make_credits()
-            args = ['--rDNSatom', doc.toxml(encoding = 'UTF-8'),
-                    'name=iTunMOVI', 'domain=com.apple.iTunes']
-            self._perform(args)
+            return [_mp4_freeform('iTunMOVI', doc.toxml(encoding = 'UTF-8'))]
+        return []
+    
+    def _items(self, version):
+        'Returns every metadata item to be embedded into the MP4 file.'
+        items = self._simple_tags(version) + self._longer_tags()
+        return items + self._credits()
+    
+    def unchanged(self, version):
+        '''Determines whether the MP4 file already contains each of the
+        metadata items which would be written.'''
+        try:
+            current = _mp4_read_items(self.source.final_file)
+        except (IOError, ValueError, struct.error):
+            return False
+        for key, item in self._items(version):
+            if current.get(key) != item:
+                return False
+        return True
     
     def write(self, version):
-        '''Performs each of the above steps involved in embedding metadata,
-        using version as the encodingTool tag.'''
+        '''Embeds all of the above metadata into the MP4 file in a single
+        pass, using version as the encodingTool tag.'''
         if self.enabled:
             logging.info('*** Adding metadata to %s ***'
                          % self.source.final_file)
-            self._simple_tags(version)
-            self._longer_tags()
-            self._credits()
+            items = self._items(version)
+            try:
+                _mp4_write_items(self.source.final_file, items)
+            except (ValueError, struct.error):
+                raise RuntimeError('Could not parse MPEG-4 file %s.' %
+                                   self.source.final_file)
     
     def clean_tmp(self):
-        'Removes any leftover MP4 files created by AtomicParsley.'
-        files = u'%s-temp-*.%s' % (self.source.final, self.source.ext)
-        for old in glob.glob(files):
-            _clean(old)
+        'Metadata is written in place, so there are no temporary files.'
+        pass
+
+_EBML_SEGMENT = 0x18538067
+_EBML_SEEKHEAD = 0x114D9B74
+_EBML_SEEK = 0x4DBB
+_EBML_SEEKID = 0x53AB
+_EBML_SEEKPOS = 0x53AC
+_EBML_VOID = 0xEC
+_EBML_TAGS = 0x1254C367
+_EBML_ATTACHMENTS = 0x1941A469
+_EBML_ATTACHED_FILE = 0x61A7
+_EBML_FILE_IDS = {'FileDescription' : 0x467E, 'FileName' : 0x466E,
+                  'FileMimeType' : 0x4660, 'FileData' : 0x465C,
+                  'FileUID' : 0x46AE}
+_EBML_TAG_IDS = {'Tags' : (_EBML_TAGS, None), 'Tag' : (0x7373, None),
+                 'Targets' : (0x63C0, None),
+                 'TargetTypeValue' : (0x68CA, 'uint'),
+                 'TargetType' : (0x63CA, 'str'), 'Simple' : (0x67C8, None),
+                 'Name' : (0x45A3, 'str'), 'String' : (0x4487, 'str')}
+
+def _ebml_vint(val, length = None):
+    '''Encodes an EBML element size as a variable-length integer, using the
+    shortest possible encoding unless a length (in bytes) is given.'''
+    if length is None:
+        length = 1
+        while val >= (1 << (7 * length)) - 1:
+            length += 1
+    if length > 8 or val >= (1 << (7 * length)) - 1:
+        raise ValueError('EBML size %d does not fit in %d bytes' %
+                         (val, length))
+    val |= 1 << (7 * length)
+    return ''.join([chr((val >> (8 * n)) & 0xff)
+                    for n in xrange(length - 1, -1, -1)])
+
+def _ebml_id(eid):
+    'Encodes an EBML element ID, which already includes its length marker.'
+    length = (eid.bit_length() + 7) // 8
+    return ''.join([chr((eid >> (8 * n)) & 0xff)
+                    for n in xrange(length - 1, -1, -1)])
+
+def _ebml_element(eid, payload):
+    'Serializes an EBML element with the given ID and payload.'
+    return _ebml_id(eid) + _ebml_vint(len(payload)) + payload
+
+def _ebml_uint(eid, val, length = None):
+    '''Serializes an EBML unsigned integer element, optionally using a fixed
+    number of bytes.'''
+    if length is None:
+        length = max((val.bit_length() + 7) // 8, 1)
+    return _ebml_element(eid, ''.join([chr((val >> (8 * n)) & 0xff)
+                                       for n in xrange(length - 1, -1, -1)]))
+
+def _ebml_void(length):
+    'Returns a Void element (padding) occupying exactly length bytes.'
+    if length < 2:
+        raise ValueError('Void elements must be at least 2 bytes long')
+    if length <= 9:
+        return chr(_EBML_VOID) + _ebml_vint(0, length - 1)
+    return chr(_EBML_VOID) + _ebml_vint(length - 9, 8) + \
+        '\0' * (length - 9)
+
+def _ebml_void_header(length):
+    '''Returns just the header of a Void element occupying length bytes, so
+    that existing data can be turned into padding without rewriting it.'''
+    if length <= 9:
+        return _ebml_void(length)
+    return chr(_EBML_VOID) + _ebml_vint(length - 9, 8)
+
+def _ebml_read_vint(data, pos, keep_marker = False):
+    '''Decodes an EBML variable-length integer from data at pos, returning
+    its value (None for an unknown size) and length.'''
+    first = ord(data[pos])
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError('Invalid EBML variable-length integer')
+    val = first
+    if not keep_marker:
+        val &= (0xff >> length)
+    for n in xrange(1, length):
+        val = (val << 8) | ord(data[pos + n])
+    if not keep_marker and val == (1 << (7 * length)) - 1:
+        val = None
+    return val, length
+
+def _ebml_header(data, pos = 0):
+    '''Decodes the header of the EBML element in data at pos, returning the
+    element ID, the size of its payload and the length of its header.'''
+    (eid, id_len) = _ebml_read_vint(data, pos, True)
+    (size, size_len) = _ebml_read_vint(data, pos + id_len)
+    return eid, size, id_len + size_len
+
+def _ebml_children(data, pos = 0, end = None):
+    '''Parses the EBML elements contained within data, yielding the ID of
+    each along with the offsets of its start, its payload and its end.'''
+    if end is None:
+        end = len(data)
+    while pos < end:
+        (eid, size, head) = _ebml_header(data, pos)
+        if size is None or pos + head + size > end:
+            raise ValueError('Invalid EBML element %x' % eid)
+        yield eid, pos, pos + head, pos + head + size
+        pos += head + size
+
+def _ebml_from_xml(node):
+    '''Converts a Matroska tags XML element (as written for mkvmerge) into
+    the equivalent EBML element.'''
+    (eid, kind) = _EBML_TAG_IDS[node.tagName]
+    if kind is None:
+        payload = ''.join([_ebml_from_xml(child) for child in node.childNodes
+                           if child.nodeType == child.ELEMENT_NODE])
+        return _ebml_element(eid, payload)
+    text = ''.join([child.data for child in node.childNodes
+                    if child.nodeType == child.TEXT_NODE]).strip()
+    if kind == 'uint':
+        return _ebml_uint(eid, int(text))
+    return _ebml_element(eid, _unicode(text).encode('utf_8'))
+
+def _mkv_segment(mkv):
+    '''Reads the top-level elements of the Segment in an open Matroska file
+    without reading any of their contents. Returns the offsets of the
+    Segment's size and payload, its end and its top-level elements (ID, start
+    and end offsets).'''
+    mkv.seek(0, os.SEEK_END)
+    length = mkv.tell()
+    pos = 0
+    while pos < length:
+        mkv.seek(pos)
+        (eid, size, head) = _ebml_header(mkv.read(12))
+        if eid == _EBML_SEGMENT:
+            break
+        pos += head + size
+    else:
+        raise ValueError('No Matroska segment found')
+    size_pos = pos + len(_ebml_id(eid))
+    data = pos + head
+    end = length
+    if size is not None:
+        end = data + size
+    (children, pos) = ([], data)
+    while pos < end:
+        mkv.seek(pos)
+        (eid, size, head) = _ebml_header(mkv.read(12))
+        if size is None:
+            raise ValueError('Cannot edit elements of unknown size')
+        children.append((eid, pos, pos + head + size))
+        pos += head + size
+    return size_pos, data, end, children
+
+def _mkv_seekhead(entries):
+    '''Serializes a SeekHead element listing the given element IDs and
+    positions (relative to the Segment payload).'''
+    seeks = ''
+    for eid, pos in entries:
+        seek = _ebml_element(_EBML_SEEKID, _ebml_id(eid))
+        seek += _ebml_uint(_EBML_SEEKPOS, pos, 8)
+        seeks += _ebml_element(_EBML_SEEK, seek)
+    return _ebml_element(_EBML_SEEKHEAD, seeks)
+
+def _mkv_fill(mkv, start, end, data):
+    '''Writes data at start, filling the rest of the space up to end with a
+    Void element.'''
+    mkv.seek(start)
+    mkv.write(data)
+    if start + len(data) < end:
+        mkv.write(_ebml_void(end - start - len(data)))
+
+def _mkv_void(mkv, start, end):
+    'Turns the element from start to end into a Void element in place.'
+    mkv.seek(start)
+    mkv.write(_ebml_void_header(end - start))
+
+def _mkv_seek_entries(raw):
+    '''Returns the element IDs and positions listed in a serialized SeekHead
+    element.'''
+    entries = []
+    (eid, size, head) = _ebml_header(raw)
+    for seek, start, body, end in _ebml_children(raw, head):
+        if seek != _EBML_SEEK:
+            continue
+        (sid, pos) = (None, None)
+        for child, cstart, cbody, cend in _ebml_children(raw, body, end):
+            if child == _EBML_SEEKID:
+                sid = _ebml_read_vint(raw, cbody, True)[0]
+            elif child == _EBML_SEEKPOS:
+                pos = int(raw[cbody:cend].encode('hex') or '0', 16)
+        if sid is not None and pos is not None:
+            entries.append((sid, pos))
+    return entries
+
+def _mkv_simple_tags(raw, ignore = ()):
+    '''Returns the target type value, name and string value of each simple
+    tag within a serialized Tags element, in sorted order, leaving out any
+    tags with the given names.'''
+    ids = dict([(name, eid) for name, (eid, kind)
+                in _EBML_TAG_IDS.iteritems()])
+    tags = []
+    for tag, start, body, end in _ebml_children(raw, _ebml_header(raw)[2]):
+        if tag != ids['Tag']:
+            continue
+        (target, simple) = (50, [])
+        for child, cstart, cbody, cend in _ebml_children(raw, body, end):
+            if child == ids['Targets']:
+                for sub, sstart, sbody, send in _ebml_children(raw, cbody,
+                                                               cend):
+                    if sub == ids['TargetTypeValue']:
+                        target = int(raw[sbody:send].encode('hex') or '0',
+                                     16)
+            elif child == ids['Simple']:
+                (name, val) = (None, None)
+                for sub, sstart, sbody, send in _ebml_children(raw, cbody,
+                                                               cend):
+                    if sub == ids['Name']:
+                        name = raw[sbody:send]
+                    elif sub == ids['String']:
+                        val = raw[sbody:send]
+                if name not in ignore:
+                    simple.append((name, val))
+        tags += [(target,) + pair for pair in simple]
+    return sorted(tags)
+
+def _mkv_read_element(filename, eid):
+    '''Returns the serialized top-level element with the given ID from a
+    Matroska file, or None if there is none.'''
+    with open(filename, 'rb') as mkv:
+        for child, start, end in _mkv_segment(mkv)[3]:
+            if child == eid:
+                mkv.seek(start)
+                return mkv.read(end - start)
+    return None
+
+def _mkv_write_elements(filename, elements):
+    '''Replaces top-level elements (such as Tags or Attachments, given as a
+    dictionary of element IDs to serialized elements) of a Matroska file in
+    place, without rewriting any clusters. Each element is written into the
+    space left by the element it replaces or into Void padding if it fits,
+    or else appended to the end of the file, and the SeekHead is updated to
+    match. Elements set to None are removed. Every placement is planned
+    before anything is written, so a ValueError exception leaves the file
+    untouched.'''
+    with open(filename, 'r+b') as mkv:
+        (size_pos, data, end, children) = _mkv_segment(mkv)
+        mkv.seek(0, os.SEEK_END)
+        at_eof = mkv.tell() == end
+        seg_end = end
+        (heads, entries) = ([], [])
+        for eid, start, stop in children:
+            if eid == _EBML_SEEKHEAD:
+                mkv.seek(start)
+                heads.append((start, stop))
+                entries += _mkv_seek_entries(mkv.read(stop - start))
+        entries = [(eid, pos) for eid, pos in entries
+                   if eid != _EBML_SEEKHEAD and eid not in elements]
+        (free, voids, writes) = ([], [], [])
+        for eid, start, stop in children:
+            if eid in elements or (start, stop) in heads[1:]:
+                voids.append((start, stop))
+            elif eid != _EBML_VOID:
+                continue
+            if len(free) > 0 and free[-1][1] == start:
+                free[-1][1] = stop
+            else:
+                free.append([start, stop])
+        reserved = None
+        for region in free:
+            if len(heads) > 0 and region[0] == heads[0][1]:
+                reserved = region
+        for eid, element in elements.iteritems():
+            if element is None:
+                continue
+            pos = None
+            for region in free:
+                space = region[1] - region[0]
+                last = at_eof and region[1] == end
+                if region is reserved or not (last or len(element) == space or
+                                              len(element) + 2 <= space):
+                    continue
+                pos = region[0]
+                region[0] += len(element)
+                if last:
+                    end = region[1] = region[0]
+                writes.append((pos, region[1], element))
+                break
+            if pos is None:
+                (pos, end) = (end, end + len(element))
+                writes.append((pos, end, element))
+            entries.append((eid, pos - data))
+        if len(heads) == 0:
+            logging.debug('No SeekHead found, elements must be found by ' +
+                          'scanning the file')
+        else:
+            (start, stop) = heads[0]
+            if reserved is not None:
+                stop = reserved[1]
+            seekhead = _mkv_seekhead(entries)
+            if len(seekhead) == stop - start or \
+                    len(seekhead) + 2 <= stop - start:
+                writes.append((start, stop, seekhead))
+            else:
+                link = _mkv_seekhead([(_EBML_SEEKHEAD, end - data)])
+                if len(link) != stop - start and \
+                        len(link) + 2 > stop - start:
+                    raise ValueError('No room to update the SeekHead')
+                writes.append((end, end + len(seekhead), seekhead))
+                writes.append((start, stop, link))
+                end += len(seekhead)
+        if end > seg_end and not at_eof:
+            raise ValueError('Segment does not end the file')
+        if end != seg_end:
+            mkv.seek(size_pos)
+            (size, size_len) = _ebml_read_vint(mkv.read(8), 0)
+            if size is not None:
+                writes.append((size_pos, size_pos + size_len,
+                               _ebml_vint(end - data, size_len)))
+        for start, stop in voids:
+            _mkv_void(mkv, start, stop)
+        for start, stop, element in writes:
+            _mkv_fill(mkv, start, stop, element)
+        if at_eof:
+            mkv.truncate(end)
 
 class MKVMetadata:
     '''Translates previously fetched metadata (series name, episode name,
     episode number, credits...) into an XML tags file for mkvmerge
     in order to embed it as Matroska tags.'''
+    _element = None
+    _recorded = None
+    _descriptions = ('Episode preview', 'Movie poster')
     
     def __init__(self, source):
         self.source = source
@@ -1198,7 +2717,7 @@ class MKVMetadata:
         n.appendChild(self._doc.createTextNode(name.upper()))
         simple.appendChild(n)
         v = self._doc.createElement('String')
-        v.appendChild(self._doc.createTextNode(str(val)))
+        v.appendChild(self._doc.createTextNode(_unicode(val)))
         simple.appendChild(v)
         tag.appendChild(simple)
     
@@ -1237,7 +2756,10 @@ class MKVMetadata:
             self._add_simple(self._ep, 'rating', popularity)
         self._add_date(self._ep, 'date_released',
                        self.source.get('originalairdate'))
-        self._add_date(self._ep, 'date_recorded', self.source.time)
+        if self.source.time is not None:
+            self._add_date(self._ep, 'date_recorded', self.source.time)
+        elif self._recorded is not None:
+            self._add_simple(self._ep, 'date_recorded', self._recorded)
         self._add_simple(self._ep, 'date_encoded', utc)
         self._add_simple(self._ep, 'date_tagged', utc)
         self._add_simple(self._ep, 'encoder', version)
@@ -1246,6 +2768,8 @@ class MKVMetadata:
     
     def _credits(self):
         'Adds a list of credited people into the XML tree.'
+        if self.source.get('credits') is None:
+            return
         for person in self.source.get('credits'):
             if person[1] in ['actor', 'host', 'guest_star', '']:
                 self._add_simple(self._ep, 'actor', person[0])
@@ -1260,6 +2784,102 @@ class MKVMetadata:
             elif person[1] == 'screenwriter':
                 self._add_simple(self._ep, 'screenplay_by', person[0])
     
+    def _current_tags(self):
+        '''Returns the simple tags already within the MKV file, or None if it
+        has no tags or cannot be read.'''
+        try:
+            raw = _mkv_read_element(self.source.final_file, _EBML_TAGS)
+            if raw is not None:
+                return _mkv_simple_tags(raw)
+        except (IOError, ValueError):
+            pass
+        return None
+    
+    def _art_description(self):
+        'Returns the description of the attached artwork.'
+        return self._descriptions[bool(self.source.get('movie'))]
+    
+    def _element_attachments(self):
+        '''Returns the artwork as a serialized Matroska Attachments element,
+        along with any other files already attached to the MKV file. Artwork
+        previously attached by transcode.py is replaced.'''
+        art = self.source.get('albumart')
+        with open(art, 'rb') as data:
+            image = data.read()
+        files = []
+        raw = _mkv_read_element(self.source.final_file, _EBML_ATTACHMENTS)
+        if raw is not None:
+            for eid, start, body, end in _ebml_children(raw,
+                                                        _ebml_header(raw)[2]):
+                if eid != _EBML_ATTACHED_FILE:
+                    continue
+                desc = None
+                for child, cstart, cbody, cend in _ebml_children(raw, body,
+                                                                 end):
+                    if child == _EBML_FILE_IDS['FileDescription']:
+                        desc = raw[cbody:cend]
+                if desc not in self._descriptions:
+                    files.append(raw[start:end])
+        mime = 'image/jpeg'
+        if art.lower().endswith('.png'):
+            mime = 'image/png'
+        uid = int(hashlib.sha1(image).hexdigest()[:15], 16) + 1
+        ids = _EBML_FILE_IDS
+        attached = _ebml_element(ids['FileDescription'],
+                                 self._art_description())
+        attached += _ebml_element(ids['FileName'],
+                                  _unicode(os.path.basename(art))
+                                  .encode('utf_8'))
+        attached += _ebml_element(ids['FileMimeType'], mime)
+        attached += _ebml_element(ids['FileData'], image)
+        attached += _ebml_uint(ids['FileUID'], uid)
+        files.append(_ebml_element(_EBML_ATTACHED_FILE, attached))
+        return _ebml_element(_EBML_ATTACHMENTS, ''.join(files))
+    
+    def _element_tags(self, version):
+        '''Returns the metadata as a serialized Matroska Tags element. If the
+        recording date of the source is unknown, the one already within the
+        MKV file is kept.'''
+        if self._element is None:
+            if self.source.time is None:
+                for target, name, val in self._current_tags() or []:
+                    if name == 'DATE_RECORDED':
+                        self._recorded = val
+            self._add_tags(version)
+            self._credits()
+            self._element = _ebml_from_xml(self._root)
+        return self._element
+    
+    def unchanged(self, version):
+        '''Determines whether the MKV file already contains exactly the tags
+        which would be embedded, apart from the dates on which it was encoded
+        and tagged.'''
+        dates = ('DATE_ENCODED', 'DATE_TAGGED')
+        current = self._current_tags()
+        if current is None:
+            return False
+        tags = _mkv_simple_tags(self._element_tags(version), dates)
+        return [tag for tag in current if tag[1] not in dates] == tags
+    
+    def embed(self, version):
+        '''Embeds the metadata directly into an existing MKV file, replacing
+        its tags and artwork in place rather than remuxing the whole file.
+        Chapters are left as they are.'''
+        if not self.enabled:
+            return
+        logging.info('*** Adding metadata to %s ***' % self.source.final_file)
+        elements = {_EBML_TAGS : self._element_tags(version)}
+        if self.source.get('albumart') is not None:
+            try:
+                elements[_EBML_ATTACHMENTS] = self._element_attachments()
+            except (IOError, ValueError):
+                logging.warning('*** Could not embed artwork ***')
+        try:
+            _mkv_write_elements(self.source.final_file, elements)
+        except ValueError as e:
+            raise RuntimeError('Could not tag Matroska file %s: %s' %
+                               (self.source.final_file, e))
+    
     def write(self, version):
         '''Writes the metadata XML file and returns command-line arguments to
         mkvmerge in order to embed it, along with album artwork if available,
@@ -1278,12 +2898,13 @@ class MKVMetadata:
             dest.write(data)
         args = ['--global-tags', self._tags]
         if self.source.get('albumart') is not None:
-            if self.source.get('movie'):
-                args += ['--attachment-description', 'Movie poster']
-            else:
-                args += ['--attachment-description', 'Episode preview']
-            args += ['--attachment-mime-type', 'image/jpeg']
-            args += ['--attach-file', self.source.get('albumart')]
+            args += ['--attachment-description', self._art_description()]
+            art = self.source.get('albumart')
+            mime = 'image/jpeg'
+            if art.lower().endswith('.png'):
+                mime = 'image/png'
+            args += ['--attachment-mime-type', mime]
+            args += ['--attach-file', art]
         return args
     
     def clean_tmp(self):
@@ -1297,19 +2918,24 @@ class Transcoder:
     subtitles = None
     chapters = None
     metadata = None
-    _split = []
-    _demuxed = []
     _demux_v = None
     _demux_a = None
     _frames = 0
     _extra = 0
+    _procs = None
+    _abort = None
     
     def __init__(self, source, opts):
         self.source = source
         self.opts = opts
         self._join = source.base + '-join.ts'
+        self._concat = source.base + '.ffconcat'
+        self._cutfile = source.base + '.Xcl'
         self._demux = source.base + '-demux'
         self._wav = source.base + '.wav'
+        self._split = []
+        self._clips = []
+        self._demuxed = []
         self.video = source.base + '.' + self.opts.video
         if self.opts.audio == 'vorbis':
             self.audio = source.base + '.ogg'
@@ -1349,49 +2975,159 @@ class Transcoder:
         elif (self.opts.audio == 'vorbis' and
               not _ver(codecs, '--enable-(libvorbis)')):
             raise RuntimeError('FFmpeg does not support libvorbis.')
+        if (self.opts.cutter == 'concat' and
+            (len(self.source.split_args) > 1 or
+             not _ver(['ffmpeg', '-formats'], '^\s*D\S*\s+(concat)\s'))):
+            logging.warning('*** FFmpeg has no concat demuxer, ' +
+                            'cutting video in separate segments ***')
+            self.opts.cutter = 'split'
         if not self.source.meta_present:
             self.metadata.enabled = False
     
-    def _extract(self, clip, elapsed):
-        '''Creates a new chapter marker at elapsed and uses ffmpeg to extract
-        an MPEG-TS video clip from clip[0] to clip[1]. All values are
-        in seconds.'''
+    def _add_clip(self, clip, elapsed, key = None):
+        '''Marks the video clip from clip[0] to clip[1] to be kept, creating
+        a new chapter marker at elapsed. All values are in seconds. When
+        copying clips with the concat demuxer, which can only start at a
+        keyframe, the clip is moved back to start at the keyframe key before
+        clip[0]. If that keyframe is within the previous clip (the cut is
+        shorter than a GOP), the clip is merged into the previous one.
+        Returns the time from which the video is kept.'''
+        if key is not None and len(self._clips) > 0 and \
+                key < self._clips[-1][1]:
+            (start, end) = self._clips[-1]
+            logging.debug('Cut [%s - %s] is too short to copy, keeping it' %
+                          (_seconds_to_time(end), _seconds_to_time(clip[0])))
+            self._clips[-1] = (start, clip[1])
+            return end
+        if key is not None:
+            clip = (max(key, 0), clip[1])
+        self.chapters.add(elapsed, len(self._clips))
+        self._clips.append(clip)
+        return clip[0]
+    
+    def _keyframes(self, starts):
+        '''Finds the keyframe before each of the given clip starts, so that
+        clips can be copied with the concat demuxer. If any keyframe cannot
+        be found, falls back to extracting each clip separately and returns
+        no keyframes.'''
+        keys = {}
+        for start in starts:
+            if start <= 0:
+                continue
+            keys[start] = _keyframe_before(self.source.orig, start)
+            if keys[start] is None:
+                logging.warning('*** Could not find keyframe before %s, ' %
+                                _seconds_to_time(start) +
+                                'cutting video in separate segments ***')
+                self.opts.cutter = 'split'
+                return {}
+        return keys
+    
+    def _spans(self):
+        '''Yields each span of the source video between the cuts in its
+        cutlist, along with whether it is kept: short clips at the beginning
+        or end of the video are not.'''
+        pos = 0
+        for start, end in self.source.cutlist:
+            yield (pos, start), start > self.opts.clip_thresh and start > pos
+            pos = end
+        if pos < self.source.duration - self.opts.clip_thresh:
+            yield (pos, self.source.duration), True
+    
+    def _extract(self, clip):
+        '''Uses ffmpeg to extract an MPEG-TS video clip from clip[0] to
+        clip[1]. All values are in seconds.'''
         logging.info('*** Extracting segment %d: [%s - %s] ***' %
                      (self.seg + 1, _seconds_to_time(clip[0]),
                       _seconds_to_time(clip[1])))
-        self.chapters.add(elapsed, self.seg)
-        args = ['ffmpeg', '-y', '-i', self.source.orig, '-ss', str(clip[0]),
-                '-t', str(clip[1] - clip[0])] + self.source.split_args[0]
+        args = ['ffmpeg', '-y'] + _seek_args(self.source.orig, clip[0],
+                                             clip[1] - clip[0], self.opts)
+        args += self.source.split_args[0]
         split = '%s-%d.ts' % (self.source.base, self.seg)
         args += [split]
-        self._split += split
+        self._split.append(split)
         if len(self.source.split_args) > 1:
             args += self.source.split_args[1]
         _cmd(args)
         self.seg += 1
-        self.subtitles.mark(clip[1])
     
     def split(self):
         '''Uses the source's cutlist to mark specific video clips from the
-        source video for extraction while also setting chapter markers.'''
-        (pos, elapsed) = (0, 0)
-        for cut in self.source.cutlist:
-            (start, end) = cut
-            if start > self.opts.clip_thresh and start > pos:
-                self._extract((pos, start), elapsed)
-            elapsed += start - pos
-            pos = end
-        if pos < self.source.duration - self.opts.clip_thresh:
-            self._extract((pos, self.source.duration), elapsed)
-            elapsed += self.source.duration - pos
-            pos = self.source.duration
+        source video for extraction while also setting chapter markers. Unless
+        the clips are to be cut from the source in a single pass, each clip
+        is extracted to a separate file.'''
+        spans = list(self._spans())
+        keys = {}
+        if self.opts.cutter == 'concat':
+            keys = self._keyframes([clip[0] for clip, keep in spans if keep])
+        elapsed = 0
+        for clip, keep in spans:
+            if keep:
+                key = keys.get(clip[0])
+                elapsed += clip[0] - self._add_clip(clip, elapsed, key)
+            elapsed += clip[1] - clip[0]
         self.chapters.add(elapsed, None)
+        if self.opts.cutter == 'split':
+            for clip in self._clips:
+                self._extract(clip)
+    
+    def _cut(self):
+        '''Uses ffmpeg's concat demuxer to copy each of the marked video clips
+        straight from the source video into a single MPEG-TS file, reading
+        the source only once. The in and out points are timestamps within
+        the source, so they are offset by the time at which it begins.'''
+        logging.info('*** Cutting video to %s ***' % self._join)
+        offset = _probe(self.source.orig).start_time()
+        orig = self.source.orig
+        if type(orig) is unicode:
+            orig = orig.encode('utf_8')
+        orig = orig.replace("'", "'\\''")
+        with open(self._concat, 'w') as concat:
+            concat.write('ffconcat version 1.0\n')
+            for clip in self._clips:
+                logging.debug('Segment: [%s - %s]' %
+                              (_seconds_to_time(clip[0]),
+                               _seconds_to_time(clip[1])))
+                concat.write("file '%s'\n" % orig)
+                concat.write('inpoint %f\noutpoint %f\n' %
+                             (clip[0] + offset, clip[1] + offset))
+        args = ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i',
+                self._concat] + self.source.split_args[0] + [self._join]
+        _cmd(args)
+    
+    def _write_cutfile(self):
+        '''Writes a Project-X cut file which keeps only the marked video clips,
+        using frame numbers as cut points.'''
+        logging.debug('Project-X cut file:')
+        with open(self._cutfile, 'w') as cut:
+            cut.write('CollectionPanel.CutMode=2\n')
+            for clip in self._clips:
+                frames = tuple([int(round(sec * self.source.fps))
+                                for sec in clip])
+                logging.debug('  %d - %d' % frames)
+                cut.write('%d\n%d\n' % frames)
+    
+    def start_subtitles(self):
+        '''Starts extracting subtitles from the source video, in parallel with
+        cutting and demuxing.'''
+        self.subtitles.start(self.source.orig)
+    
+    def finish_subtitles(self):
+        '''Waits for the subtitles to be extracted and aligns them with the
+        video clips which were kept.'''
+        self.subtitles.finish(self._clips)
     
     def join(self):
         '''Uses ffmpeg's concat: protocol to rejoin the previously split
-        video clips, and then extracts subtitles from the resulting video.'''
+        video clips (or cuts the clips from the source video in a single
+        pass). If Project-X is to cut the video, only writes its cut file.'''
+        if self.opts.cutter == 'projectx':
+            self._write_cutfile()
+            return
+        if self.opts.cutter == 'concat':
+            self._cut()
+            return
         logging.info('*** Joining video to %s ***' % self._join)
-        self.subtitles.clean_tmp()
         concat = 'concat:'
         for seg in xrange(0, self.seg):
             name = '%s-%d.ts' % (self.source.base, seg)
@@ -1405,40 +3141,29 @@ class Transcoder:
         if len(self.source.split_args) > 1:
             args += self.source.split_args[1]
         _cmd(args)
-        self.subtitles.extract(self._join)
-        self.subtitles.adjust()
     
-    def _find_streams(self):
+    def _find_streams(self, video):
         '''Locates the PID numbers of the video and audio streams to be encoded
-        using ffmpeg.'''
+        using ffprobe.'''
         (vstreams, astreams) = ([], [])
-        stream = 'Stream.*\[0x([0-9a-fA-F]+)\].*'
-        videoRE = re.compile(stream + 'Video:.*\s+([0-9]+)x([0-9]+)')
-        audioRE = re.compile(stream + ':\s*Audio')
-        proc = subprocess.Popen(['ffmpeg', '-i', self._join],
-                                stdout = subprocess.PIPE,
-                                stderr = subprocess.STDOUT)
-        for line in proc.stdout:
-            match = re.search(videoRE, line)
-            if match:
-                enabled = False
-                if re.search('Video:.*\(Main\)', line):
-                    logging.debug('Found video stream 0x%s' %
-                                  match.group(1))
-                    enabled = True
-                vstreams += [(int(match.group(1), 16), enabled)]
-            match = re.search(audioRE, line)
-            if match:
-                enabled = False
-                pid = int(match.group(1), 16)
-                match = re.search('\]\(([A-Za-z]+)\)', line)
-                if match:
-                    if match.group(1) == _iso_639_2(self.opts.language):
-                        logging.debug('Found audio stream %s' %
-                                      match.group(1))
-                        enabled = True
-                astreams += [(pid, enabled)]
-            proc.wait()
+        info = _probe(video)
+        for stream in info.video:
+            if stream.get('id') is None or not stream.get('width'):
+                continue
+            enabled = False
+            if stream.get('profile') == 'Main':
+                logging.debug('Found video stream %s' % stream['id'])
+                enabled = True
+            vstreams += [(int(stream['id'], 16), enabled)]
+        for stream in info.audio:
+            if stream.get('id') is None:
+                continue
+            enabled = False
+            lang = stream.get('tags', {}).get('language')
+            if lang == _iso_639_2(self.opts.language):
+                logging.debug('Found audio stream %s' % lang)
+                enabled = True
+            astreams += [(int(stream['id'], 16), enabled)]
         if len(vstreams) == 0:
             raise RuntimeError('No video streams could be found.')
         if len(astreams) == 0:
@@ -1453,9 +3178,9 @@ class Transcoder:
             astreams[0] = (astreams[0][0], True)
         return vstreams, astreams
     
-    def _find_demux(self):
+    def _find_demux(self, video):
         'Uses the Project-X log to obtain the separated video / audio files.'
-        (vstreams, astreams) = self._find_streams()
+        (vstreams, astreams) = self._find_streams(video)
         with open('%s_log.txt' % self._demux, 'r') as log:
             videoRE = re.compile('Video: PID 0x([0-9A-Fa-f]+)')
             audioRE = re.compile('Audio: PID 0x([0-9A-Fa-f]+)')
@@ -1481,14 +3206,14 @@ class Transcoder:
                 if re.match('\.Video ', line):
                     match = re.search(fileRE, line)
                     if match:
-                        self._demuxed += match.group(1)
+                        self._demuxed.append(match.group(1))
                         if curr_v == targ_v:
                             self._demux_v = match.group(1)
                     curr_v += 1
                 elif re.match('Audio \d', line):
                     match = re.search(fileRE, line)
                     if match:
-                        self._demuxed += match.group(1)
+                        self._demuxed.append(match.group(1))
                         if curr_a == targ_a:
                             self._demux_a = match.group(1)
                     curr_a += 1
@@ -1500,12 +3225,17 @@ class Transcoder:
         container into separate raw data files.'''
         logging.info('*** Demuxing video ***')
         name = os.path.basename(self._demux)
+        video = self._join
+        args = ['java', '-jar', self.opts.projectx, '-out', self.opts.tmp,
+                '-name', name]
+        if self.opts.cutter == 'projectx':
+            video = self.source.orig
+            args += ['-cut', self._cutfile]
         try:
-            _cmd(['java', '-jar', self.opts.projectx, '-out', self.opts.tmp,
-                  '-name', name, '-demux', self._join])
+            _cmd(args + ['-demux', video])
         except RuntimeError:
             raise RuntimeError('Could not demux video.')
-        self._find_demux()
+        self._find_demux(video)
         if self._demux_v is None or not os.path.exists(self._demux_v):
             raise RuntimeError('Could not locate demuxed video stream.')
         if self._demux_a is None or not os.path.exists(self._demux_a):
@@ -1540,6 +3270,13 @@ class Transcoder:
                 vf += ['pad=%d:%d:%d:0:black' % (target[0], target[1], pad)]
         return vf
     
+    def _encode_cmd(self, args, cwd = None):
+        '''Executes an encoding command, unless another encoder has already
+        failed. The abort flag is checked only once the command has been
+        registered, so that a failing encoder either sees the command and
+        kills it, or the command sees the flag and does not start.'''
+        _cmd(args, cwd = cwd, procs = self._procs, abort = self._abort)
+    
     def encode_video(self):
         'Invokes ffmpeg to transcode the video stream to H.264 or VP8.'
         preset, threads, rate, speed, vf = [], [], [], [], []
@@ -1585,13 +3322,15 @@ class Transcoder:
         if self.opts.two_pass:
             logging.info(u'*** Encoding video to %s - first pass ***' %
                          self.opts.tmp)
-            _cmd(common + ['-pass', 1, os.devnull], cwd = self.opts.tmp)
+            self._encode_cmd(common + ['-pass', 1, os.devnull],
+                             cwd = self.opts.tmp)
             logging.info(u'*** Encoding video to %s - second pass ***' %
                          self.video)
-            _cmd(common + ['-pass', 2, self.video], cwd = self.opts.tmp)
+            self._encode_cmd(common + ['-pass', 2, self.video],
+                             cwd = self.opts.tmp)
         else:
             logging.info(u'*** Encoding video to %s ***' % self.video)
-            _cmd(common + [self.video])
+            self._encode_cmd(common + [self.video])
     
     def encode_audio(self):
         '''Invokes ffmpeg or neroAacEnc to transcode the audio stream to
@@ -1613,14 +3352,49 @@ class Transcoder:
         _clean(self.audio)
         logging.info(u'*** Encoding audio to %s ***' % self.audio)
         if self.opts.audio == 'aac' and self.opts.aac_encoder == 'nero':
-            _cmd(['ffmpeg', '-y', '-i', self._demux_a, '-vn', '-acodec',
-                  'pcm_s16le', '-f', 'wav'] + channels + [self._wav])
-            _cmd(['neroAacEnc', '-q', self.opts.audio_q, '-if', self._wav,
-                  '-of', self.audio])
+            self._encode_cmd(['ffmpeg', '-y', '-i', self._demux_a, '-vn',
+                              '-acodec', 'pcm_s16le', '-f', 'wav'] +
+                             channels + [self._wav])
+            self._encode_cmd(['neroAacEnc', '-q', self.opts.audio_q,
+                              '-if', self._wav, '-of', self.audio])
         else:
-            _cmd(['ffmpeg', '-y', '-i', self._demux_a, '-vn', '-acodec',
-                  codec, '-ab', '%dk' % self.opts.audio_br, '-f', fmt]
-                 + channels + [self.audio])
+            self._encode_cmd(['ffmpeg', '-y', '-i', self._demux_a, '-vn',
+                              '-acodec', codec, '-ab',
+                              '%dk' % self.opts.audio_br, '-f', fmt] +
+                             channels + [self.audio])
+    
+    def _encode_stream(self, encode, clean, errors):
+        '''Runs one of the encoders and removes its source data once done.
+        If the encoder fails, any other running encoders are killed.'''
+        try:
+            encode()
+            clean()
+        except Exception as e:
+            errors.append(e)
+            self._abort.set()
+            for cmd in list(self._procs):
+                cmd.kill()
+    
+    def encode(self):
+        '''Encodes the audio and video streams at the same time, removing the
+        demuxed data for each stream as soon as it has been encoded. If either
+        encoder fails, the other is stopped and the first error is raised.'''
+        self._procs = []
+        self._abort = threading.Event()
+        errors = []
+        threads = []
+        for encode, clean in [(self.encode_audio, self.clean_audio),
+                              (self.encode_video, self.clean_video)]:
+            thread = threading.Thread(target = self._encode_stream,
+                                      args = (encode, clean, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        if len(errors) > 0:
+            raise errors[0]
     
     def clean_video(self):
         'Removes the temporary video stream data.'
@@ -1634,6 +3408,8 @@ class Transcoder:
         'Removes temporary video clips used before rejoining.'
         for split in self._split:
             _clean(split)
+        _clean(self._concat)
+        _clean(self._cutfile)
     
     def clean_join(self):
         'Removes the temporary rejoined MPEG-2 video data.'
@@ -1674,19 +3450,31 @@ class MP4Transcoder(Transcoder):
     
     def remux(self):
         '''Invokes MP4Box to combine the audio, video and subtitle streams
-        into the MPEG-4 target file, also embedding chapter data and
-        metadata.'''
+        and chapter data into the MPEG-4 target file in a single pass, and
+        then embeds metadata. Hint tracks are added afterwards if enabled.'''
         logging.info(u'*** Remuxing to %s ***' % self.source.final_file)
         self.source.make_final_dir()
         _clean(self.source.final_file)
         common = ['MP4Box', '-tmp', self.opts.final_path]
-        _cmd(common + ['-new', '-add', '%s#video:name=Video' % self.video,
-                       '-add', '%s#audio:name=Audio' % self.audio,
-                       self.source.final_file])
-        _cmd(common + ['-isma', '-hint', self.source.final_file])
-        self.subtitles.write()
-        self.chapters.write()
-        _cmd(common + ['-lang', self.opts.language, self.source.final_file])
+        lang = _iso_639_2(self.opts.language)
+        args = common + ['-new',
+                         '-add', '%s#video:name=Video:lang=%s' %
+                         (self.video, lang),
+                         '-add', '%s#audio:name=Audio:lang=%s' %
+                         (self.audio, lang)]
+        args += self.subtitles.write()
+        chapters = self.chapters.write()
+        try:
+            _cmd(args + chapters + [self.source.final_file])
+        except RuntimeError:
+            if len(chapters) == 0:
+                raise
+            logging.warning('*** Old version of MP4Box, ' +
+                            'chapter support unavailable ***')
+            _clean(self.source.final_file)
+            _cmd(args + [self.source.final_file])
+        if self.opts.isma_hint:
+            _cmd(common + ['-isma', '-hint', self.source.final_file])
         self.metadata.write(_version(self.opts))
     
     def clean_tmp(self):
@@ -1744,7 +3532,7 @@ class MKVTranscoder(Transcoder):
 
 class NullTranscoder(Transcoder):
     '''Does not actually perform any transcoding operations. Used to tag
-    MPEG-4 video files which have already been transcoded.'''
+    MPEG-4 or Matroska video files which have already been transcoded.'''
     
     def __init__(self, source, opts):
         self.source = source
@@ -1756,13 +3544,22 @@ class NullTranscoder(Transcoder):
         self.audio = ''
         self.subtitles = None
         self.chapters = None
-        self.metadata = MP4Metadata(source)
+        if source.ext.lower() == 'mkv':
+            self.metadata = MKVMetadata(source)
+        else:
+            self.metadata = MP4Metadata(source)
         self.check()
     
     def check(self):
-        'Checks if metadata tagging tools are installed.'
+        'Checks if metadata tagging is enabled.'
         if not self.metadata.enabled:
-            raise RuntimeError('AtomicParsley is not installed.')
+            raise RuntimeError('Video files cannot be tagged in WebM mode.')
+    
+    def start_subtitles(self):
+        pass
+    
+    def finish_subtitles(self):
+        pass
     
     def split(self):
         pass
@@ -1780,13 +3577,223 @@ class NullTranscoder(Transcoder):
         pass
     
     def remux(self):
-        'Embeds metadata using AtomicParsley.'
-        self.metadata.write(_version(self.opts))
+        'Embeds metadata directly into the MPEG-4 or Matroska file.'
+        if type(self.metadata) == MKVMetadata:
+            self.metadata.embed(_version(self.opts))
+        else:
+            self.metadata.write(_version(self.opts))
+    
+    def unchanged(self):
+        'Determines whether the video file is already tagged identically.'
+        return self.metadata.unchanged(_version(self.opts))
     
     def clean_tmp(self):
         'Removes any temporary files generated during encoding.'
         self.metadata.clean_tmp()
 
+class TitleCatalog:
+    '''Keeps a catalog of every TV show and movie title which has been
+    resolved through Tvdb / TMDb, in an SQLite database within the cache
+    directory. Titles are indexed by their trigrams, so that candidates
+    for a misspelled or partial title can be found without any network
+    requests.'''
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS titles (id INTEGER ' +
+                         'PRIMARY KEY, kind TEXT, title TEXT, norm TEXT, ' +
+                         'ref TEXT, year INTEGER, grams INTEGER, ' +
+                         'UNIQUE (kind, norm, ref))')
+            conn.execute('CREATE TABLE IF NOT EXISTS trigrams ' +
+                         '(gram TEXT, id INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS trigrams_gram ' +
+                         'ON trigrams (gram)')
+            conn.execute('CREATE INDEX IF NOT EXISTS titles_norm ' +
+                         'ON titles (kind, norm)')
+    
+    def _conn(self):
+        'Returns the database connection for the current thread and process.'
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout = 30)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+    
+    def _trigrams(self, norm):
+        'Returns the set of trigrams within a normalized title.'
+        padded = '  %s ' % norm
+        return set(padded[i:i + 3] for i in xrange(0, len(padded) - 2))
+    
+    def add(self, kind, title, ref = None, year = None):
+        '''Records a resolved title of the given kind ('show' or 'movie'),
+        along with its database ID and year, if known.'''
+        if not title:
+            return
+        title = _unicode(title)
+        norm = _episode_key(title)
+        grams = self._trigrams(norm)
+        if ref is None:
+            ref = ''
+        ref = unicode(ref)
+        try:
+            with self._conn() as conn:
+                cur = conn.execute('INSERT OR IGNORE INTO titles (kind, ' +
+                                   'title, norm, ref, year, grams) VALUES ' +
+                                   '(?, ?, ?, ?, ?, ?)', (kind, title, norm,
+                                   ref, year, len(grams)))
+                if cur.rowcount == 1:
+                    row = cur.lastrowid
+                    conn.executemany('INSERT INTO trigrams (gram, id) ' +
+                                     'VALUES (?, ?)',
+                                     [(gram, row) for gram in grams])
+        except sqlite3.Error as e:
+            logging.debug('Could not add %s to title catalog: %s' % (title, e))
+    
+    def search(self, kind, title, limit = 10, similarity = 0.3):
+        '''Returns up to limit (title, ref, year) tuples of the given kind
+        which resemble the title, ranked by the proportion of trigrams
+        they have in common with it, exact matches first. Byte strings are
+        treated as UTF-8.'''
+        norm = _episode_key(title)
+        grams = list(self._trigrams(norm))
+        if len(grams) == 0:
+            return []
+        try:
+            conn = self._conn()
+            found = conn.execute('SELECT title, ref, year FROM titles ' +
+                                 'WHERE kind = ? AND norm = ?',
+                                 (kind, norm)).fetchall()
+            query = ('SELECT title, ref, year, norm, COUNT(*) * 1.0 / ' +
+                     '(grams + ? - COUNT(*)) AS score FROM trigrams JOIN ' +
+                     'titles ON titles.id = trigrams.id WHERE gram IN ' +
+                     '(%s) AND kind = ? GROUP BY titles.id HAVING score ' +
+                     '>= ? ORDER BY score DESC LIMIT ?') % \
+                     ', '.join('?' * len(grams))
+            rows = conn.execute(query, [len(grams)] + grams +
+                                [kind, similarity, limit]).fetchall()
+        except sqlite3.Error as e:
+            logging.debug('Could not search title catalog: %s' % e)
+            return []
+        for row in rows:
+            if row[3] != norm:
+                found.append(row[:3])
+        return found[:limit]
+    
+    def lookup(self, kind, title, thresh = 0, year = None):
+        '''Returns the (title, ref, year) tuple of the given kind which is
+        either the same title once normalized, or within the Levenshtein
+        threshold of it, or None if there is no such title. Unlike matches
+        against Tvdb / TMDb results, titles merely containing the title are
+        not accepted, so that a related show or movie in the catalog is not
+        mistaken for the one being looked up.'''
+        norm = _episode_key(title)
+        if thresh == 0:
+            thresh = max(int(round(len(norm) * 0.25)), 3)
+        for found in self.search(kind, title):
+            if year is not None and found[2] != year:
+                continue
+            other = _episode_key(found[0])
+            if other == norm or _levenshtein(norm, other, thresh) < thresh:
+                return found
+        return None
+
+_catalogs = {}
+_catalog_lock = threading.Lock()
+
+def _catalog(opts):
+    '''Returns the title catalog within the cache directory, or None if
+    caching is disabled or the catalog cannot be opened.'''
+    path = _cache_path(opts, 'catalog.db')
+    if path is None:
+        return None
+    with _catalog_lock:
+        if path not in _catalogs:
+            try:
+                _catalogs[path] = TitleCatalog(path)
+            except sqlite3.Error as e:
+                logging.warning('*** Could not open title catalog: %s ***' %
+                                e)
+                _catalogs[path] = None
+        return _catalogs[path]
+
+_tvdb_apis = {}
+_tvdb_shows = {}
+_tvdb_indexes = {}
+_tvdb_pending = {}
+_tvdb_lock = threading.Lock()
+
+def _tvdb_api(language, opener):
+    '''Returns the Tvdb instance for the given language, which is shared by
+    every job within the process so that series are only fetched once.'''
+    key = (language, opener)
+    with _tvdb_lock:
+        if key not in _tvdb_apis:
+            _tvdb_apis[key] = MythTV.ttvdb.tvdb_api.Tvdb(language = language,
+                                                         cache = opener)
+        return _tvdb_apis[key]
+
+def _tvdb_show(tvdb, title):
+    '''Looks up a series by name within Tvdb, remembering the series (or its
+    absence) for the rest of the run. Raises tvdb_shownotfound if the series
+    does not exist.'''
+    key = (id(tvdb), title.lower())
+    with _tvdb_lock:
+        show = _tvdb_shows.get(key, False)
+        if show is False:
+            pending = _tvdb_pending.setdefault(key, threading.Lock())
+    if show is False:
+        with pending:
+            with _tvdb_lock:
+                show = _tvdb_shows.get(key, False)
+            if show is False:
+                try:
+                    show = tvdb[title]
+                except MythTV.ttvdb.tvdb_exceptions.tvdb_shownotfound:
+                    show = None
+                with _tvdb_lock:
+                    _tvdb_shows[key] = show
+                    _tvdb_pending.pop(key, None)
+    if show is None:
+        raise MythTV.ttvdb.tvdb_exceptions.tvdb_shownotfound(title)
+    return show
+
+def _episode_key(name):
+    'Normalizes an episode name for lookups, ignoring case and punctuation.'
+    return re.sub('[\W_]+', ' ', _unicode(name).lower(), flags = re.U).strip()
+
+def _tvdb_index(show):
+    '''Indexes the episodes of a Tvdb series by original air date and by
+    normalized episode name. The index is built once per series.'''
+    with _tvdb_lock:
+        index = _tvdb_indexes.get(id(show))
+    if index is not None:
+        return index
+    index = {'firstaired' : {}, 'episodename' : {}, 'names' : []}
+    for season in show.values():
+        for ep in season.values():
+            air = ep.get('firstaired')
+            if air:
+                index['firstaired'].setdefault(unicode(air), []).append(ep)
+            name = ep.get('episodename')
+            if name:
+                key = _episode_key(name)
+                index['episodename'].setdefault(key, []).append(ep)
+                index['names'].append((key, ep))
+    with _tvdb_lock:
+        _tvdb_indexes[id(show)] = index
+    return index
+
+def _tvdb_named(index, name):
+    '''Returns the episodes within a series index with the given name, or
+    failing that, those whose names contain it.'''
+    key = _episode_key(name)
+    if key in index['episodename']:
+        return index['episodename'][key]
+    return [ep for other, ep in index['names'] if other.find(key) >= 0]
+
 class Source(dict):
     '''Acts as a base class for various raw video sources and handles
     Tvdb metadata.'''
@@ -1807,6 +3814,11 @@ class Source(dict):
     split_args = None
     job = None
     crop = None
+    _meta_thread = None
+    _meta_result = None
+    _meta_deadline = None
+    _meta_cancel = None
+    _meta_procs = None
     
     def __repr__(self):
         season = int(self.get('season', 0))
@@ -1849,12 +3861,12 @@ class Source(dict):
                 self.ext = 'webm'
             else:
                 self.ext = 'mkv'
-        self.tvdb = MythTV.ttvdb.tvdb_api.Tvdb(language = self.opts.language)
+        opener = _http_opener(self.opts)
+        self.tvdb = _tvdb_api(self.opts.language, opener)
         ln = _iso_639_2(self.opts.language)
         cn = self.opts.country
         if cn is not None:
             cn = cn.upper()
-        cache = os.path.join(tempfile.gettempdir(), 'tmdb3.cache')
         MythTV.tmdb3.set_cache(engine = 'null')
         MythTV.tmdb3.set_key(self.api_key)
         MythTV.tmdb3.set_locale(language = ln, country = cn,
@@ -1862,30 +3874,17 @@ class Source(dict):
     
     def _find_broken(self):
         '''Determines whether the original video file includes an invalid
-        audio or video stream which cannot be copied, and if so, returns
-        arguments to ffmpeg which avoids copying these streams.'''
+        audio stream which cannot be copied, and if so, returns arguments to
+        ffmpeg which avoids copying these streams.'''
         audioMap = ['-map', '0:a']
-        videoRE = re.compile('Stream #\d+:\d+\[0x[0-9a-fA-F]+\].*:\s*Video')
-        audioRE = re.compile('Stream #\d+:(\d+)\[0x[0-9a-fA-F]+\].*:\s*Audio')
-        args = ['ffmpeg', '-y', '-i', self.orig, '-t', '5', '-map', '0:v',
-                '-map', '0:a', '-c', 'copy', '-f', 'mpegts', os.devnull]
-        proc = subprocess.Popen(args, stdout = subprocess.PIPE,
-                                stderr = subprocess.STDOUT)
-        vStreams = 0
         disabled = False
         enabled = []
-        for line in proc.stdout:
-            match = re.search(videoRE, line)
-            if match:
-                vStreams += 1
-            match = re.search(audioRE, line)
-            if match:
-                stream = int(match.group(1)) - vStreams
-                if re.search('0 channels', line):
-                    logging.debug('Audio stream %d is invalid' % stream)
-                    disabled = True
-                else:
-                    enabled += [stream]
+        for stream, info in enumerate(_probe(self.orig).audio):
+            if info.get('channels', 0) == 0:
+                logging.debug('Audio stream %d is invalid' % stream)
+                disabled = True
+            else:
+                enabled += [stream]
         if disabled:
             audioMap = []
             for stream in enabled:
@@ -1913,49 +3912,17 @@ class Source(dict):
     
     def video_params(self):
         '''Obtains source media parameters such as resolution and FPS
-        using ffmpeg.'''
-        (fps, resolution, duration) = (None, None, None)
-        (vstreams, astreams) = (0, 0)
-        stream = 'Stream.*\[0x[0-9a-fA-F]+\].*'
-        fpsRE = re.compile('([0-9]*\.?[0-9]*) tbr')
-        videoRE = re.compile(stream + 'Video:.*\s+([0-9]+)x([0-9]+)')
-        audioRE = re.compile(stream + ':\s*Audio')
-        duraRE = re.compile('Duration: ([0-9]+):([0-9]+):([0-9]+)\.([0-9]+)')
-        try:
-            proc = subprocess.Popen(['ffmpeg', '-i', self.orig],
-                                    stdout = subprocess.PIPE,
-                                    stderr = subprocess.STDOUT)
-            for line in proc.stdout:
-                match = re.search(fpsRE, line)
-                if match:
-                    fps = float(match.group(1))
-                match = re.search(videoRE, line)
-                if match:
-                    vstreams += 1
-                    if resolution is None:
-                        width = int(match.group(1))
-                        height = int(match.group(2))
-                        resolution = (width, height)
-                match = re.search(audioRE, line)
-                if match:
-                    astreams += 1
-                match = re.search(duraRE, line)
-                if match:
-                    hour = int(match.group(1))
-                    minute = int(match.group(2))
-                    sec = int(match.group(3))
-                    frac = int(match.group(4))
-                    duration = hour * 3600 + minute * 60 + sec
-                    duration += frac / (10. ** len(match.group(4)))
-            proc.wait()
-        except OSError:
-            raise RuntimeError('FFmpeg is not installed.')
+        using ffprobe.'''
+        info = _probe(self.orig)
+        vstreams = len(info.video)
+        astreams = len(info.audio)
         if vstreams == 0:
             raise RuntimeError('No video streams could be found.')
         if astreams == 0:
             raise RuntimeError('No audio streams could be found.')
         self._check_split_args()
-        return fps, resolution, duration, vstreams, astreams
+        return (info.fps(), info.resolution(), info.duration(),
+                vstreams, astreams)
     
     def _auto_crop(self):
         '''Uses ffmpeg to detect black borders in order to automatically
@@ -1969,22 +3936,20 @@ class Source(dict):
             cut = (0, self.cutlist[0][1])
         else:
             cut = (self.cutlist[0][1], self.cutlist[1][0])
-        args = ['ffmpeg', '-y', '-i', self.orig, '-ss', str(cut[0]),
-                '-t', str(cut[1] - cut[0]), '-vf', 'cropdetect=%d' % 96,
-                '-an', '-f', 'mpegts']
+        args = ['ffmpeg', '-y'] + _seek_args(self.orig, cut[0],
+                                             cut[1] - cut[0], self.opts)
+        args += ['-vf', 'cropdetect=%d' % 96, '-an', '-f', 'mpegts']
         args += [os.devnull]
         if len(self.split_args) > 1:
             args += self.split_args[1]
-        proc = subprocess.Popen(args, stdout = subprocess.PIPE,
-                                stderr = subprocess.STDOUT)
-        logging.debug('$ %s' % u' '.join(args))
         regex = re.compile('crop=(\d+):(\d+):(\d+):(\d+)')
-        for line in proc.stdout:
+        def _parse(line):
             match = re.search(regex, line)
             if match:
                 res = (match.group(1), match.group(2))
                 pos = (match.group(3), match.group(4))
                 self.crop = (res, pos)
+        Command(args, callback = _parse).run()
         if self.crop is not None:
             aspect = int(self.crop[0][0]) * 1.0 / int(self.crop[0][1])
             closest = 0.01
@@ -2071,13 +4036,14 @@ class Source(dict):
     
     def _find_episode(self, show):
         'Searches Tvdb for the episode using the original air date and title.'
-        episodes = None
+        index = _tvdb_index(show)
+        episodes = []
         airdate = self.get('originalairdate')
         subtitle = self.get('subtitle')
         if airdate is not None:
-            episodes = show.search(airdate, key = 'firstaired')
+            episodes = index['firstaired'].get(unicode(airdate), [])
         if not episodes and subtitle is not None:
-            episodes = show.search(subtitle, key = 'episodename')
+            episodes = _tvdb_named(index, subtitle)
         if len(episodes) == 1:
             return episodes[0]
         for ep in episodes:
@@ -2086,18 +4052,105 @@ class Source(dict):
                 date = datetime.datetime.strptime(air, '%Y-%m-%d').date()
                 if airdate == date:
                     return ep
+        if subtitle is None:
+            return None
         for ep in episodes:
             st = ep.get('episodename')
+            if st is None:
+                continue
             if subtitle.find(st) >= 0 or st.find(subtitle) >= 0:
                 return ep
         return None
     
+    def _scale_art(self, src, dest):
+        '''Downscales and recompresses artwork into a JPEG image no larger
+        than art_size pixels wide or high. Returns False on failure.'''
+        fit = 'min(1,%d/max(iw,ih))' % self.opts.art_size
+        scale = "scale='trunc(iw*%s/2)*2':'trunc(ih*%s/2)*2'" % (fit, fit)
+        try:
+            _cmd(['ffmpeg', '-y', '-i', src, '-vf', scale, '-f', 'image2',
+                  '-vcodec', 'mjpeg', '-qscale', '3', dest],
+                 procs = self._meta_procs)
+        except RuntimeError:
+            logging.warning('*** Unable to downscale artwork ***')
+            _clean(dest)
+            return False
+        return True
+    
+    def _fetch_art(self, url, desc):
+        '''Obtains the artwork at the given URL through the artwork cache,
+        downloading it (and downscaling it if requested) only if it has not
+        been cached already, and copies it alongside the temporary files.
+        Nothing is written once the lookup has been cancelled.'''
+        if _lookup_cancelled():
+            return
+        ext = os.path.splitext(url)[-1].lower()
+        key = hashlib.sha1(url).hexdigest()
+        if self.opts.art_size:
+            key += '-%d' % self.opts.art_size
+            ext = '.jpg'
+        cached = _cache_path(self.opts, 'art', key + ext)
+        art = self.base + ext
+        if cached is not None and os.path.exists(cached):
+            try:
+                shutil.copyfile(cached, art)
+                os.utime(cached, None)
+                self['albumart'] = art
+                logging.debug('Using cached %s %s' % (desc, cached))
+                return
+            except (IOError, OSError):
+                _clean(art)
+        if self.opts.offline:
+            logging.warning('*** No cached %s in offline mode ***' % desc)
+            return
+        orig = self.base + '-orig' + os.path.splitext(url)[-1].lower()
+        _rate_limiter(self.opts).wait()
+        if _lookup_cancelled():
+            return
+        try:
+            urllib.urlretrieve(url, orig)
+        except IOError:
+            logging.warning('*** Unable to download %s ***' % desc)
+            _clean(orig)
+            return
+        if _lookup_cancelled():
+            _clean(orig)
+            return
+        if not self.opts.art_size:
+            _replace(orig, art)
+        elif self._scale_art(orig, art):
+            _clean(orig)
+        else:
+            art = self.base + os.path.splitext(url)[-1].lower()
+            _replace(orig, art)
+            cached = None
+        if _lookup_cancelled():
+            _clean(orig)
+            _clean(art)
+            return
+        self['albumart'] = art
+        if cached is not None:
+            path = os.path.dirname(cached)
+            try:
+                fd, tmp = tempfile.mkstemp(prefix = '.', dir = path)
+                os.close(fd)
+                shutil.copyfile(art, tmp)
+                _replace(tmp, cached)
+                _cache_added(self.opts.cache,
+                             self.opts.cache_size * 1024 * 1024,
+                             os.path.getsize(cached))
+            except (IOError, OSError):
+                logging.debug('Could not cache %s %s' % (desc, url))
+    
     def _fetch_tvdb(self):
         'Obtains missing metadata through Tvdb if episode is found.'
         if not self.get('title'):
             return
         try:
-            show = self.tvdb[self.get('title')]
+            show = _tvdb_show(self.tvdb, self.get('title'))
+            catalog = _catalog(self.opts)
+            if catalog is not None:
+                catalog.add('show', show.data.get('seriesname'))
             self['seasoncount'] = len(show)
             if show.has_key(0):
                 self['seasoncount'] -= 1
@@ -2135,14 +4188,7 @@ class Source(dict):
                             self['description'] += ' (%s / 10)' % rating
                 filename = ep.get('filename')
                 if filename is not None and len(filename) > 0:
-                    ext = os.path.splitext(filename)[-1]
-                    art = self.base + ext
-                    try:
-                        urllib.urlretrieve(filename, art)
-                        self['albumart'] = art
-                    except IOError:
-                        logging.warning('*** Unable to download ' +
-                                        'episode screenshot ***')
+                    self._fetch_art(filename, 'episode screenshot')
         except MythTV.ttvdb.tvdb_exceptions.tvdb_shownotfound:
             logging.warning('*** Unable to fetch Tvdb listings for show ***')
     
@@ -2185,6 +4231,12 @@ class Source(dict):
                 logging.warning('*** Unable to fetch TMDb listings '
                                 'for movie ***')
                 return
+            catalog = _catalog(self.opts)
+            if catalog is not None:
+                year = None
+                if movie.releasedate is not None:
+                    year = movie.releasedate.year
+                catalog.add('movie', movie.title, movie.id, year)
             airdate = self.get('originalairdate')
             if airdate is None or airdate.year < 1900:
                 self['originalairdate'] = movie.releasedate
@@ -2218,14 +4270,7 @@ class Source(dict):
             self['tagline'] = movie.tagline
             poster = movie.poster
             if poster is not None:
-                poster = poster.geturl()
-                ext = os.path.splitext(poster)[-1]
-                art = self.base + ext
-                try:
-                    urllib.urlretrieve(poster, art)
-                    self['albumart'] = art
-                except IOError:
-                    logging.warning('*** Unable to download movie poster ***')
+                self._fetch_art(poster.geturl(), 'movie poster')
             self._add_tmdb_credits(movie)
         except MythTV.tmdb3.tmdb_exceptions.TMDBError:
             logging.warning('*** Unable to fetch TMDb listings for movie ***')
@@ -2237,6 +4282,62 @@ class Source(dict):
         else:
             self._fetch_tvdb()
     
+    def start_metadata(self):
+        '''Starts obtaining missing metadata from Tvdb / TMDb in the
+        background, on a copy of the source, so that slow lookups overlap
+        with the transcode rather than delaying it.'''
+        clone = copy.copy(self)
+        if clone.get('credits') is not None:
+            clone['credits'] = list(clone['credits'])
+        clone._meta_procs = []
+        cancel = threading.Event()
+        result = {}
+        def _fetch():
+            _lookup.cancel = cancel
+            try:
+                clone.fetch_database()
+                clone.sort_credits()
+                result['meta'] = dict(clone)
+            except Exception as e:
+                result['error'] = e
+        if self.opts.metadata_timeout > 0:
+            self._meta_deadline = time.time() + self.opts.metadata_timeout
+        self._meta_result = result
+        self._meta_cancel = cancel
+        self._meta_procs = clone._meta_procs
+        self._meta_thread = threading.Thread(target = _fetch)
+        self._meta_thread.daemon = True
+        self._meta_thread.start()
+    
+    def finish_metadata(self):
+        '''Waits for the background metadata lookups until the deadline and
+        merges their results, falling back to the metadata found within the
+        recording itself if they fail or run late. Lookups which run late are
+        cancelled, so that they make no further requests and write no more
+        files. Then determines the filename of the target video.'''
+        if self._meta_thread is not None:
+            timeout = None
+            if self._meta_deadline is not None:
+                timeout = max(0, self._meta_deadline - time.time())
+            self._meta_thread.join(timeout)
+            if self._meta_thread.is_alive():
+                self._meta_cancel.set()
+                for cmd in list(self._meta_procs):
+                    cmd.kill()
+                logging.warning('*** Timed out fetching Tvdb / TMDb ' +
+                                'metadata ***')
+            elif 'error' in self._meta_result:
+                logging.warning('*** Unable to fetch Tvdb / TMDb ' +
+                                'metadata: %s ***' %
+                                self._meta_result['error'])
+            else:
+                self.update(self._meta_result['meta'])
+            (self._meta_thread, self._meta_cancel) = (None, None)
+            self._meta_procs = None
+            self.sort_credits()
+        self.final = self.final_name()
+        self.final_file = '%s.%s' % (self.final, self.ext)
+    
     def sort_credits(self):
         '''Sorts the list of credited actors, directors and such using the
         last name first.'''
@@ -2246,10 +4347,11 @@ class Source(dict):
             self['credits'] = sorted(self.get('credits'), key = key)
     
     def print_metadata(self):
-        'Outputs any metadata obtained to the log.'
+        'Outputs any metadata obtained, and the target file, to the log.'
+        logging.info('*** Printing file metadata ***')
+        logging.info('  Target file: %s' % self.final_file)
         if not self.meta_present:
             return
-        logging.info('*** Printing file metadata ***')
         for key in self.keys():
             if key != 'credits':
                 logging.info(u'  %s: %s' % (key, self[key]))
@@ -2321,7 +4423,6 @@ class Source(dict):
         if type(self) != MP4Source:
             logging.info(enc)
         logging.info('  Source file: %s' % self.orig)
-        logging.info('  Target file: %s' % self.final_file)
         logging.info('  Temporary directory: %s' % self.opts.tmp)
     
     def final_name(self):
@@ -2382,27 +4483,186 @@ class Source(dict):
         if self.remove_tmp and os.path.isdir(self.opts.tmp):
             shutil.rmtree(self.opts.tmp)
 
+def _cut_pairs(marks):
+    '''Pairs up the cut start and end marks (types 1 and 0) from the
+    recordedmarkup table by walking them in order. A leading end mark cuts
+    from the beginning and a trailing start mark cuts to the end, as with
+    getcutlist() in the MythTV bindings, while any other stray marks are
+    ignored.'''
+    marks = sorted(marks)
+    (cuts, start) = ([], None)
+    if len(marks) > 0 and marks[0][1] == 0:
+        start = 0
+    for mark, kind in marks:
+        if kind == 1 and start is None:
+            start = mark
+        elif kind == 0 and start is not None:
+            cuts.append((start, mark))
+            start = None
+    if start is not None:
+        cuts.append((start, 9999999))
+    return cuts
+
+def _myth_time(time):
+    '''Converts the start time of a recording, either a 14-digit local
+    timestamp or a datetime from the MythTV bindings, into the form in which
+    the database stores it: UTC for bindings which are timezone aware, or
+    local time for older ones.'''
+    if isinstance(time, (int, long)):
+        time = _convert_time(time)
+    time = MythTV.datetime.duck(time)
+    if hasattr(time, 'asnaiveutc'):
+        return time.asnaiveutc()
+    return time
+
+class MythLoader:
+    '''Loads the MythTV metadata for a set of recordings - the recorded and
+    recordedprogram rows, channel names, content ratings, credits and cut
+    points - using a few indexed queries in total rather than several
+    queries for each recording, and keeps it for the rest of the process.'''
+    chunk = 100
+    
+    def __init__(self, db):
+        self.db = db
+        self.loaded = {}
+        self.wanted = set()
+    
+    def _query(self, query, args):
+        'Executes a query against the MythTV database, returning every row.'
+        cursor = self.db.cursor()
+        try:
+            cursor.execute(query, args)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+    
+    def _union(self, select, params):
+        '''Runs a query once for each set of parameters, batched into UNION
+        ALL queries, and returns the rows found for each set in turn.'''
+        results = []
+        for n in xrange(0, len(params), self.chunk):
+            part = params[n:n + self.chunk]
+            query = ' UNION ALL '.join(['(SELECT %d, %s)' % (i, select)
+                                        for i in xrange(0, len(part))])
+            rows = [[] for args in part]
+            for row in self._query(query, [arg for args in part
+                                           for arg in args]):
+                rows[row[0]].append(row[1:])
+            results += rows
+        return results
+    
+    def _channels(self, chanids):
+        'Returns the names of the given channels.'
+        if len(chanids) == 0:
+            return {}
+        query = 'SELECT chanid, name FROM channel WHERE chanid IN (%s)' % \
+            ', '.join(['%s'] * len(chanids))
+        return dict(self._query(query, chanids))
+    
+    def _ref(self, chanid, starttime):
+        'Returns the query parameters identifying a recording.'
+        return chanid, _myth_time(starttime)
+    
+    def load(self, keys):
+        '''Loads the metadata for each recording (given as a channel ID and
+        a 14-digit local start time), along with any other recordings
+        wanted, which have not been loaded already.'''
+        keys = [key for key in set(keys) | self.wanted
+                if key not in self.loaded]
+        self.wanted = set()
+        if len(keys) == 0:
+            return
+        logging.debug('Loading MythTV metadata for %d recordings' % len(keys))
+        where = ' WHERE chanid = %s AND starttime = %s'
+        (recs, infos) = ([], [])
+        found = self._union('recorded.* FROM recorded' + where,
+                            [self._ref(*key) for key in keys])
+        for key, rows in zip(keys, found):
+            self.loaded[key] = None
+            if len(rows) > 0:
+                rec = MythTV.Recorded.fromRaw(rows[0], self.db)
+                self.loaded[key] = {'rec' : rec}
+                recs.append(rec)
+                infos.append(self.loaded[key])
+        if len(recs) == 0:
+            return
+        refs = [self._ref(recording.chanid, recording.starttime)
+                for recording in recs]
+        progs = self._union('recordedprogram.* FROM recordedprogram' + where,
+                            [self._ref(recording.chanid, recording.progstart)
+                             for recording in recs])
+        ratings = self._union('rating FROM recordedrating' + where, refs)
+        credits = self._union('people.name, recordedcredits.role FROM ' +
+                              'recordedcredits JOIN people ON ' +
+                              'people.person = recordedcredits.person' +
+                              where, refs)
+        marks = self._union('mark, type FROM recordedmarkup' + where +
+                            ' AND type IN (0, 1)', refs)
+        channels = self._channels(sorted(set([recording.chanid
+                                              for recording in recs])))
+        for info, prog, rating, cred, mark in zip(infos, progs, ratings,
+                                                  credits, marks):
+            rec = info['rec']
+            info['prog'] = None
+            if len(prog) > 0:
+                info['prog'] = MythTV.RecordedProgram.fromRaw(prog[0],
+                                                              self.db)
+            info['ratings'] = [{'rating' : row[0]} for row in rating]
+            info['credits'] = [(row[0], row[1]) for row in cred]
+            info['cuts'] = _cut_pairs(mark)
+            info['channel'] = channels.get(rec.chanid)
+    
+    def get(self, chanid, starttime):
+        '''Returns the metadata for a single recording, or None if the
+        recording could not be found.'''
+        key = (int(chanid), long(starttime))
+        if key not in self.loaded:
+            self.load([key])
+        return self.loaded[key]
+    
+    def seek(self, rec, kind):
+        '''Reads the seek table entries of the given type for a recording,
+        as (mark, offset) pairs.'''
+        return self._union('mark, offset FROM recordedseek WHERE ' +
+                           'chanid = %s AND starttime = %s AND type = %s',
+                           [self._ref(rec.chanid, rec.starttime) +
+                            (kind,)])[0]
+
+_myth_loaders = {}
+_myth_wanted = []
+
+def _myth_loader(db):
+    '''Returns the metadata loader for the given MythTV database connection,
+    which also loads any recordings wanted by the current batch.'''
+    if id(db) not in _myth_loaders:
+        loader = MythLoader(db)
+        loader.wanted.update(_myth_wanted)
+        _myth_loaders[id(db)] = loader
+    return _myth_loaders[id(db)]
+
 class MythSource(Source):
     '''Obtains the raw MPEG-2 video data from a MythTV database along with
     metadata and a commercial-skip cutlist.'''
     prog = None
     db = None
-    index = []
-    
-    class _Rating(MythTV.DBDataRef):
-        'Query for the content rating within the MythTV database.'
-        _table = 'recordedrating'
-        _ref = ['chanid', 'starttime']
+    index = None
+    seek = None
+    info = None
+    direct = False
     
-    def __init__(self, jobid, opts, defaults):
-        self._get_db(opts)
+    @classmethod
+    def from_job(cls, jobid, opts, defaults):
+        'Creates the source for the recording of the given MythTV job.'
+        db = _connect(opts)
         try:
-            self.job = MythTV.Job(jobid, db = self.db)
+            job = MythTV.Job(jobid, db = db)
         except MythTV.exceptions.MythError:
             raise ValueError('Could not find job ID %d.' % jobid)
-        channel = int(self.job.chanid)
-        time = long(self.job.starttime.strftime('%Y%m%d%H%M%S'))
-        self.__init__(channel, time, opts, defaults)
+        channel = int(job.chanid)
+        time = long(job.starttime.strftime('%Y%m%d%H%M%S'))
+        source = cls(channel, time, opts, defaults)
+        source.job = job
+        return source
     
     def __init__(self, channel, time, opts, defaults):
         Source.__init__(self, opts, defaults)
@@ -2412,76 +4672,117 @@ class MythSource(Source):
         self.base = os.path.join(opts.tmp, '%s_%s' % (str(channel), str(time)))
         self.orig = self.base + '-orig.mpg'
         self._get_db(opts)
-        try:
-            self.rec = MythTV.Recorded((channel, time), db = self.db)
-        except MythTV.exceptions.MythError:
+        self.info = _myth_loader(self.db).get(channel, time)
+        if self.info is None:
             err = 'Could not find recording at channel %d and time %s.'
             raise ValueError(err % (channel, time))
-        try:
-            self.prog = self.rec.getRecordedProgram()
+        self.rec = self.info['rec']
+        self.prog = self.info['prog']
+        if self.prog is not None:
             self.meta_present = True
-        except MythTV.exceptions.MythError:
+        else:
             logging.warning('*** No MythTV program data, ' +
                             'metadata disabled ***')
-        self.rating = self._Rating(self.rec._wheredat, self.db)
+        self.rating = self.info['ratings']
         self._fetch_metadata()
-        self.final = self.final_name()
-        self.final_file = '%s.%s' % (self.final, self.ext)
     
     def _get_db(self, opts):
         'Connects to the MythTV MySQL database.'
-        self.db_info = {'DBHostName' : opts.host, 'DBName' : opts.database,
-                        'DBUserName' : opts.user, 'DBPassword' : opts.password,
-                        'SecurityPin' : opts.pin}
-        self.db = MythTV.MythDB(**self.db_info)
+        self.db = _connect(opts)
     
     def _build_index(self):
         '''Uses ffprobe to build a frame index for the video file in
         order to easily determine the amount of time elapsed by any
-        given number of frames.'''
-        self.index = []
-        frames, prev, time = 0, 0.0, 0.0
-        args = ['ffprobe', '-print_format', 'compact',
-                '-show_frames', self.orig]
-        with open(os.devnull, 'w') as devnull:
-            proc = subprocess.Popen(args, stdout = subprocess.PIPE,
-                                    stderr = devnull)
-            logging.debug('$ %s' % u' '.join(args))
-            videoRE = re.compile('media_type=video')
-            ptsRE = re.compile('pkt_pts_time=([0-9.]+)')
-            video_index, pts_index = -1, -1
-            for line in proc.stdout:
-                tokens = line.split('|')
-                if video_index < 0:
-                    for count, token in zip(range(len(tokens)), tokens):
-                        if re.search('media_type', token):
-                            video_index = count
-                            break
-                if pts_index < 0:
-                    for count, token in zip(range(len(tokens)), tokens):
-                        if re.search(ptsRE, token):
-                            pts_index = count
-                            break
-                if re.search(videoRE, tokens[video_index]):
-                    match = re.search(ptsRE, tokens[pts_index])
-                    if match is None:
-                        raise RuntimeError('Could not find PTS for + '
-                                           'frame %d.' % frames)
-                    pts = float(match.group(1))
-                    self.index += [time]
-                    frames += 1
-                    if prev != 0:
-                        time += pts - prev
-                    prev = pts
+        given number of frames. Only the packet timestamps of the video
+        stream are read, without decoding any frames, and the index is
+        cached so that later runs on the same recording can skip this.'''
+        cache = _cache_path(self.opts, 'index', _file_key(self.orig) + '.idx')
+        if cache is not None and os.path.exists(cache):
+            self.index = array.array('d')
+            try:
+                with open(cache, 'rb') as data:
+                    self.index.fromstring(data.read())
+                os.utime(cache, None)
+                logging.debug('Loaded frame index from %s' % cache)
+                return
+            except (IOError, OSError, ValueError):
+                logging.debug('Ignoring unreadable frame index %s' % cache)
+        logging.info('*** Building frame index ***')
+        pts = array.array('d')
+        args = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                '-show_entries', 'packet=pts_time', '-of', 'csv=p=0',
+                self.orig]
+        def _parse(line):
+            time = line.split(',')[0].strip()
+            if time != '' and time != 'N/A':
+                bisect.insort(pts, float(time))
+        Command(args, tail = 0, use_stderr = False, callback = _parse).run()
+        if len(pts) == 0:
+            raise RuntimeError('Could not find PTS for any frames.')
+        first = pts[0]
+        for frame in xrange(0, len(pts)):
+            pts[frame] -= first
+        self.index = pts
+        if cache is not None:
+            tmp = None
+            try:
+                (fd, tmp) = tempfile.mkstemp(prefix = '.',
+                                             dir = os.path.dirname(cache))
+                with os.fdopen(fd, 'wb') as data:
+                    self.index.tofile(data)
+                _replace(tmp, cache)
+                _evict_lru(self.opts.cache,
+                           self.opts.index_cache_size * 1024 * 1024,
+                           ['index'])
+            except (IOError, OSError):
+                logging.debug('Could not cache frame index %s' % cache)
+                _clean(tmp)
+    
+    def _load_seek(self):
+        '''Reads the keyframe positions and durations which MythTV stores in
+        the seek table for the recording. Returns False if the seek table is
+        missing or inconsistent with the video file.'''
+        duration_ms = getattr(self.rec.markup, 'MARK_DURATION_MS', 33)
+        seek = [(int(mark), int(offset)) for mark, offset
+                in _myth_loader(self.db).seek(self.rec, duration_ms)]
+        seek.sort()
+        if len(seek) < 2:
+            logging.debug('Seek table is missing')
+            return False
+        for prev, curr in zip(seek[:-1], seek[1:]):
+            if curr[0] == prev[0] or curr[1] < prev[1]:
+                logging.debug('Seek table is out of order')
+                return False
+        rate = (seek[-1][0] - seek[0][0]) * 1000.0
+        rate /= max(seek[-1][1] - seek[0][1], 1)
+        if abs(rate - self.fps) > self.fps * 0.1:
+            logging.debug('Seek table frame rate %.2f does not match' % rate)
+            return False
+        if seek[-1][1] / 1000.0 < self.duration - 30:
+            logging.debug('Seek table does not cover the recording')
+            return False
+        self.seek = ([mark for mark, ms in seek], [ms for mark, ms in seek])
+        return True
     
     def _frame_to_timecode(self, frame):
-        '''Uses the previously generated frame index for the video file to
-        obtain the amount of elapsed time corresponding to a given
-        frame number within the video.'''
-        if self.index is None or len(self.index) == 0:
-            self._build_index()
+        '''Uses MythTV's seek table (or the previously generated frame index
+        for the video file, if the seek table can't be used) to obtain the
+        amount of elapsed time corresponding to a given frame number within
+        the video. Frames between keyframes in the seek table are
+        interpolated using the frame rate of the video.'''
         if frame < 0:
             frame = 0
+        if self.seek is None:
+            self.seek = False
+            if self.opts.use_seek_table:
+                self._load_seek()
+        if self.seek:
+            (marks, times) = self.seek
+            pos = max(bisect.bisect_right(marks, frame) - 1, 0)
+            time = times[pos] / 1000.0 + (frame - marks[pos]) / self.fps
+            return min(time, self.duration)
+        if self.index is None or len(self.index) == 0:
+            self._build_index()
         if frame >= len(self.index):
             frame = len(self.index) - 1
         return self.index[frame]
@@ -2489,7 +4790,7 @@ class MythSource(Source):
     def _cut_list(self):
         'Obtains the MythTV commercial-skip cutlist from the database.'
         logging.info('*** Locating cut points ***')
-        markup = self.rec.markup.getcutlist()
+        markup = self.info['cuts']
         self.cutlist = []
         for cut in xrange(0, len(markup)):
             start = self._frame_to_timecode(markup[cut][0])
@@ -2501,13 +4802,8 @@ class MythSource(Source):
         if not self.meta_present:
             return
         logging.info('*** Fetching metadata for %s ***' % self.base)
-        channel = None
-        ch = MythTV.Channel(db = self.db)
-        for chan in ch._fromQuery("", (), db = self.db):
-            if chan.get('chanid') == self.rec.get('chanid'):
-                channel = chan
-        if channel:
-            self['channel'] = channel.get('name')
+        if self.info['channel']:
+            self['channel'] = self.info['channel']
         for key in ['title', 'subtitle', 'description', 'category',
                     'originalairdate', 'syndicatedepisodenumber']:
             val = self.prog.get(key)
@@ -2522,26 +4818,55 @@ class MythSource(Source):
         for item in self.rating:
             self['rating'] = item.get('rating')
         cred = None
-        for person in self.rec.cast:
-            if cred is None:
-                cred = []
-            cred.append((person['name'], person['role']))
+        if len(self.info['credits']) > 0:
+            cred = list(self.info['credits'])
         self['credits'] = cred
         self._collapse_movie()
-        self.fetch_database()
-        self.sort_credits()
+        self.start_metadata()
+    
+    def _local_path(self):
+        '''Locates the recording within the storage_path directory or one of
+        the directories of its storage group, if reachable from this
+        computer. Returns None if the recording cannot be read locally.'''
+        basename = self.rec.get('basename')
+        if not basename:
+            return None
+        dirs = []
+        if self.opts.storage_path:
+            dirs.append(self.opts.storage_path)
+        group = self.rec.get('storagegroup') or 'Default'
+        try:
+            for sg in self.db.getStorageGroup(groupname = group,
+                                              hostname = self.rec.hostname):
+                dirs.append(sg.dirname)
+        except MythTV.exceptions.MythError:
+            logging.debug('Could not look up storage group %s' % group)
+        for path in dirs:
+            filename = os.path.join(path, basename)
+            if os.path.isfile(filename) and os.access(filename, os.R_OK):
+                return filename
+        return None
     
     def copy(self):
-        '''Copies the recording for the given channel ID and start time to the
-        specified path, if enough space is available.'''
-        bs = 4096 * 1024
-        logging.info('*** Copying video to %s ***' % self.orig)
-        with self.rec.open() as source:
-            with open(self.orig, 'wb') as dest:
-                data = source.read(bs)
-                while len(data) > 0:
-                    dest.write(data)
+        '''Reads the recording for the given channel ID and start time in
+        place if it can be found locally, or otherwise copies it from the
+        MythTV backend to the specified path.'''
+        local = None
+        if self.opts.direct_read:
+            local = self._local_path()
+        if local is not None:
+            logging.info('*** Reading video directly from %s ***' % local)
+            self.orig = local
+            self.direct = True
+        else:
+            bs = 4096 * 1024
+            logging.info('*** Copying video to %s ***' % self.orig)
+            with self.rec.open() as source:
+                with open(self.orig, 'wb') as dest:
                     data = source.read(bs)
+                    while len(data) > 0:
+                        dest.write(data)
+                        data = source.read(bs)
         (self.fps, self.resolution, self.duration,
          self.vstreams, self.astreams) = self.video_params()
         if not self.fps or not self.resolution or not self.duration:
@@ -2551,6 +4876,12 @@ class MythSource(Source):
             self._auto_crop()
         self.opts.resolution = self.parse_resolution(self.opts.resolution)
     
+    def clean_copy(self):
+        '''Removes the copied MPEG-2 video data, unless the recording itself
+        was read in place.'''
+        if not self.direct:
+            _clean(self.orig)
+    
     def _clean_cutlist(self):
         '''Removes commercial-skip and cut marks from the cutlist.
         Adapted from http://www.mythtv.org/wiki/Transcode_wrapper_stub'''
@@ -2625,8 +4956,6 @@ class WTVSource(Source):
             self.base = os.path.join(opts.tmp, os.path.splitext(f)[0])
         self.orig = self.base + '-orig.ts'
         self._fetch_metadata()
-        self.final = self.final_name()
-        self.final_file = '%s.%s' % (self.final, self.ext)
     
     def _cut_list(self):
         '''Obtains a commercial-skip cutlist from previously generated
@@ -2681,39 +5010,25 @@ class WTVSource(Source):
     def _fetch_metadata(self):
         'Obtains any metadata which might be embedded in the WTV.'
         logging.info('*** Fetching metadata for %s ***' % self.wtv)
-        val = '\s*:\s*(.*)$'
-        tags = []
-        tags.append((re.compile('service_provider' + val), 'channel'))
-        tags.append((re.compile('service_name' + val), 'channel'))
-        tags.append((re.compile('\s+Title' + val), 'title'))
-        tags.append((re.compile('WM/SubTitle' + val), 'subtitle'))
-        tags.append((re.compile('WM/SubTitleDescription' + val),
-                     'description'))
-        tags.append((re.compile('genre' + val), self._parse_genre))
-        tags.append((re.compile('WM/MediaOriginalBroadcastDateTime' + val),
-                     self._parse_airdate))
-        tags.append((re.compile('WM/ParentalRating' + val), 'rating'))
-        tags.append((re.compile('WM/MediaCredits' + val), self._parse_credits))
-        tags.append((re.compile('WM/MediaIsMovie' + val), self._parse_movie))
-        try:
-            proc = subprocess.Popen(['ffmpeg', '-i', self.wtv],
-                                    stdout = subprocess.PIPE,
-                                    stderr = subprocess.STDOUT)
-            for line in proc.stdout:
-                for tag in tags:
-                    match = re.search(tag[0], line)
-                    if match:
-                        self.meta_present = True
-                        if type(tag[1]) == type(str()):
-                            self[tag[1]] = match.group(1).strip()
-                        else:
-                            tag[1](match.group(1).strip())
-            proc.wait()
-        except OSError:
-            raise RuntimeError('FFmpeg is not installed.')
+        tags = [('service_provider', 'channel'), ('service_name', 'channel'),
+                ('Title', 'title'), ('WM/SubTitle', 'subtitle'),
+                ('WM/SubTitleDescription', 'description'),
+                ('genre', self._parse_genre),
+                ('WM/MediaOriginalBroadcastDateTime', self._parse_airdate),
+                ('WM/ParentalRating', 'rating'),
+                ('WM/MediaCredits', self._parse_credits),
+                ('WM/MediaIsMovie', self._parse_movie)]
+        found = _probe(self.wtv).tags()
+        for name, tag in tags:
+            val = found.get(name)
+            if val is not None:
+                self.meta_present = True
+                if type(tag) == type(str()):
+                    self[tag] = val.strip()
+                else:
+                    tag(val.strip())
         self._collapse_movie()
-        self.fetch_database()
-        self.sort_credits()
+        self.start_metadata()
     
     def copy(self):
         'Extracts the MPEG-2 data from the WTV file.'
@@ -2747,7 +5062,7 @@ class MP4Source(Source):
             self.ext = self.ext[1:]
         b = os.path.basename(os.path.splitext(mp4)[0])
         self.base = os.path.join(opts.tmp, b)
-        self.time = datetime.datetime.fromtimestamp(os.stat(mp4).st_ctime)
+        self.time = None
         self.orig = os.path.abspath(mp4)
         self.final = os.path.splitext(self.orig)[0]
         self.final_file = self.orig
@@ -2755,19 +5070,21 @@ class MP4Source(Source):
     
     def _check(self, test, title, thresh = 0):
         'Determines whether a test string matches closely with the title.'
-        if thresh == 0:
-            thresh = max(int(round(len(title) * 0.25)), 3)
-        test = test.lower()
-        title = title.lower()
-        if len(title) > 8 and test.find(title) >= 0:
-            return True
-        if _levenshtein(title, test) < thresh:
-            return True
-        return False
+        return _fuzzy_match(title, [test], thresh) is not None
     
     def _check_movie(self, title, thresh = 0):
         '''Determines if a given title matches closely with the name of a
-        movie in the TMDb database, within a given Levenshtein threshold.'''
+        movie in the title catalog or the TMDb database, within a given
+        Levenshtein threshold.'''
+        catalog = _catalog(self.opts)
+        if catalog is not None:
+            year = re.search('\((\d\d\d\d)\)', title)
+            if year is not None:
+                year = int(year.group(1))
+            name = re.sub('\(\d\d\d\d\)', '', title).strip()
+            hit = catalog.lookup('movie', name, thresh, year)
+            if hit is not None and hit[1]:
+                return hit[0], MythTV.tmdb3.Movie(int(hit[1]))
         title = re.sub('-', '\\-', title)
         try:
             if re.search('\((\d\d\d\d)\)', title):
@@ -2777,20 +5094,27 @@ class MP4Source(Source):
                 movies = MythTV.tmdb3.searchMovie(title)
         except MythTV.tmdb3.tmdb_exceptions.TMDBError:
             return None
-        for m in movies:
-            t = m.title
-            if self._check(t, title, thresh):
-                return t, m
+        m = _fuzzy_match(title, movies, thresh, key = lambda m: m.title)
+        if m is not None:
+            return m.title, m
         return None
     
     def _check_show(self, title, thresh = 0):
         '''Determines if a given title matches closely with the name of a
-        TV show in the Tvdb database, within a given Levenshtein threshold.'''
+        TV show in the title catalog or the Tvdb database, within a given
+        Levenshtein threshold.'''
+        catalog = _catalog(self.opts)
+        if catalog is not None:
+            hit = catalog.lookup('show', title, thresh)
+            if hit is not None:
+                return hit[0]
         try:
-            show = self.tvdb[title].data.get('seriesname')
+            show = _tvdb_show(self.tvdb, title).data.get('seriesname')
         except MythTV.ttvdb.tvdb_exceptions.tvdb_shownotfound:
             return None
         if self._check(show, title, thresh):
+            if catalog is not None:
+                catalog.add('show', show)
             return show
         return None
     
@@ -2799,14 +5123,13 @@ class MP4Source(Source):
         episode of a TV show in the Tvdb database, within a given
         Levenshtein threshold.'''
         try:
-            show = self.tvdb[show]
+            show = _tvdb_show(self.tvdb, show)
         except MythTV.ttvdb.tvdb_exceptions.tvdb_shownotfound:
             return None
-        eps = show.search(title, key = 'episodename')
-        for ep in eps:
-            name = ep['episodename']
-            if self._check(name, title):
-                return name
+        eps = _tvdb_named(_tvdb_index(show), title)
+        ep = _fuzzy_match(title, eps, key = lambda ep: ep['episodename'])
+        if ep is not None:
+            return ep['episodename']
         return None
     
     def _fetch_metadata(self):
@@ -2844,6 +5167,11 @@ class MP4Source(Source):
         self.fetch_database()
         self.sort_credits()
     
+    def finish_metadata(self):
+        '''Does nothing, as metadata is looked up before tagging, and the
+        video is tagged in place.'''
+        pass
+    
     def copy(self):
         'Sets all video parameters to null, as they are not necessary.'
         self.fps = 0
@@ -2856,28 +5184,25 @@ class MP4Source(Source):
     def clean_copy(self):
         pass
 
-if __name__ == '__main__':
-    defaults = _read_options()
-    parser = _get_options(defaults)
-    opts, args = parser.parse_args()
-    _collapse_args(defaults, opts)
-    _check_args(args, parser, opts)
-    s = None
+def _make_source(args, opts, defaults):
+    '''Creates the appropriate video source for the given positional
+    arguments.'''
     if len(args) == 1:
         if args[0].isdigit():
             jobid = int(args[0])
-            s = MythSource(jobid, opts, defaults)
+            return MythSource.from_job(jobid, opts, defaults)
         elif re.search('\.[Ww][Tt][Vv]', args[0]) is not None:
-            wtv = args[0]
-            s = WTVSource(wtv, opts, defaults)
+            return WTVSource(args[0], opts, defaults)
         else:
-            s = MP4Source(args[0], opts, defaults)
-    else:
-        channel = int(args[0])
-        timecode = long(args[1])
-        s = MythSource(channel, timecode, opts, defaults)
+            return MP4Source(args[0], opts, defaults)
+    channel = int(args[0])
+    timecode = long(args[1])
+    return MythSource(channel, timecode, opts, defaults)
+
+def _transcode(s, opts):
+    '''Copies, cuts, demuxes, encodes and remuxes the video source using the
+    appropriate transcoder.'''
     s.copy()
-    s.print_metadata()
     s.print_options()
     if type(s) == MP4Source:
         t = NullTranscoder(s, opts)
@@ -2885,19 +5210,238 @@ if __name__ == '__main__':
         t = MKVTranscoder(s, opts)
     else:
         t = MP4Transcoder(s, opts)
+    t.start_subtitles()
     t.split()
     t.join()
     t.demux()
+    t.finish_subtitles()
     s.clean_copy()
-    t.encode_audio()
-    t.clean_audio()
-    t.encode_video()
-    t.clean_video()
+    t.encode()
+    s.finish_metadata()
+    s.print_metadata()
     t.remux()
     t.clean_tmp()
     s.clean_tmp()
     if type(s) == MythSource and opts.import_mythtv:
         s.import_mythtv()
+    _media_info.clear()
+
+def _job_args(job):
+    '''Translates a batch job into positional arguments. Jobs are either
+    MythTV recordings (chanid_time or 'chanid time', optionally with a file
+    extension), MythTV job IDs, or paths to WTV / MPEG-4 / Matroska files.'''
+    job = job.strip()
+    match = re.match('^(\d+)[_\s]+(\d{14})(\.(mpg|ts|nuv))?$',
+                     os.path.basename(job))
+    if match:
+        return [match.group(1), match.group(2)]
+    if job.isdigit():
+        return [job]
+    return [os.path.expanduser(job)]
+
+def _batch_jobs(args, opts):
+    '''Compiles the list of jobs to transcode from the positional arguments,
+    the batch file and the MythTV recording group, if specified.'''
+    jobs = [_job_args(arg) for arg in args]
+    if opts.batch_file is not None:
+        if opts.batch_file == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(os.path.expanduser(opts.batch_file), 'r') as jobfile:
+                lines = jobfile.readlines()
+        for line in lines:
+            line = re.sub('#.*', '', line).strip()
+            if line != '':
+                jobs.append(_job_args(line))
+    if opts.recgroup is not None:
+        db = _connect(opts)
+        for rec in db.searchRecorded(recgroup = opts.recgroup):
+            start = rec.starttime.strftime('%Y%m%d%H%M%S')
+            jobs.append([str(rec.chanid), start])
+    return jobs
+
+def _batch_term(signum, frame):
+    'Kills any running commands when a batch worker is terminated.'
+    _kill_commands()
+    os._exit(1)
+
+def _batch_init(cache, recordings):
+    '''Prepares a worker process for batch transcoding, using previously
+    probed tool information and discarding any inherited connections. The
+    MythTV metadata for every recording in the batch is loaded together.'''
+    _ver_cache.update(cache)
+    _databases.clear()
+    _cache_totals.clear()
+    _myth_loaders.clear()
+    _myth_wanted[:] = recordings
+    signal.signal(signal.SIGTERM, _batch_term)
+
+def _batch_job(job):
+    '''Transcodes a single batch job, returning the job description, whether
+    it succeeded, and the reason for any failure.'''
+    (args, opts, defaults) = job
+    opts = copy.deepcopy(opts)
+    name = ' '.join(args)
+    s = None
+    try:
+        s = _make_source(args, opts, defaults)
+        _transcode(s, opts)
+    except Exception as e:
+        logging.error('*** Job %s failed: %s ***' % (name, e))
+        _kill_commands()
+        if s is not None:
+            try:
+                s.clean_tmp()
+            except (OSError, IOError):
+                pass
+        return name, False, str(e)
+    return name, True, None
+
+def _run_batch(args, opts, defaults):
+    '''Transcodes each job in the batch using a pool of worker processes,
+    and prints a summary of which jobs succeeded or failed.'''
+    jobs = _batch_jobs(args, opts)
+    invalid = 0
+    for job in jobs:
+        err = _check_job(job)
+        if err is not None:
+            logging.error('*** Invalid job %s: %s ***' % (' '.join(job), err))
+            invalid += 1
+    if invalid > 0:
+        return False
+    logging.info('*** Transcoding %d jobs using %d workers ***' %
+                 (len(jobs), opts.workers))
+    _probe_tools(opts)
+    _databases.clear()
+    recordings = [(int(job[0]), long(job[1])) for job in jobs
+                  if len(job) == 2]
+    pool = multiprocessing.Pool(opts.workers, _batch_init,
+                                (_ver_cache, recordings))
+    try:
+        work = [(job, opts, defaults) for job in jobs]
+        results = pool.map_async(_batch_job, work, 1).get(sys.maxint)
+    finally:
+        pool.terminate()
+        pool.join()
+    failed = 0
+    logging.info('*** Batch summary ***')
+    for name, ok, err in results:
+        if ok:
+            logging.info('  %s: success' % name)
+        else:
+            failed += 1
+            logging.info('  %s: failed (%s)' % (name, err))
+    logging.info('  %d succeeded, %d failed' % (len(results) - failed, failed))
+    return failed == 0
+
+def _retag_files(path):
+    'Yields each MPEG-4 / Matroska video within the directory tree.'
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if re.search('\.([Mm][Pp]4|[Mm]4[Vv]|[Mm][Kk][Vv])$', name):
+                yield os.path.join(root, name)
+
+def _retag_lookup(job):
+    '''Looks up the metadata for a single video being re-tagged, returning
+    the filename, the video source (or None) and the reason for any
+    failure. Each video gets its own options and temporary directory.'''
+    (filename, opts, defaults) = job
+    opts = copy.copy(opts)
+    opts.tmp = tempfile.mkdtemp(prefix = u'retag_', dir = opts.tmp)
+    try:
+        return filename, MP4Source(filename, opts, defaults), None
+    except Exception as e:
+        logging.error('*** Lookup for %s failed: %s ***' % (filename, e))
+        shutil.rmtree(opts.tmp, True)
+        return filename, None, str(e)
+
+def _retag_write(s):
+    '''Embeds the metadata into a single video being re-tagged, unless it is
+    already tagged identically. Returns True if the video was tagged.'''
+    try:
+        t = NullTranscoder(s, s.opts)
+        if t.unchanged():
+            logging.info('*** Tags already match for %s ***' % s.final_file)
+            return False
+        t.remux()
+        t.clean_tmp()
+        return True
+    finally:
+        s.clean_tmp()
+        shutil.rmtree(s.opts.tmp, True)
+
+def _run_retag(opts, defaults):
+    '''Re-tags every MPEG-4 / Matroska video within a directory tree. The
+    metadata is looked up by one pool of threads, subject to the request
+    rate limit, and written by a separate pool as soon as each lookup
+    finishes. Prints a summary of which videos were tagged, skipped or
+    failed.'''
+    files = list(_retag_files(opts.retag))
+    logging.info('*** Re-tagging %d videos using %d lookup and %d tagging '
+                 'workers ***' % (len(files), opts.lookup_workers,
+                                  opts.tag_workers))
+    _probe_tools(opts)
+    remove_tmp = False
+    if not opts.tmp:
+        opts.tmp = tempfile.mkdtemp(prefix = u'transcode_')
+        remove_tmp = True
+    lookups = multiprocessing.pool.ThreadPool(opts.lookup_workers)
+    writers = multiprocessing.pool.ThreadPool(opts.tag_workers)
+    (results, pending) = ([], [])
+    try:
+        work = [(filename, opts, defaults) for filename in files]
+        for filename, s, err in lookups.imap_unordered(_retag_lookup, work):
+            if s is None:
+                results.append((filename, 'failed (%s)' % err))
+            else:
+                pending.append((filename, writers.apply_async(_retag_write,
+                                                              (s,))))
+        for filename, res in pending:
+            try:
+                if res.get(sys.maxint):
+                    results.append((filename, 'tagged'))
+                else:
+                    results.append((filename, 'unchanged'))
+            except Exception as e:
+                logging.error('*** Tagging %s failed: %s ***' % (filename, e))
+                results.append((filename, 'failed (%s)' % e))
+    finally:
+        lookups.terminate()
+        writers.terminate()
+        lookups.join()
+        writers.join()
+        if remove_tmp:
+            shutil.rmtree(opts.tmp, True)
+    counts = {'tagged' : 0, 'unchanged' : 0, 'failed' : 0}
+    logging.info('*** Re-tagging summary ***')
+    for filename, status in sorted(results):
+        counts[status.split()[0]] += 1
+        if status != 'unchanged':
+            logging.info('  %s: %s' % (filename, status))
+    logging.info('  %d tagged, %d already up to date, %d failed' %
+                 (counts['tagged'], counts['unchanged'], counts['failed']))
+    return counts['failed'] == 0
+
+if __name__ == '__main__':
+    defaults = _read_options()
+    parser = _get_options(defaults)
+    opts, args = parser.parse_args()
+    _collapse_args(defaults, opts)
+    _check_args(args, parser, opts)
+    try:
+        if opts.retag is not None:
+            if not _run_retag(opts, defaults):
+                exit(1)
+        elif _batch_mode(opts):
+            if not _run_batch(args, opts, defaults):
+                exit(1)
+        else:
+            _probe_tools(opts)
+            s = _make_source(args, opts, defaults)
+            _transcode(s, opts)
+    finally:
+        _kill_commands()
 
 # Copyright (c) 2012, Lucas Jacobs
 # All rights reserved.